@@ -0,0 +1,314 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: chat() のレイテンシ・スループットを計測するベンチマーク
+
+使い方:
+    python manage.py bench_chat
+    python manage.py bench_chat --service full --concurrency 1,4,8 --output bench.json
+    python manage.py bench_chat --providers recorded --recording bench_recording.json
+    python manage.py bench_chat --compare bench_before.json --output bench_after.json
+"""
+import functools
+import json
+import platform
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, List
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.stubs import (
+    FakeChatModel,
+    FakeCrossEncoder,
+    FakeEmbeddings,
+    Recording,
+    RecordedChatModel,
+    RecordedEmbeddings,
+    build_stub_multivector,
+    build_stub_router,
+    build_stub_store,
+    install_providers,
+)
+from common.timing import summarize_latencies
+from chat_ui.management.commands.import_guidelines import Command as GuidelineCommand
+from chat_ui.management.commands.load_qa_data import Command as QACommand
+
+# AIServiceLiteは内部でステージ時間を返さないため、メソッドをラップして計測する
+LITE_STAGES = {
+    'rewrite_query': 'rewrite',
+    'search_documents': 'retrieve',
+    'generate_answer': 'generate',
+}
+
+
+def peak_rss_mb() -> float:
+    """プロセスのピークRSS（MB）。LinuxはKB、macOSはバイト単位で返る"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / divisor, 1)
+
+
+def load_questions(path: str, limit: int = 0) -> List[str]:
+    """QAファイルから質問行を取り出す"""
+    with open(path, 'r', encoding='utf-8') as f:
+        records = QACommand().to_records(f.read(), 'bench', 'qa', 'qa')
+    questions = [r['question'] for r in records if r['question']]
+    return questions[:limit] if limit else questions
+
+
+def build_corpus(questions_path: str) -> List[Dict]:
+    """スタブ用のインメモリコーパス（QA + ガイドライン）"""
+    with open(questions_path, 'r', encoding='utf-8') as f:
+        records = QACommand().to_records(f.read(), 'フロントFAQ', 'qa', 'qa')
+    for doc in GuidelineCommand().parse_guideline_file('docs/guideline_unified.txt'):
+        records.append({
+            'id': doc.metadata['id'],
+            'type': 'guideline',
+            'doc_title': doc.metadata['title'],
+            'question': doc.metadata['title'],
+            'answer': '',
+            'content': doc.page_content,
+            'source': doc.metadata['source'],
+        })
+    return records
+
+
+def build_service(name: str, options, recording=None):
+    """プロバイダを差し替えたサービスを生成する
+
+    options には providers / questions / llm_latency_ms / embed_latency_ms /
+    rerank_latency_ms / real_reranker を含める（コマンド引数と同じキー）。
+    """
+    if name == 'full':
+        from common.ai_service import AIService
+        service = AIService()
+    else:
+        from common.ai_service_lite import AIServiceLite
+        service = AIServiceLite()
+
+    if options['providers'] == 'stub':
+        embeddings = FakeEmbeddings(latency_ms=options['embed_latency_ms'])
+        corpus = build_corpus(options['questions'])
+        store = build_stub_store(corpus, embeddings)
+        install_providers(
+            service,
+            llm_rewrite=FakeChatModel(latency_ms=options['llm_latency_ms'] / 2, seed=1),
+            llm_answer=FakeChatModel(latency_ms=options['llm_latency_ms'], seed=2),
+            embeddings=embeddings,
+            store=store,
+            cross_encoder=None if options['real_reranker'] else FakeCrossEncoder(options['rerank_latency_ms']),
+            multi_vector=build_stub_multivector(corpus, embeddings) if name == 'full' else None,
+            router=build_stub_router(corpus, embeddings) if name == 'full' else None,
+        )
+    elif options['providers'] == 'recorded':
+        from langchain_chroma import Chroma
+        from common.multivector import QA_VECTOR_COLLECTION
+        real_embeddings = getattr(service, 'embeddings_model', None) or service.embeddings
+        embeddings = RecordedEmbeddings(recording, inner=real_embeddings)
+        real_answer = getattr(service, 'llm_answer', None) or service.llm
+        install_providers(
+            service,
+            llm_rewrite=RecordedChatModel(recording, 'rewrite', inner=service.llm_rewrite),
+            llm_answer=RecordedChatModel(recording, 'answer', inner=real_answer),
+            embeddings=embeddings,
+            store=Chroma(collection_name='wdb', persist_directory="./wdb", embedding_function=embeddings),
+            # 取り込み済みのマルチベクトルも記録再生の埋め込みで引く
+            multi_vector=Chroma(collection_name=QA_VECTOR_COLLECTION, persist_directory="./wdb",
+                                embedding_function=embeddings) if getattr(service, 'qa_vectors', None) else None,
+            # セントロイド・IVFインデックス・店舗シャード・特徴量は実際の取り込み結果をそのまま使う
+            router=getattr(service, 'router', None),
+            ivf=getattr(service, 'ivf', None),
+            shards=getattr(service, 'shards', None),
+            features=getattr(service, 'features', None),
+            fact_index=getattr(service, 'fact_index', None),
+        )
+    return service
+
+
+class Command(BaseCommand):
+    help = 'Benchmark AIService.chat / AIServiceLite.chat latency and throughput'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions', default='docs/rag-text.txt', help='質問セット（=====区切りのQAファイル）')
+        parser.add_argument('--limit', type=int, default=50, help='使用する質問数（0で全件）')
+        parser.add_argument('--service', choices=['full', 'lite', 'both'], default='both', help='計測対象のサービス')
+        parser.add_argument('--providers', choices=['stub', 'recorded', 'live'], default='stub',
+                            help='stub: 擬似プロバイダ / recorded: 記録再生 / live: 実API')
+        parser.add_argument('--recording', default='bench_recording.json', help='recordedモードの記録ファイル')
+        parser.add_argument('--concurrency', default='1,4', help='同時実行数（カンマ区切り）')
+        parser.add_argument('--llm-latency-ms', type=float, default=400, help='スタブLLMの平均レイテンシ')
+        parser.add_argument('--embed-latency-ms', type=float, default=50, help='スタブ埋め込みのレイテンシ')
+        parser.add_argument('--rerank-latency-ms', type=float, default=5, help='スタブCross-Encoderの1ペアあたりレイテンシ')
+        parser.add_argument('--real-reranker', action='store_true', help='stubモードでも実Cross-Encoderを使用')
+        parser.add_argument('--tracemalloc', action='store_true', help='tracemallocでアロケーションを計測（低速）')
+        parser.add_argument('--output', help='結果を書き出すJSONファイル')
+        parser.add_argument('--compare', help='比較対象の過去の結果JSON')
+
+    def handle(self, *args, **options):
+        # ベンチマークの呼び出しを本番のトレースに混ぜない
+        settings.TRACE_ENABLED = False
+        questions = load_questions(options['questions'], options['limit'])
+        if not questions:
+            raise CommandError(f"質問が見つかりません: {options['questions']}")
+        levels = [int(c) for c in options['concurrency'].split(',') if c.strip()]
+        self.stdout.write(f"Questions: {len(questions)} / providers: {options['providers']} / concurrency: {levels}")
+
+        recording = Recording(options['recording']) if options['providers'] == 'recorded' else None
+        if options['tracemalloc']:
+            tracemalloc.start()
+
+        results = []
+        services = ['full', 'lite'] if options['service'] == 'both' else [options['service']]
+        for name in services:
+            service = build_service(name, options, recording)
+            if name == 'lite':
+                self.instrument_lite(service)
+            # ウォームアップ（遅延初期化やコネクション確立を計測から除外）
+            service.chat(questions[0])
+            for level in levels:
+                result = self.run(name, service, questions, level, options['tracemalloc'])
+                results.append(result)
+                self.print_result(result)
+
+        if recording is not None:
+            recording.save()
+
+        report = {
+            'meta': {
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'questions': len(questions),
+                'providers': options['providers'],
+                'llm_latency_ms': options['llm_latency_ms'],
+                'embed_latency_ms': options['embed_latency_ms'],
+                'rerank_latency_ms': options['rerank_latency_ms'],
+            },
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+        if options['compare']:
+            self.print_comparison(options['compare'], results)
+
+    def instrument_lite(self, service):
+        """AIServiceLiteのステージメソッドをラップしてスレッドごとに時間を記録する"""
+        local = threading.local()
+        service._bench_local = local
+
+        for method_name, stage in LITE_STAGES.items():
+            original = getattr(service, method_name)
+
+            @functools.wraps(original)
+            def timed(*args, _original=original, _stage=stage, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return _original(*args, **kwargs)
+                finally:
+                    timings = getattr(local, 'timings', None)
+                    if timings is not None:
+                        timings[_stage] = timings.get(_stage, 0.0) + (time.perf_counter() - start) * 1000
+
+            setattr(service, method_name, timed)
+
+    def call(self, service, question: str) -> Dict:
+        """1件実行してエンドツーエンド時間とステージ時間を返す"""
+        local = getattr(service, '_bench_local', None)
+        if local is not None:
+            local.timings = {}
+        start = time.perf_counter()
+        error = False
+        stages = {}
+        try:
+            result = service.chat(question)
+            if isinstance(result, dict):
+                info = result.get('process_info', {})
+                error = bool(info.get('system_error') or info.get('error_fallback'))
+                stages = {k: v for k, v in info.get('timings', {}).items() if k != 'total'}
+            elif local is not None:
+                stages = dict(local.timings)
+        except Exception:
+            error = True
+        return {
+            'e2e': (time.perf_counter() - start) * 1000,
+            'stages': stages,
+            'error': error,
+        }
+
+    def run(self, name: str, service, questions: List[str], concurrency: int, trace_alloc: bool) -> Dict:
+        """指定した同時実行数で質問セットを流す"""
+        if trace_alloc:
+            tracemalloc.reset_peak()
+        hedgers = getattr(service, 'hedgers', {})
+        for hedger in hedgers.values():
+            hedger.reset_stats()
+        wall_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(lambda q: self.call(service, q), questions))
+        wall = time.perf_counter() - wall_start
+
+        stage_values: Dict[str, List[float]] = {}
+        for sample in samples:
+            for stage, value in sample['stages'].items():
+                stage_values.setdefault(stage, []).append(value)
+
+        result = {
+            'service': name,
+            'concurrency': concurrency,
+            'requests': len(samples),
+            'errors': sum(1 for s in samples if s['error']),
+            'wall_seconds': round(wall, 3),
+            'throughput_rps': round(len(samples) / wall, 3) if wall else None,
+            'e2e_ms': summarize_latencies([s['e2e'] for s in samples]),
+            'stages_ms': {stage: summarize_latencies(values) for stage, values in stage_values.items()},
+            'peak_rss_mb': peak_rss_mb(),
+        }
+        if hedgers:
+            result['hedging'] = {name: hedger.stats() for name, hedger in hedgers.items()}
+        if trace_alloc:
+            current, peak = tracemalloc.get_traced_memory()
+            result['tracemalloc_current_mb'] = round(current / 1024 / 1024, 2)
+            result['tracemalloc_peak_mb'] = round(peak / 1024 / 1024, 2)
+        return result
+
+    def print_result(self, result: Dict):
+        e2e = result['e2e_ms']
+        self.stdout.write(
+            f"[{result['service']} x{result['concurrency']}] "
+            f"{result['throughput_rps']} req/s, errors {result['errors']}/{result['requests']}, "
+            f"p50 {e2e['p50']}ms p95 {e2e['p95']}ms p99 {e2e['p99']}ms, peak RSS {result['peak_rss_mb']}MB"
+        )
+        for stage, summary in result['stages_ms'].items():
+            self.stdout.write(f"    {stage:<12} p50 {summary['p50']}ms p95 {summary['p95']}ms max {summary['max']}ms")
+        for name, stats in result.get('hedging', {}).items():
+            self.stdout.write(
+                f"    hedge {name:<6} rate {stats['hedge_rate']:.1%} wins {stats['hedge_wins']}/{stats['hedged']} "
+                f"skipped {stats.get('hedges_skipped', 0)} "
+                f"retries {stats['retries']} delay {stats['hedge_delay_ms']}ms saved p50 {stats['saved_ms']['p50']}ms"
+            )
+
+    def print_comparison(self, path: str, results: List[Dict]):
+        """過去の結果と p50/p95/スループットを比較表示する"""
+        with open(path, 'r', encoding='utf-8') as f:
+            baseline = {(r['service'], r['concurrency']): r for r in json.load(f)['results']}
+        self.stdout.write(f"Comparison against {path}:")
+        for result in results:
+            before = baseline.get((result['service'], result['concurrency']))
+            if before is None:
+                continue
+            parts = []
+            for key in ('p50', 'p95'):
+                old, new = before['e2e_ms'][key], result['e2e_ms'][key]
+                if old and new is not None:
+                    parts.append(f"{key} {old}→{new}ms ({(new - old) / old * 100:+.1f}%)")
+            if before['throughput_rps'] and result['throughput_rps'] is not None:
+                old, new = before['throughput_rps'], result['throughput_rps']
+                parts.append(f"rps {old}→{new} ({(new - old) / old * 100:+.1f}%)")
+            self.stdout.write(f"  [{result['service']} x{result['concurrency']}] " + ", ".join(parts))
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: 'wdb' コレクションからクラスタ分割（IVF）インデックスを作る
+
+コレクションの全埋め込みを球面k-meansでクラスタ（既定 √N 個）に分け、
+settings.IVF_INDEX_PATH に書き出す（IVF_ENABLED=True のとき AIService が読み込む）。
+取り込みで件数が変わったインデックスは使われないので、取り込みの後に作り直す。
+
+--eval を付けると、質問セットの埋め込みで n_probe ごとの recall@k とレイテンシを
+全件比較（同じベクトルの総当たり）と Chroma の検索に対して評価する。
+
+使い方:
+    python manage.py build_ivf_index
+    python manage.py build_ivf_index --clusters 64 --eval --n-probe 1,2,4,8,16
+    python manage.py build_ivf_index --eval --scaling --output-report ivf.json
+"""
+import json
+import time
+from typing import Dict, List
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.ingest import ingest_embeddings, open_collection
+from common.ivf import IVFIndex
+from common.timing import summarize_latencies
+from chat_ui.management.commands.bench_chat import load_questions
+from chat_ui.management.commands.eval_retrieval import parse_ints
+
+
+def recall(found: List, expected: List) -> float:
+    if not expected:
+        return 1.0
+    return len({doc_id for doc_id, _ in found} & {doc_id for doc_id, _ in expected}) / len(expected)
+
+
+class Command(BaseCommand):
+    help = "Build the IVF (clustered) vector index for the 'wdb' collection and evaluate it"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clusters', type=int, default=0, help='クラスタ数（0で √N）')
+        parser.add_argument('--iterations', type=int, default=20, help='k-meansの反復回数の上限')
+        parser.add_argument('--output', default=None, help='インデックスの出力先（既定: settings.IVF_INDEX_PATH）')
+        parser.add_argument('--eval', action='store_true', help='recall@k とレイテンシを評価する')
+        parser.add_argument('--questions', default='docs/rag-text.txt', help='評価に使う質問セット')
+        parser.add_argument('--limit', type=int, default=200, help='評価に使う質問数（0で全件）')
+        parser.add_argument('--k', type=int, default=10, help='評価する取得件数')
+        parser.add_argument('--n-probe', default='1,2,4,8,16', help='評価する探索クラスタ数')
+        parser.add_argument('--scaling', action='store_true',
+                            help='コーパスの一部（1/8〜全件）で作り直し、件数に対する比較ベクトル数の伸びを見る')
+        parser.add_argument('--output-report', help='評価結果を書き出すJSONファイル')
+
+    def handle(self, *args, **options):
+        collection = open_collection()
+        start = time.perf_counter()
+        try:
+            index = IVFIndex.from_collection(collection, n_clusters=options['clusters'] or None,
+                                             iterations=options['iterations'])
+        except ValueError as e:
+            raise CommandError(f"インデックスを作れません: {e}")
+        self.stdout.write(f"Built {index.summary()} in {time.perf_counter() - start:.1f}s")
+        path = options['output'] or settings.IVF_INDEX_PATH
+        index.save(path)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {path}"))
+        if not settings.IVF_ENABLED:
+            self.stdout.write("IVF_ENABLED=False のため、chat() ではまだ使われません")
+
+        if not options['eval']:
+            return
+        questions = load_questions(options['questions'], options['limit'])
+        if not questions:
+            raise CommandError(f"質問が見つかりません: {options['questions']}")
+        # 取り込みと同じ埋め込みキャッシュを通すので、2回目以降の評価ではAPIを呼ばない
+        queries = np.asarray(ingest_embeddings().embed_documents(questions), dtype=np.float32)
+        if queries.shape[1] != index.dimensions:
+            raise CommandError(f"質問の埋め込みの次元 {queries.shape[1]} がインデックス {index.dimensions} と違います")
+
+        report = {'index': index.summary(), 'questions': len(questions), 'k': options['k'],
+                  'results': self.evaluate(index, collection, queries, options)}
+        if options['scaling']:
+            report['scaling'] = self.scaling(index, queries, options)
+        if options['output_report']:
+            with open(options['output_report'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output_report']}"))
+
+    def evaluate(self, index: IVFIndex, collection, queries: np.ndarray, options) -> List[Dict]:
+        k = options['k']
+        exact, exact_ms = [], []
+        for query in queries:
+            start = time.perf_counter()
+            exact.append(index.exhaustive_search(query, k=k))
+            exact_ms.append((time.perf_counter() - start) * 1000)
+        chroma_ms = []
+        for query in queries:
+            start = time.perf_counter()
+            collection.query(query_embeddings=[query.tolist()], n_results=k, include=['distances'])
+            chroma_ms.append((time.perf_counter() - start) * 1000)
+
+        rows = [{'method': 'exhaustive', 'n_probe': len(index.centroids), 'recall': 1.0,
+                 'scanned': 1.0, 'latency_ms': summarize_latencies(exact_ms)},
+                {'method': 'chroma', 'n_probe': None, 'recall': None,
+                 'scanned': None, 'latency_ms': summarize_latencies(chroma_ms)}]
+        for n_probe in parse_ints(options['n_probe']):
+            recalls, scanned, latencies = [], [], []
+            for query, expected in zip(queries, exact):
+                start = time.perf_counter()
+                found, count = index.search(query, k=k, n_probe=n_probe)
+                latencies.append((time.perf_counter() - start) * 1000)
+                recalls.append(recall(found, expected))
+                scanned.append(count / len(index))
+            rows.append({'method': 'ivf', 'n_probe': n_probe, 'recall': round(float(np.mean(recalls)), 4),
+                         'scanned': round(float(np.mean(scanned)), 4), 'latency_ms': summarize_latencies(latencies)})
+
+        self.stdout.write("")
+        self.stdout.write(f"{'method':<12}{'n_probe':>8}{f'R@{k}':>8}{'scanned':>9}{'p50ms':>9}{'p95ms':>9}")
+        for row in rows:
+            recall_text = f"{row['recall']:.3f}" if row['recall'] is not None else '-'
+            scanned_text = f"{row['scanned'] * 100:.1f}%" if row['scanned'] is not None else '-'
+            self.stdout.write(
+                f"{row['method']:<12}{row['n_probe'] if row['n_probe'] is not None else '-':>8}{recall_text:>8}"
+                f"{scanned_text:>9}{row['latency_ms']['p50']:>9.3f}{row['latency_ms']['p95']:>9.3f}"
+            )
+        self.stdout.write(f"R@{k} = 全件比較の上位{k}件のうちIVFで取得できた割合 / scanned = 距離を計算したベクトルの割合")
+        return rows
+
+    def scaling(self, index: IVFIndex, queries: np.ndarray, options) -> List[Dict]:
+        """コーパスの一部で作り直し、件数に対する比較ベクトル数とレイテンシの伸びを見る（n_probe は最大値）"""
+        n_probe = max(parse_ints(options['n_probe']))
+        rng = np.random.RandomState(0)
+        types = [index.type_names[code] for code in index.type_codes]
+        rows = []
+        self.stdout.write("")
+        self.stdout.write(f"{'vectors':>8}{'clusters':>10}{'scanned':>9}{'p50ms':>9}{'exh p50ms':>11}")
+        for fraction in (0.125, 0.25, 0.5, 1.0):
+            size = max(1, int(len(index) * fraction))
+            sample = np.sort(rng.choice(len(index), size, replace=False))
+            sub = IVFIndex.build(index.ids[sample], index.vectors[sample], [types[i] for i in sample],
+                                 space=index.space, iterations=options['iterations'])
+            scanned, ivf_ms, exact_ms = [], [], []
+            for query in queries:
+                start = time.perf_counter()
+                _, count = sub.search(query, k=options['k'], n_probe=n_probe)
+                ivf_ms.append((time.perf_counter() - start) * 1000)
+                scanned.append(count)
+                start = time.perf_counter()
+                sub.exhaustive_search(query, k=options['k'])
+                exact_ms.append((time.perf_counter() - start) * 1000)
+            row = {'vectors': size, 'clusters': len(sub.centroids), 'scanned': round(float(np.mean(scanned)), 1),
+                   'latency_ms': summarize_latencies(ivf_ms), 'exhaustive_ms': summarize_latencies(exact_ms)}
+            rows.append(row)
+            self.stdout.write(f"{size:>8}{row['clusters']:>10}{row['scanned']:>9.1f}"
+                              f"{row['latency_ms']['p50']:>9.3f}{row['exhaustive_ms']['p50']:>11.3f}")
+        return rows
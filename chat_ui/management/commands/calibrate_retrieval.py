@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: 適応制御（common.adaptive）の閾値をオフラインで求める
+
+各質問を chat() と同じくリライトしてから一次検索と全件の再ランクを実行し、検索方式（search_type）ごとに
+「再ランクを省いても / 上位 n 件だけ再ランクしても、全件再ランクと1位が変わらない割合」が
+--target-agreement 以上になる範囲で、省ける再ランクが最も多くなる閾値を選ぶ。
+結果は settings.ADAPTIVE_RETRIEVAL_PATH（wdbと一緒にデプロイする）に書き出す。
+
+rag-text.txt の質問は取り込んだ本文そのものなので一次検索の1位が明確になりやすく、閾値が甘くなる。
+--labels で取り込んでいない言い換えの質問（1行1件の JSON: {"question": ...}）を渡すと、そちらだけで求める。
+
+使い方:
+    python manage.py calibrate_retrieval --providers live --labels docs/paraphrases.jsonl
+    python manage.py calibrate_retrieval --providers recorded --target-agreement 0.99 --dry-run
+"""
+import json
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.adaptive import AdaptiveThresholds, score_signals
+from common.stubs import Recording
+from common.timing import summarize_latencies
+from chat_ui.management.commands.bench_chat import build_service, load_questions
+from chat_ui.management.commands.eval_retrieval import parse_ints
+
+# 閾値の探索範囲
+SKIP_SCORES = [round(0.3 + 0.025 * i, 3) for i in range(28)]
+SKIP_MARGINS = [round(0.01 * i, 2) for i in range(31)]
+SHRINK_ENTROPIES = [round(0.05 * i, 2) for i in range(21)]
+# 条件を満たす閾値が無い場合（スコアは1を超えないので再ランクを省かない）
+NEVER_SKIP = 1.01
+
+
+def load_calibration_questions(options) -> List[str]:
+    """--labels（取り込んでいない言い換え）があればその質問、無ければ質問セットの質問"""
+    if not options['labels']:
+        return load_questions(options['questions'], options['limit'])
+    questions = []
+    with open(options['labels'], 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                questions.append(json.loads(line)['question'])
+    return questions[:options['limit']] if options['limit'] else questions
+
+
+def agreement(samples: List[Dict]) -> float:
+    return sum(s['agrees'] for s in samples) / len(samples) if samples else 1.0
+
+
+def calibrate(samples: List[Dict], target: float, shrink_sizes: List[int],
+              temperature: float) -> tuple[AdaptiveThresholds, Dict]:
+    """1つの検索方式のサンプルから閾値を選び、(閾値, 評価) を返す"""
+    best_skip = (NEVER_SKIP, 0.0, [])
+    for skip_score in SKIP_SCORES:
+        for skip_margin in SKIP_MARGINS:
+            skipped = [s for s in samples
+                       if s['signals']['top_score'] >= skip_score and s['signals']['margin'] >= skip_margin]
+            marked = [{'agrees': s['vector_top'] == s['reranked_top']} for s in skipped]
+            # 省ける件数が同じなら閾値の高い（保守的な）方を残す
+            if marked and agreement(marked) >= target and len(skipped) > len(best_skip[2]):
+                best_skip = (skip_score, skip_margin, skipped)
+    skip_score, skip_margin, skipped = best_skip
+    skipped_ids = {id(s) for s in skipped}
+    rest = [s for s in samples if id(s) not in skipped_ids]
+
+    best_shrink = (0.0, shrink_sizes[0], [], 0)
+    for shrink_n in shrink_sizes:
+        for shrink_entropy in SHRINK_ENTROPIES:
+            shrunk = [s for s in rest
+                      if len(s['vector_ids']) > shrink_n and s['signals']['entropy'] <= shrink_entropy]
+            marked = [{'agrees': s['reranked_top'] in s['vector_ids'][:shrink_n]} for s in shrunk]
+            saved = sum(len(s['vector_ids']) - shrink_n for s in shrunk)
+            if marked and agreement(marked) >= target and saved > best_shrink[3]:
+                best_shrink = (shrink_entropy, shrink_n, shrunk, saved)
+    shrink_entropy, shrink_n, shrunk, _ = best_shrink
+
+    shrunk_ids = {id(s) for s in shrunk}
+    total_pairs = sum(len(s['vector_ids']) for s in samples)
+    pairs = sum(0 if id(s) in skipped_ids else shrink_n if id(s) in shrunk_ids else len(s['vector_ids'])
+                for s in samples)
+    outcome = [
+        {'agrees': s['vector_top'] == s['reranked_top'] if id(s) in skipped_ids
+         else s['reranked_top'] in s['vector_ids'][:shrink_n] if id(s) in shrunk_ids else True}
+        for s in samples
+    ]
+    thresholds = AdaptiveThresholds(skip_score=skip_score, skip_margin=skip_margin,
+                                    shrink_entropy=shrink_entropy, shrink_n=shrink_n, temperature=temperature)
+    report = {
+        'questions': len(samples),
+        'skip_rate': round(len(skipped) / len(samples), 4),
+        'shrink_rate': round(len(shrunk) / len(samples), 4),
+        'top1_agreement': round(agreement(outcome), 4),
+        'rerank_pairs_saved': round(1 - pairs / total_pairs, 4) if total_pairs else 0.0,
+        'full_rerank_ms': summarize_latencies([s['rerank_ms'] for s in samples]),
+    }
+    return thresholds, report
+
+
+class Command(BaseCommand):
+    help = 'Calibrate adaptive retrieval thresholds (rerank skip / shrink) against full reranking'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions', default='docs/rag-text.txt', help='質問セット（=====区切りのQAファイル）')
+        parser.add_argument('--labels', help='取り込んでいない言い換えの質問（JSONL: question）。指定時は --questions を使わない')
+        parser.add_argument('--limit', type=int, default=0, help='使用する質問数（0で全件）')
+        parser.add_argument('--rewrite', choices=['on', 'off'], default='on',
+                            help='chat() と同じく質問をリライトしてから検索する')
+        parser.add_argument('--providers', choices=['stub', 'recorded', 'live'], default='live')
+        parser.add_argument('--recording', default='bench_recording.json', help='recordedモードの記録ファイル')
+        parser.add_argument('--target-agreement', type=float, default=0.98,
+                            help='全件再ランクと1位が一致する割合の下限')
+        parser.add_argument('--shrink-n', default='3,5', help='再ランクを絞るときの件数の候補')
+        parser.add_argument('--temperature', type=float, default=0.05, help='エントロピー計算のsoftmax温度')
+        parser.add_argument('--min-samples', type=int, default=20,
+                            help='これより質問が少ない検索方式は既定値のままにする')
+        parser.add_argument('--llm-latency-ms', type=float, default=0, help='スタブLLMの平均レイテンシ')
+        parser.add_argument('--embed-latency-ms', type=float, default=0, help='スタブ埋め込みのレイテンシ')
+        parser.add_argument('--rerank-latency-ms', type=float, default=5, help='スタブCross-Encoderの1ペアあたりレイテンシ')
+        parser.add_argument('--real-reranker', action='store_true', help='stubモードでも実Cross-Encoderを使用')
+        parser.add_argument('--output', default=None, help='書き出すJSON（既定: settings.ADAPTIVE_RETRIEVAL_PATH）')
+        parser.add_argument('--dry-run', action='store_true', help='結果を表示するだけで書き出さない')
+
+    def handle(self, *args, **options):
+        questions = load_calibration_questions(options)
+        if not questions:
+            raise CommandError(f"質問が見つかりません: {options['labels'] or options['questions']}")
+
+        recording = Recording(options['recording']) if options['providers'] == 'recorded' else None
+        service = build_service('full', options, recording)
+        if service.cross_encoder is None:
+            raise CommandError("Cross-Encoderが使えないため、再ランクとの一致を評価できません")
+
+        samples: Dict[str, List[Dict]] = {}
+        for i, question in enumerate(questions, start=1):
+            sample = self.measure(service, question, options['temperature'], options['rewrite'] == 'on')
+            if sample is not None:
+                samples.setdefault(sample['search_type'], []).append(sample)
+            if i % 50 == 0:
+                self.stdout.write(f"  {i}/{len(questions)}")
+        if recording is not None:
+            recording.save()
+
+        thresholds, reports = {}, {}
+        for search_type, group in sorted(samples.items()):
+            if len(group) < options['min_samples']:
+                self.stdout.write(f"{search_type}: {len(group)} questions (< --min-samples), keeping defaults")
+                continue
+            thresholds[search_type], reports[search_type] = calibrate(
+                group, options['target_agreement'], parse_ints(options['shrink_n']), options['temperature'])
+        if not thresholds:
+            raise CommandError("閾値を求められる検索方式がありません")
+        self.print_table(thresholds, reports)
+
+        if options['dry_run']:
+            return
+        path = options['output'] or settings.ADAPTIVE_RETRIEVAL_PATH
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'calibrated_at': datetime.now().isoformat(timespec='seconds'),
+                'providers': options['providers'],
+                'questions': options['labels'] or options['questions'],
+                'rewrite': options['rewrite'] == 'on',
+                'target_agreement': options['target_agreement'],
+                'thresholds': {key: value.to_dict() for key, value in thresholds.items()},
+                'report': reports,
+            }, f, ensure_ascii=False, indent=2)
+        self.stdout.write(self.style.SUCCESS(f"Wrote {path}"))
+
+    @staticmethod
+    def measure(service, question: str, temperature: float, rewrite: bool = True) -> Optional[Dict]:
+        """一次検索（振り分けを含む）と全件再ランクの結果（chat() と同じくリライト後の質問で検索・再ランクする）"""
+        query = question
+        if rewrite:
+            try:
+                query = service.rewrite_query(question)
+            except Exception as e:
+                print(f"Warning: query rewrite failed: {e}")
+        candidates, search_type, _ = service.routed_retrieve(query)
+        if len(candidates) < 2:
+            return None
+        ranked = sorted(candidates, key=lambda d: d.get('score', 0), reverse=True)
+        start = time.perf_counter()
+        reranked = service.rerank_documents(query, candidates, top_n=len(candidates))
+        rerank_ms = (time.perf_counter() - start) * 1000
+        return {
+            'search_type': search_type,
+            'signals': score_signals([d.get('score', 0) for d in ranked], temperature),
+            'vector_ids': [d.get('id') for d in ranked],
+            'vector_top': ranked[0].get('id'),
+            'reranked_top': reranked[0].get('id'),
+            'rerank_ms': rerank_ms,
+        }
+
+    def print_table(self, thresholds: Dict[str, AdaptiveThresholds], reports: Dict[str, Dict]):
+        self.stdout.write("")
+        self.stdout.write(f"{'search_type':<16}{'n':>5}{'skip>=':>8}{'margin>=':>10}{'H<=':>6}{'top_n':>6}"
+                          f"{'skip%':>7}{'shrink%':>9}{'agree':>7}{'saved%':>8}")
+        for search_type, value in thresholds.items():
+            report = reports[search_type]
+            self.stdout.write(
+                f"{search_type:<16}{report['questions']:>5}{value.skip_score:>8.3f}{value.skip_margin:>10.2f}"
+                f"{value.shrink_entropy:>6.2f}{value.shrink_n:>6}{report['skip_rate'] * 100:>7.1f}"
+                f"{report['shrink_rate'] * 100:>9.1f}{report['top1_agreement']:>7.3f}"
+                f"{report['rerank_pairs_saved'] * 100:>8.1f}"
+            )
+        self.stdout.write("saved% = 全件再ランクに比べて省けるCross-Encoderのペア数の割合")
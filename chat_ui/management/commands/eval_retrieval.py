@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: 検索構成ごとの recall@k / MRR とレイテンシを評価する
+
+rag-text.txt の各QAブロックの質問で検索し、そのブロック自身が取得できるかを
+正解として扱う。構成（vector/hybrid/multivector、リライト有無、再ランク有無、k、top_n）の
+全組み合わせを評価し、精度とレイテンシのパレート表を出力する。
+
+使い方:
+    python manage.py eval_retrieval
+    python manage.py eval_retrieval --modes vector,hybrid,multivector --rewrite off,on --rerank off,on --k 5,10,20 --top-n 3,5
+    python manage.py eval_retrieval --providers live --limit 100 --output eval.json
+"""
+import itertools
+import json
+import time
+from typing import Dict, List, Optional, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common.lexical import LexicalIndex, reciprocal_rank_fusion
+from common.stubs import Recording
+from common.timing import summarize_latencies
+from chat_ui.management.commands.bench_chat import build_service, load_questions
+
+
+def parse_flags(value: str) -> List[bool]:
+    return [v.strip() == 'on' for v in value.split(',') if v.strip()]
+
+
+def parse_ints(value: str) -> List[int]:
+    return [int(v) for v in value.split(',') if v.strip()]
+
+
+class Command(BaseCommand):
+    help = 'Evaluate retrieval recall/MRR versus latency for each retrieval configuration'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions', default='docs/rag-text.txt', help='正解セット（=====区切りのQAファイル）')
+        parser.add_argument('--limit', type=int, default=0, help='評価する質問数（0で全件）')
+        parser.add_argument('--providers', choices=['stub', 'recorded', 'live'], default='stub')
+        parser.add_argument('--recording', default='bench_recording.json', help='recordedモードの記録ファイル')
+        parser.add_argument('--modes', default='vector,hybrid', help='検索方式（vector,hybrid,multivector）')
+        parser.add_argument('--rewrite', default='off,on', help='質問リライトの有無（off,on）')
+        parser.add_argument('--rerank', default='off,on', help='再ランクの有無（off,on）')
+        parser.add_argument('--k', default='5,10,20', help='一次検索の取得件数')
+        parser.add_argument('--top-n', default='3,5', help='最終的に残す件数')
+        parser.add_argument('--llm-latency-ms', type=float, default=400, help='スタブLLMの平均レイテンシ')
+        parser.add_argument('--embed-latency-ms', type=float, default=50, help='スタブ埋め込みのレイテンシ')
+        parser.add_argument('--rerank-latency-ms', type=float, default=5, help='スタブCross-Encoderの1ペアあたりレイテンシ')
+        parser.add_argument('--real-reranker', action='store_true', help='stubモードでも実Cross-Encoderを使用')
+        parser.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    def handle(self, *args, **options):
+        questions = load_questions(options['questions'], options['limit'])
+        if not questions:
+            raise CommandError(f"質問が見つかりません: {options['questions']}")
+
+        recording = Recording(options['recording']) if options['providers'] == 'recorded' else None
+        service = build_service('full', options, recording)
+        self.service = service
+        self.lexical = None
+        # ステージ出力と所要時間のメモ（同じ入力を構成間で共有してAPI呼び出しを減らす）
+        self.memo: Dict[Tuple, Tuple[object, float]] = {}
+
+        modes = [m.strip() for m in options['modes'].split(',') if m.strip()]
+        if 'hybrid' in modes:
+            self.lexical = LexicalIndex.from_store(service.db, doc_type='qa')
+        if 'multivector' in modes and not getattr(service, 'qa_vectors', None):
+            raise CommandError("質問・回答ベクトルがありません（ingest / load_qa_data で取り込んでください）")
+
+        configs = list(itertools.product(
+            modes,
+            parse_flags(options['rewrite']),
+            parse_flags(options['rerank']),
+            parse_ints(options['k']),
+            parse_ints(options['top_n']),
+        ))
+        self.stdout.write(f"Questions: {len(questions)} / configurations: {len(configs)}")
+
+        rows = []
+        for mode, rewrite, rerank, k, top_n in configs:
+            if top_n > k:
+                continue
+            rows.append(self.evaluate(questions, mode, rewrite, rerank, k, top_n))
+
+        if recording is not None:
+            recording.save()
+
+        mark_pareto(rows)
+        self.print_table(rows)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump({'questions': len(questions), 'providers': options['providers'], 'results': rows},
+                          f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def timed(self, key: Tuple, func):
+        """同じ入力のステージ結果はメモから返し、初回計測時の所要時間を使う"""
+        if key not in self.memo:
+            start = time.perf_counter()
+            value = func()
+            self.memo[key] = (value, (time.perf_counter() - start) * 1000)
+        return self.memo[key]
+
+    def retrieve(self, question: str, mode: str, rewrite: bool, rerank: bool, k: int, top_n: int):
+        """1構成で検索を実行し、(一次検索結果, 最終結果, 所要時間ms) を返す"""
+        latency = 0.0
+        query = question
+        if rewrite:
+            query, elapsed = self.timed(('rewrite', question), lambda: self.service.rewrite_query(question))
+            latency += elapsed
+
+        if mode == 'multivector':
+            candidates, elapsed = self.timed(('multivector', query, k),
+                                             lambda: self.service.multi_vector_search(query, k=k))
+        else:
+            candidates, elapsed = self.timed(('vector', query, k),
+                                             lambda: self.service.vector_search(query, doc_type='qa', k=k))
+        latency += elapsed
+        if mode == 'hybrid':
+            lexical, elapsed = self.timed(('lexical', query, k), lambda: self.lexical.search(query, k=k))
+            latency += elapsed
+            candidates = reciprocal_rank_fusion([candidates, lexical], limit=k)
+
+        if rerank:
+            reranked, elapsed = self.timed(
+                ('rerank', mode, query, k),
+                lambda: self.service.rerank_documents(query, [dict(d) for d in candidates], top_n=k),
+            )
+            latency += elapsed
+            final = reranked[:top_n]
+        else:
+            final = sorted(candidates, key=lambda d: d.get('score', 0), reverse=True)[:top_n]
+        return candidates, final, latency
+
+    def evaluate(self, questions: List[str], mode: str, rewrite: bool, rerank: bool, k: int, top_n: int) -> Dict:
+        hits_at_1 = hits_at_k = hits_at_n = 0
+        reciprocal_ranks = []
+        latencies = []
+        for question in questions:
+            candidates, final, latency = self.retrieve(question, mode, rewrite, rerank, k, top_n)
+            latencies.append(latency)
+            if find_rank(candidates, question) is not None:
+                hits_at_k += 1
+            rank = find_rank(final, question)
+            if rank is not None:
+                hits_at_n += 1
+                hits_at_1 += rank == 1
+                reciprocal_ranks.append(1.0 / rank)
+            else:
+                reciprocal_ranks.append(0.0)
+
+        total = len(questions)
+        return {
+            'mode': mode,
+            'rewrite': rewrite,
+            'rerank': rerank,
+            'k': k,
+            'top_n': top_n,
+            'recall_at_1': round(hits_at_1 / total, 4),
+            'recall_at_k': round(hits_at_k / total, 4),
+            'recall_at_top_n': round(hits_at_n / total, 4),
+            'mrr': round(sum(reciprocal_ranks) / total, 4),
+            'latency_ms': summarize_latencies(latencies),
+        }
+
+    def print_table(self, rows: List[Dict]):
+        self.stdout.write("")
+        self.stdout.write(f"{'':2}{'mode':<12}{'rewrite':<8}{'rerank':<7}{'k':>4}{'top_n':>6}"
+                          f"{'R@1':>8}{'R@k':>8}{'R@n':>8}{'MRR':>8}{'p50ms':>10}{'p95ms':>10}")
+        for row in sorted(rows, key=lambda r: r['latency_ms']['p50'] or 0):
+            self.stdout.write(
+                f"{'*' if row['pareto'] else ' ':2}{row['mode']:<12}{'on' if row['rewrite'] else 'off':<8}"
+                f"{'on' if row['rerank'] else 'off':<7}{row['k']:>4}{row['top_n']:>6}"
+                f"{row['recall_at_1']:>8.3f}{row['recall_at_k']:>8.3f}{row['recall_at_top_n']:>8.3f}"
+                f"{row['mrr']:>8.3f}{row['latency_ms']['p50']:>10.1f}{row['latency_ms']['p95']:>10.1f}"
+            )
+        self.stdout.write("* = パレート最適（MRRとp50レイテンシの両方で他の構成に劣らない）")
+
+
+def find_rank(documents: List[Dict], question: str) -> Optional[int]:
+    """質問自身のレコードが何位にあるか（1始まり）。見つからなければNone"""
+    for rank, doc in enumerate(documents, start=1):
+        if doc['metadata'].get('question') == question:
+            return rank
+    return None
+
+
+def mark_pareto(rows: List[Dict]):
+    """MRRが高くp50レイテンシが低い構成をパレート最適としてマークする"""
+    for row in rows:
+        row['pareto'] = not any(
+            other is not row
+            and other['mrr'] >= row['mrr']
+            and other['latency_ms']['p50'] <= row['latency_ms']['p50']
+            and (other['mrr'] > row['mrr'] or other['latency_ms']['p50'] < row['latency_ms']['p50'])
+            for other in rows
+        )
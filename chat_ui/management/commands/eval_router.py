@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: 検索前の振り分け（common.router）の正解率と、省けた検索回数を評価する
+
+正解ラベルは rag-text.txt の質問を qa、ガイドラインのタイトルを guideline とし、
+--labels で手作業のラベル（1行1件の JSON: {"question": ..., "route": "qa" | "guideline"}）を追加できる。
+各質問で chat() を振り分けあり・なしの2回実行し、ベクトル検索・再ランクの呼び出し回数とレイテンシを比べる。
+
+使い方:
+    python manage.py eval_router
+    python manage.py eval_router --providers recorded --labels docs/router_labels.jsonl --output router.json
+"""
+import functools
+import json
+import time
+from typing import Dict, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common.parsers import iter_guideline_sections, read_lines
+from common.router import ROUTES
+from common.stubs import Recording
+from common.timing import summarize_latencies
+from chat_ui.management.commands.bench_chat import build_service, load_questions
+
+# 呼び出し回数を数えるメソッド
+COUNTED = ('vector_search', 'multi_vector_search', 'rerank_documents')
+
+
+def load_labels(options) -> List[Tuple[str, str]]:
+    """(質問, 正解の振り分け先) の一覧"""
+    labels = [(question, 'qa') for question in load_questions(options['questions'], options['limit'])]
+    labels += [(section['title'], 'guideline')
+               for section in iter_guideline_sections(read_lines(options['guidelines']))]
+    if options['labels']:
+        with open(options['labels'], 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    row = json.loads(line)
+                    labels.append((row['question'], row['route']))
+    return labels
+
+
+class Command(BaseCommand):
+    help = 'Evaluate intent routing accuracy and the retrieval calls it saves'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions', default='docs/rag-text.txt', help='QAの質問（正解 qa）')
+        parser.add_argument('--guidelines', default='docs/guideline_unified.txt', help='ガイドライン（タイトルの正解 guideline）')
+        parser.add_argument('--labels', help='追加のラベル（JSONL: question / route）')
+        parser.add_argument('--limit', type=int, default=0, help='使用するQAの質問数（0で全件）')
+        parser.add_argument('--providers', choices=['stub', 'recorded', 'live'], default='stub')
+        parser.add_argument('--recording', default='bench_recording.json', help='recordedモードの記録ファイル')
+        parser.add_argument('--llm-latency-ms', type=float, default=0, help='スタブLLMの平均レイテンシ')
+        parser.add_argument('--embed-latency-ms', type=float, default=50, help='スタブ埋め込みのレイテンシ')
+        parser.add_argument('--rerank-latency-ms', type=float, default=5, help='スタブCross-Encoderの1ペアあたりレイテンシ')
+        parser.add_argument('--real-reranker', action='store_true', help='stubモードでも実Cross-Encoderを使用')
+        parser.add_argument('--output', help='質問ごとの結果を書き出すJSONファイル')
+
+    def handle(self, *args, **options):
+        labels = load_labels(options)
+        if not labels:
+            raise CommandError("評価する質問がありません")
+
+        recording = Recording(options['recording']) if options['providers'] == 'recorded' else None
+        service = build_service('full', options, recording)
+        if service.router is None:
+            raise CommandError("セントロイドがありません（ingest / load_qa_data で取り込むと作られます）")
+        service.use_rewrite = False
+        counts = self.instrument(service)
+
+        rows = []
+        for i, (question, expected) in enumerate(labels, start=1):
+            routed = self.run(service, counts, question, use_router=True)
+            baseline = self.run(service, counts, question, use_router=False)
+            rows.append({
+                'question': question,
+                'expected': expected,
+                'route': (routed['trace'].get('routing') or {}).get('route'),
+                'routed': routed['calls'],
+                'baseline': baseline['calls'],
+                'routed_ms': routed['ms'],
+                'baseline_ms': baseline['ms'],
+                'top1_same': (routed['trace'].get('context_ids') or [None])[:1]
+                             == (baseline['trace'].get('context_ids') or [None])[:1],
+            })
+            if i % 50 == 0:
+                self.stdout.write(f"  {i}/{len(labels)}")
+        if recording is not None:
+            recording.save()
+
+        self.print_summary(rows)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(rows, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    @staticmethod
+    def instrument(service) -> Dict[str, int]:
+        """検索・再ランクのメソッドをラップして呼び出し回数を数える（1件ずつ順に実行する前提）"""
+        counts = {name: 0 for name in COUNTED}
+        for method_name in COUNTED:
+            original = getattr(service, method_name)
+
+            @functools.wraps(original)
+            def counted(*args, _original=original, _name=method_name, **kwargs):
+                counts[_name] += 1
+                return _original(*args, **kwargs)
+
+            setattr(service, method_name, counted)
+        return counts
+
+    @staticmethod
+    def run(service, counts: Dict[str, int], question: str, use_router: bool) -> Dict:
+        for name in counts:
+            counts[name] = 0
+        service.use_router = use_router
+        start = time.perf_counter()
+        _, trace = service.run_traced(question)
+        return {
+            'trace': trace,
+            'calls': {'searches': counts['vector_search'] + counts['multi_vector_search'],
+                      'reranks': counts['rerank_documents']},
+            'ms': (time.perf_counter() - start) * 1000,
+        }
+
+    def print_summary(self, rows: List[Dict]):
+        total = len(rows)
+        routed = [r for r in rows if r['route']]
+        exact = sum(r['route'] == r['expected'] for r in routed)
+        covered = sum(r['route'] in (r['expected'], 'both') for r in routed)
+        self.stdout.write("")
+        self.stdout.write(f"Routed {len(routed)}/{total} questions: accuracy {exact / max(len(routed), 1):.3f}, "
+                          f"expected partition searched {covered / max(len(routed), 1):.3f}")
+
+        # 混同行列（行: 正解、列: 振り分け先）
+        expected_labels = sorted({r['expected'] for r in rows})
+        self.stdout.write(f"  {'expected':<12}" + "".join(f"{route:>10}" for route in ROUTES))
+        for expected in expected_labels:
+            cells = [sum(r['expected'] == expected and r['route'] == route for r in rows) for route in ROUTES]
+            self.stdout.write(f"  {expected:<12}" + "".join(f"{cell:>10}" for cell in cells))
+
+        for key in ('searches', 'reranks'):
+            before = sum(r['baseline'][key] for r in rows)
+            after = sum(r['routed'][key] for r in rows)
+            saved = 1 - after / before if before else 0.0
+            self.stdout.write(f"  {key:<9} {before / total:.2f} → {after / total:.2f} per question "
+                              f"({saved * 100:.1f}% saved)")
+        baseline_ms = summarize_latencies([r['baseline_ms'] for r in rows])
+        routed_ms = summarize_latencies([r['routed_ms'] for r in rows])
+        self.stdout.write(f"  latency   p50 {baseline_ms['p50']}ms → {routed_ms['p50']}ms, "
+                          f"p95 {baseline_ms['p95']}ms → {routed_ms['p95']}ms")
+        self.stdout.write(f"  top-1 context unchanged {sum(r['top1_same'] for r in rows)}/{total}")
@@ -1,16 +1,32 @@
 # -*- coding: utf-8 -*-
 """
 ガイドラインファイルをChromaDBに取り込むDjango管理コマンド
+
+IDはタイトルから作り、再実行するとファイルとの差分（追加・更新・削除）だけを適用する。
+差分を比べるのは同じファイルから取り込んだガイドライン（メタデータの doc_title）だけなので、
+別のファイルを取り込んでも他のファイルのガイドラインは消えない（全部消すのは --clear のときだけ）。
+--store を付けると、その店舗のシャード（common.shards）に取り込む。
+
+使い方:
+    python manage.py import_guidelines
+    python manage.py import_guidelines --file docs/shibuya_guideline.txt --store shibuya
 """
 
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from langchain_openai import OpenAIEmbeddings
 from langchain_chroma import Chroma
 from langchain.schema import Document
-from django.conf import settings
 import os
 from pathlib import Path
 
+from common.features import FeatureStore
+from common.ivf import invalidate_index
+from common.router import rebuild_centroids
+from common.shards import SHARD_METADATA, shard_name, store_records, validate_store
+from common.ingest import ingest_embeddings
+from common.parsers import batched, iter_guideline_records, read_lines, source_config, source_scope
+from common.sync import sync_stream
+
 class Command(BaseCommand):
     help = 'ガイドラインファイルをChromaDBに取り込む'
 
@@ -26,6 +42,22 @@ class Command(BaseCommand):
             action='store_true',
             help='既存のガイドラインドキュメントを削除してから追加'
         )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='差分を表示するだけで適用しない'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='1回に読み込んで反映する件数（デフォルト: 500）'
+        )
+        parser.add_argument(
+            '--store',
+            type=str,
+            help='店舗コード（指定するとブランド共通ではなくその店舗のシャードに取り込む）'
+        )
 
     def handle(self, *args, **options):
         self.stdout.write("ガイドラインファイルをChromaDBに取り込み開始...")
@@ -35,13 +67,17 @@ class Command(BaseCommand):
         if not os.path.exists(file_path):
             self.stderr.write(f"ファイルが見つかりません: {file_path}")
             return
+        try:
+            store = validate_store(options['store']) if options['store'] else None
+        except ValueError as e:
+            self.stderr.write(str(e))
+            return
+        collection_name = shard_name(store)
         
         # OpenAI Embeddings初期化
         try:
-            embeddings = OpenAIEmbeddings(
-                api_key=settings.OPENAI_API_KEY,
-                model="text-embedding-3-small"
-            )
+            # 本文が変わっていないガイドラインは埋め込みキャッシュから返す
+            embeddings = ingest_embeddings()
         except Exception as e:
             self.stderr.write(f"OpenAI Embeddings初期化エラー: {e}")
             return
@@ -56,14 +92,15 @@ class Command(BaseCommand):
             collection_names = [c.name for c in collections]
             self.stdout.write(f"既存のコレクション: {collection_names}")
             
-            # 'wdb'コレクションを取得
-            if 'wdb' not in collection_names:
-                self.stdout.write("'wdb'コレクションが存在しません。作成します...")
-                client.create_collection(name='wdb')
+            # 'wdb'（店舗を指定した場合は店舗のシャード）を取得
+            if collection_name not in collection_names:
+                self.stdout.write(f"'{collection_name}'コレクションが存在しません。作成します...")
+                client.create_collection(name=collection_name, metadata=SHARD_METADATA if store else None)
+            collection = client.get_collection(collection_name)
             
             db = Chroma(
                 client=client,
-                collection_name='wdb',
+                collection_name=collection_name,
                 embedding_function=embeddings
             )
             
@@ -72,114 +109,87 @@ class Command(BaseCommand):
             self.stdout.write("デフォルト設定で初期化を試行...")
             try:
                 db = Chroma(
-                    collection_name='wdb',
+                    collection_name=collection_name,
                     persist_directory="./wdb",
                     embedding_function=embeddings
                 )
             except Exception as e2:
                 self.stderr.write(f"デフォルト初期化も失敗: {e2}")
                 return
+            collection = db._collection
         
-        # ガイドラインファイルを解析
-        self.stdout.write(f"ファイルを解析中: {file_path}")
-        documents = self.parse_guideline_file(file_path)
-        self.stdout.write(f"解析完了: {len(documents)} 個のドキュメントを抽出")
-        
-        if not documents:
-            self.stderr.write("ドキュメントが抽出されませんでした")
-            return
-        
-        # ドキュメント詳細表示
-        for i, doc in enumerate(documents[:3]):  # 最初の3つのみ表示
-            self.stdout.write(f"ドキュメント {i+1}:")
-            self.stdout.write(f"  タイトル: {doc.metadata.get('title', 'N/A')}")
-            self.stdout.write(f"  カテゴリ: {doc.metadata.get('category', 'N/A')}")
-            self.stdout.write(f"  内容 (先頭100文字): {doc.page_content[:100]}...")
-        
-        if len(documents) > 3:
-            self.stdout.write(f"...他 {len(documents) - 3} 個のドキュメント")
+        # 店舗のドキュメントは特徴量ストア（ファクト・セントロイド）に入れない
+        features = FeatureStore() if store is None else None
         
         # 既存のガイドラインドキュメント処理
-        if options['clear']:
-            self.stdout.write("既存のガイドラインドキュメント削除処理をスキップ（現在未実装）")
-        else:
-            try:
-                existing_docs = db.similarity_search("", k=1000, filter={"type": "guideline"})
-                if existing_docs:
-                    self.stdout.write(
-                        self.style.WARNING(
-                            f"警告: 既存のガイドラインドキュメント {len(existing_docs)} 個が存在します。"
-                            "重複する可能性があります。--clear オプションを使用してください。"
-                        )
-                    )
-            except Exception as e:
-                self.stdout.write(f"既存ドキュメント確認でエラー: {e}")
+        if options['clear'] and not options['dry_run']:
+            existing_ids = collection.get(where={"type": "guideline"}, include=[])['ids']
+            if existing_ids:
+                collection.delete(ids=existing_ids)
+                if features is not None:
+                    features.delete(existing_ids)
+            self.stdout.write(f"既存のガイドラインドキュメント {len(existing_ids)} 個を削除しました")
         
-        # ChromaDBに追加
-        self.stdout.write("ChromaDBに追加中...")
+        # ガイドラインファイルを1件ずつ解析し、batch_size 件ずつ差分を適用（範囲はこのファイルのガイドラインだけ）
+        self.stdout.write(f"ファイルを解析中: {file_path}")
+        config = source_config(file_path, format='guideline')
+        records = self.preview(iter_guideline_records(read_lines(file_path), doc_title=config['doc_title'],
+                                                      id_prefix=config['id_prefix']))
+        if store:
+            records = store_records(records, store)
+        self.stdout.write("ChromaDBに反映中...")
         try:
-            db.add_documents(documents)
+            stats = sync_stream(
+                collection, batched(records, options['batch_size']), source_scope(config),
+                embeddings, features, dry_run=options['dry_run'],
+            )
+            if options['dry_run']:
+                self.stdout.write(f"差分: {stats.summary()}")
+                return
             self.stdout.write(
-                self.style.SUCCESS(f"✅ {len(documents)} 個のドキュメントを正常に追加しました")
+                self.style.SUCCESS(f"✅ 同期しました: {stats.summary()}")
             )
+            if stats.inserted or stats.updated:
+                self.stdout.write(embeddings.summary())
+            if features is not None:
+                self.stdout.write(f"振り分け用のセントロイドを {rebuild_centroids(collection, features)} 個作り直しました")
+                if (options['clear'] or stats.changed) and invalidate_index(settings.IVF_INDEX_PATH):
+                    self.stdout.write("IVFインデックスを削除しました（build_ivf_index で作り直してください）")
             
-            # 追加確認
-            test_results = db.similarity_search("Wブランド", k=3, filter={"type": "guideline"})
-            self.stdout.write(f"確認検索結果: {len(test_results)} 個のドキュメントが見つかりました")
-            
-            for i, result in enumerate(test_results):
-                title = result.metadata.get('title', 'タイトルなし')
-                category = result.metadata.get('category', 'カテゴリなし')
-                self.stdout.write(f"  {i+1}. {title} ({category})")
+            # 追加確認（変更が無ければ検索クエリの埋め込みも呼ばない）
+            if stats.changed:
+                test_results = db.similarity_search("Wブランド", k=3, filter={"type": "guideline"})
+                self.stdout.write(f"確認検索結果: {len(test_results)} 個のドキュメントが見つかりました")
+                
+                for i, result in enumerate(test_results):
+                    title = result.metadata.get('title', 'タイトルなし')
+                    category = result.metadata.get('category', 'カテゴリなし')
+                    self.stdout.write(f"  {i+1}. {title} ({category})")
                 
         except Exception as e:
-            self.stderr.write(f"❌ ChromaDBへの追加でエラーが発生: {e}")
+            self.stderr.write(f"❌ ChromaDBへの反映でエラーが発生: {e}")
             return
         
         self.stdout.write(self.style.SUCCESS("✅ ガイドライン取り込み完了!"))
 
+    def preview(self, records):
+        """最初の3件の内容を表示しながらレコードをそのまま流す"""
+        count = 0
+        for record in records:
+            count += 1
+            if count <= 3:
+                self.stdout.write(f"ドキュメント {count}:")
+                self.stdout.write(f"  タイトル: {record['metadata'].get('title', 'N/A')}")
+                self.stdout.write(f"  カテゴリ: {record['metadata'].get('category', 'N/A')}")
+                self.stdout.write(f"  内容 (先頭100文字): {record['content'][:100]}...")
+            yield record
+        if count > 3:
+            self.stdout.write(f"...他 {count - 3} 個のドキュメント")
+        self.stdout.write(f"解析完了: {count} 個のドキュメントを抽出")
+
     def parse_guideline_file(self, file_path):
         """統一形式のガイドラインファイルを解析してドキュメントリストを返す"""
-        documents = []
-        
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # '---'で分割
-        sections = content.split('---\n')
-        
-        for section in sections:
-            section = section.strip()
-            if not section:
-                continue
-                
-            lines = section.split('\n')
-            title = ""
-            category = ""
-            content_lines = []
-            
-            for line in lines:
-                if line.startswith('タイトル: '):
-                    title = line.replace('タイトル: ', '').strip()
-                elif line.startswith('カテゴリ: '):
-                    category = line.replace('カテゴリ: ', '').strip()
-                elif line.startswith('内容: '):
-                    content_lines.append(line.replace('内容: ', '').strip())
-                elif content_lines:  # 内容の続き
-                    content_lines.append(line.strip())
-            
-            if title and category and content_lines:
-                content_text = '\n'.join(content_lines)
-                
-                doc = Document(
-                    page_content=content_text,
-                    metadata={
-                        'title': title,
-                        'type': 'guideline',
-                        'category': category,
-                        'source': f'ガイドライン - {title}'
-                    }
-                )
-                documents.append(doc)
-        
-        return documents
\ No newline at end of file
+        return [
+            Document(page_content=record['content'], metadata=record['metadata'])
+            for record in iter_guideline_records(read_lines(file_path))
+        ]
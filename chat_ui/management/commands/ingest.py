@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: マニュアル類をまとめてChromaDBに取り込む
+
+ファイルごとに形式（qa / guideline / text）のパーサを選び、並列に差分同期する。
+既知のファイル（common.parsers.DOCUMENT_SOURCES）は形式・種別・タイトルが決まっており、
+それ以外は地の文（text）としてトークン数で区切ったチャンクにする。
+ほぼ重複したレコードは取り込み前に1件にまとめる（--no-dedupe で無効）。
+最後に検索前の振り分け（common.router）に使うセントロイドを作り直す。
+--store を付けると、その店舗のシャード（common.shards）に取り込む
+（店舗のドキュメントは特徴量・マルチベクトル・セントロイドの対象外）。
+
+使い方:
+    python manage.py ingest docs/rag-text.txt docs/guideline_unified.txt docs/concept.txt docs/history.txt docs/rinenn.txt
+    python manage.py ingest docs/concept.txt --chunk-tokens 300 --overlap-tokens 50 --dry-run
+    python manage.py ingest docs/new_manual.txt --format text --type manual --doc-title "新マニュアル"
+    python manage.py ingest docs/shibuya_rules.txt --format text --type manual --store shibuya
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.dedupe import collapse_duplicates, find_duplicates
+from common.features import FeatureStore
+from common.ingest import IngestStats, ingest_embeddings, open_collection
+from common.ivf import invalidate_index
+from common.multivector import QA_VECTOR_COLLECTION, QA_VECTOR_METADATA, iter_child_records
+from common.parsers import PARSERS, batched, parse_source, source_config, source_scope
+from common.router import rebuild_centroids
+from common.shards import SHARD_METADATA, shard_name, store_records, validate_store
+from common.sync import sync_stream
+
+
+class Command(BaseCommand):
+    help = 'Ingest manual files (QA, guideline, free text) into ChromaDB in one pass'
+
+    def add_arguments(self, parser):
+        parser.add_argument('files', nargs='+', help='Files to ingest')
+        parser.add_argument('--format', choices=sorted(PARSERS), help='Parser for all files (default: by file name)')
+        parser.add_argument('--type', help='Document type metadata (default: by file name)')
+        parser.add_argument('--doc-title', help='Document title metadata (default: by file name)')
+        parser.add_argument('--chunk-tokens', type=int, default=400, help='Max tokens per text chunk')
+        parser.add_argument('--overlap-tokens', type=int, default=60, help='Tokens repeated between text chunks')
+        parser.add_argument('--workers', type=int, default=4, help='Files processed in parallel')
+        parser.add_argument('--concurrency', type=int, default=2, help='Parallel embedding requests per file')
+        parser.add_argument('--batch-tokens', type=int, default=20000, help='Max tokens per embedding request')
+        parser.add_argument('--batch-size', type=int, default=500, help='Records read and synced per batch')
+        parser.add_argument('--dry-run', action='store_true', help='Show the sync plan without applying it')
+        parser.add_argument('--no-dedupe', action='store_true', help='Keep near-duplicate records')
+        parser.add_argument('--dedupe-threshold', type=float, default=0.8,
+                            help='MinHash Jaccard at or above which records are duplicates')
+        parser.add_argument('--dedupe-embedding-threshold', type=float, default=0.95,
+                            help='Embedding cosine that confirms pairs between 0.5 and --dedupe-threshold')
+        parser.add_argument('--store', help='Store code: ingest into that store\'s shard instead of the brand shard')
+
+    def handle(self, *args, **options):
+        try:
+            store = validate_store(options['store']) if options['store'] else None
+        except ValueError as e:
+            raise CommandError(str(e))
+        configs = [
+            source_config(path, format=options['format'], type=options['type'], doc_title=options['doc_title'],
+                          chunk_tokens=options['chunk_tokens'], overlap_tokens=options['overlap_tokens'])
+            for path in options['files']
+        ]
+        for config in configs:
+            if config['format'] not in PARSERS:
+                raise CommandError(f"Unknown format for {config['path']}: {config['format']}")
+            self.stdout.write(f"{config['path']}: format={config['format']} type={config['type']} "
+                              f"title={config.get('doc_title', '-')}")
+
+        embeddings = ingest_embeddings()
+        if store:
+            self.stdout.write(f"Store shard: {shard_name(store)}")
+            collection = open_collection(name=shard_name(store), metadata=SHARD_METADATA)
+            qa_vectors, features = None, None
+        else:
+            collection = open_collection()
+            qa_vectors = open_collection(name=QA_VECTOR_COLLECTION, metadata=QA_VECTOR_METADATA)
+            features = FeatureStore()
+        throughput = IngestStats()
+
+        def run(config):
+            read_records = lambda: parse_source(config)
+            if not options['no_dedupe']:
+                # 候補ペアの埋め込み確認はドライランでは行わない（APIを呼ばない）
+                duplicates = find_duplicates(
+                    read_records, embeddings=None if options['dry_run'] else embeddings,
+                    threshold=options['dedupe_threshold'],
+                    embedding_threshold=options['dedupe_embedding_threshold'],
+                )
+                self.stdout.write(f"{config['path']}: {duplicates.summary()}")
+                read_records = lambda: collapse_duplicates(parse_source(config), duplicates)
+            if store:
+                parsed = read_records
+                read_records = lambda: store_records(parsed(), store)
+            sync_options = dict(dry_run=options['dry_run'], concurrency=options['concurrency'],
+                                batch_tokens=options['batch_tokens'], on_batch=throughput.add)
+            stats = sync_stream(collection, batched(read_records(), options['batch_size']), source_scope(config),
+                                embeddings, features, **sync_options)
+            if config['format'] == 'qa' and qa_vectors is not None:
+                # 質問・回答を別ベクトルにしたインデックスも同じ範囲で同期する
+                vector_stats = sync_stream(
+                    qa_vectors, batched(iter_child_records(read_records()), options['batch_size']),
+                    source_scope(config), embeddings, None, **sync_options,
+                )
+                self.stdout.write(f"{config['path']}: question/answer vectors {vector_stats.summary()}")
+            return config, stats
+
+        failed = 0
+        changed = False
+        with ThreadPoolExecutor(max_workers=max(1, options['workers'])) as executor:
+            futures = [executor.submit(run, config) for config in configs]
+            for future, config in zip(futures, configs):
+                try:
+                    _, stats = future.result()
+                except Exception as e:
+                    failed += 1
+                    self.stdout.write(self.style.ERROR(f"{config['path']}: {e}"))
+                    continue
+                self.stdout.write(f"{config['path']}: {stats.summary()}")
+                changed = changed or stats.changed
+
+        if not options['dry_run']:
+            self.stdout.write(f"Embedded {throughput.summary()}")
+            self.stdout.write(embeddings.summary())
+            # 検索前の振り分けに使う 種別/カテゴリ のセントロイドを作り直す（ブランドシャードだけ）
+            if features is not None:
+                self.stdout.write(f"Rebuilt {rebuild_centroids(collection, features)} routing centroids")
+                # ブランドシャードが変わったらIVFインデックスは古いので消す
+                if changed and invalidate_index(settings.IVF_INDEX_PATH):
+                    self.stdout.write("Removed the IVF index (run build_ivf_index to rebuild it)")
+        if failed:
+            raise CommandError(f"{failed} of {len(configs)} files failed")
+        self.stdout.write(self.style.SUCCESS(f"Ingested {len(configs)} files"))
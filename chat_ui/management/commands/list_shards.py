@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: ブランドシャード（'wdb'）と店舗シャードの件数・種別の内訳・検索レイテンシを表示する
+
+--questions を付けると、質問セットの埋め込みで各シャードを検索して p50/p95 を測る
+（ブランド + 1店舗 の2シャードを検索する chat() のコストの目安）。
+稼働中のワーカーの件数と実際の検索レイテンシは管理画面の /admin/pipeline/ の 'shards' で見られる。
+
+使い方:
+    python manage.py list_shards
+    python manage.py list_shards --questions docs/rag-text.txt --limit 100
+"""
+import time
+from collections import Counter
+
+from chromadb import PersistentClient
+from django.core.management.base import BaseCommand, CommandError
+
+from common.ingest import ingest_embeddings, iter_collection
+from common.shards import BRAND_SHARD, store_of
+from common.timing import summarize_latencies
+from chat_ui.management.commands.bench_chat import load_questions
+
+
+class Command(BaseCommand):
+    help = 'Show document counts, type breakdown and search latency of the brand and per-store shards'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--questions', help='検索レイテンシを測る質問セット（省略時は測らない）')
+        parser.add_argument('--limit', type=int, default=100, help='使用する質問数（0で全件）')
+        parser.add_argument('--k', type=int, default=10, help='取得件数')
+
+    def handle(self, *args, **options):
+        client = PersistentClient(path="./wdb")
+        names = sorted(c.name for c in client.list_collections() if c.name == BRAND_SHARD or store_of(c.name))
+        if not names:
+            raise CommandError("シャードがありません（ingest / load_qa_data で取り込むと作られます）")
+
+        queries = []
+        if options['questions']:
+            questions = load_questions(options['questions'], options['limit'])
+            if not questions:
+                raise CommandError(f"質問が見つかりません: {options['questions']}")
+            # 取り込みと同じ埋め込みキャッシュを通すので、2回目以降はAPIを呼ばない
+            queries = ingest_embeddings().embed_documents(questions)
+
+        self.stdout.write(f"{'shard':<28}{'docs':>8}{'space':>8}{'p50ms':>9}{'p95ms':>9}  types")
+        for name in names:
+            collection = client.get_collection(name)
+            types = Counter(
+                (metadata or {}).get('type') or '-'
+                for page in iter_collection(collection, ['metadatas'])
+                for metadata in page['metadatas']
+            )
+            latency = self.measure(collection, queries, options['k']) if queries else None
+            space = (collection.metadata or {}).get('hnsw:space', 'l2')
+            p50 = f"{latency['p50']:.2f}" if latency else '-'
+            p95 = f"{latency['p95']:.2f}" if latency else '-'
+            breakdown = ', '.join(f"{doc_type}={count}" for doc_type, count in types.most_common())
+            self.stdout.write(f"{name:<28}{collection.count():>8}{space:>8}{p50:>9}{p95:>9}  {breakdown}")
+
+    @staticmethod
+    def measure(collection, queries, k: int):
+        if not collection.count():
+            return None
+        latencies = []
+        for query in queries:
+            start = time.perf_counter()
+            collection.query(query_embeddings=[query], n_results=min(k, collection.count()), include=['distances'])
+            latencies.append((time.perf_counter() - start) * 1000)
+        return summarize_latencies(latencies)
@@ -5,20 +5,30 @@ Django management command: RAG用データをベクトル化してChromaDBに保
 
 使い方:
     python manage.py load_qa_data docs/rag-text.txt --doc-title "フロントFAQ"
-    python manage.py load_qa_data docs/rag-text.txt --type qa --update-existing
+    python manage.py load_qa_data docs/rag-text.txt --type qa --dry-run
+    python manage.py load_qa_data docs/rag-text.txt --clear-db --concurrency 8 --batch-size 1000
+    python manage.py load_qa_data docs/shibuya_faq.txt --doc-title "渋谷店FAQ" --store shibuya
+
+IDは質問文から作るので、ブロックを挿入・並べ替えてもずれない。再実行すると
+ファイルとコレクションの差分（追加・更新・削除）だけを適用する。
+ファイルは1行ずつ読み、--batch-size 件ずつ埋め込み・書き込みに流す。
+--store を付けると、その店舗のシャード（common.shards）に取り込む（--clear-db もそのシャードだけを消す）。
+複数の形式のファイルをまとめて取り込む場合は ingest コマンドを使う。
 """
-import argparse
-import re
-import json
-from datetime import datetime
-from typing import List, Dict
-from django.core.management.base import BaseCommand
-from langchain_openai import OpenAIEmbeddings
-from langchain_chroma import Chroma
-from langchain.schema import Document
+from typing import Callable, Dict, Iterator, List
 from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from chromadb import PersistentClient
 
-SEP_PATTERN = re.compile(r"^\s*={3,}\s*$", re.MULTILINE)
+from common.dedupe import collapse_duplicates, find_duplicates
+from common.features import FeatureStore
+from common.ingest import IngestStats, ingest_embeddings
+from common.ivf import invalidate_index
+from common.multivector import QA_VECTOR_COLLECTION, QA_VECTOR_METADATA, iter_child_records
+from common.parsers import batched, iter_qa_records, qa_sync_record, read_lines
+from common.router import rebuild_centroids
+from common.shards import SHARD_METADATA, shard_name, store_records, validate_store
+from common.sync import sync_stream
 
 class Command(BaseCommand):
     help = 'Load QA data into ChromaDB from text file'
@@ -28,202 +38,169 @@ class Command(BaseCommand):
         parser.add_argument('--doc-title', default='フロントFAQ', help='Document title for metadata')
         parser.add_argument('--type', default='qa', help='Document type (qa, guideline, etc.)')
         parser.add_argument('--id-prefix', default='qa', help='ID prefix for documents')
-        parser.add_argument('--start-id', type=int, default=1, help='Starting ID number')
-        parser.add_argument('--update-existing', action='store_true', help='Update existing documents')
+        parser.add_argument('--dry-run', action='store_true', help='Show the sync plan without applying it')
         parser.add_argument('--clear-db', action='store_true', help='Clear existing database before loading')
+        parser.add_argument('--concurrency', type=int, default=4, help='Parallel embedding requests')
+        parser.add_argument('--batch-tokens', type=int, default=20000, help='Max tokens per embedding request')
+        parser.add_argument('--batch-size', type=int, default=500, help='Records read and synced per batch')
+        parser.add_argument('--no-dedupe', action='store_true', help='Keep near-duplicate QA records')
+        parser.add_argument('--store', help='Store code: load into that store\'s shard instead of the brand shard')
+        # 以前のオプション（差分同期になって不要になった。既存のスクリプトが失敗しないよう受け付けて無視する）
+        parser.add_argument('--update-existing', action='store_true',
+                            help='Deprecated, ignored: changed records are always updated')
+        parser.add_argument('--start-id', type=int, help='Deprecated, ignored: IDs are derived from the question')
 
     def handle(self, *args, **options):
         input_file = options['input_file']
         doc_title = options['doc_title']
         doc_type = options['type']
         id_prefix = options['id_prefix']
-        start_id = options['start_id']
-        update_existing = options['update_existing']
+        dry_run = options['dry_run']
         clear_db = options['clear_db']
+        try:
+            store = validate_store(options['store']) if options['store'] else None
+        except ValueError as e:
+            raise CommandError(str(e))
+        if options['update_existing']:
+            self.stdout.write(self.style.WARNING(
+                "--update-existing is deprecated and ignored: changed records are always updated"))
+        if options['start_id'] is not None:
+            self.stdout.write(self.style.WARNING(
+                "--start-id is deprecated and ignored: IDs are derived from the question text"))
 
         self.stdout.write(f"Loading data from: {input_file}")
         self.stdout.write(f"Document title: {doc_title}")
         self.stdout.write(f"Document type: {doc_type}")
+        if store:
+            self.stdout.write(f"Store shard: {shard_name(store)}")
 
         try:
-            # ファイル読み込み
-            with open(input_file, 'r', encoding='utf-8') as f:
-                text = f.read()
+            # QAデータを1件ずつ読み、batch_size 件ずつ同期する（重複検出のため何度か読み直す）
+            def read_records():
+                for record in iter_qa_records(read_lines(input_file), doc_title, doc_type, id_prefix):
+                    yield qa_sync_record(record)
 
-            # QAデータに変換
-            records = self.to_records(text, doc_title, doc_type, id_prefix, start_id)
-            self.stdout.write(f"Converted {len(records)} records")
-
-            # ChromaDBに保存
-            self.save_to_chromadb(records, update_existing, clear_db)
+            stats = self.save_to_chromadb(
+                read_records, doc_type, doc_title, clear_db, dry_run=dry_run,
+                concurrency=options['concurrency'], batch_tokens=options['batch_tokens'],
+                batch_size=options['batch_size'], dedupe=not options['no_dedupe'], store=store,
+            )
             
-            self.stdout.write(self.style.SUCCESS(f"Successfully loaded {len(records)} records into ChromaDB"))
+            if not dry_run:
+                self.stdout.write(self.style.SUCCESS(f"Successfully synced into ChromaDB: {stats.summary()}"))
 
         except FileNotFoundError:
             self.stdout.write(self.style.ERROR(f"File not found: {input_file}"))
         except Exception as e:
             self.stdout.write(self.style.ERROR(f"Error: {str(e)}"))
 
-    def split_blocks(self, text: str) -> List[str]:
-        """テキストを=====区切りでブロック分割"""
-        parts = re.split(SEP_PATTERN, text)
-        return [p.strip() for p in parts if p.strip()]
+    def to_records(self, text: str, doc_title: str, rec_type: str, id_prefix: str) -> List[Dict]:
+        """テキストをレコードのリストに変換（IDは質問文から作る）"""
+        return list(iter_qa_records(text.splitlines(), doc_title, rec_type, id_prefix))
 
-    def qa_from_block(self, block: str) -> tuple:
-        """ブロックから質問と回答を抽出"""
-        lines = block.replace("\r\n", "\n").replace("\r", "\n").split("\n")
-        
-        # 先頭・末尾の空行を除去
-        while lines and not lines[0].strip():
-            lines.pop(0)
-        while lines and not lines[-1].strip():
-            lines.pop()
-        
-        if not lines:
-            return None, None
-        
-        q = lines[0].strip()
-        a_lines = lines[1:]
-        
-        # 先頭に空行が1つ入っているケースに対応
-        while a_lines and not a_lines[0].strip():
-            a_lines.pop(0)
-        
-        a = "\n".join(a_lines).strip()
-        return q, a
-
-    def to_records(self, text: str, doc_title: str, rec_type: str, id_prefix: str, start: int) -> List[Dict]:
-        """テキストをレコードのリストに変換"""
-        blocks = self.split_blocks(text)
-        records = []
-        n = start
-        today = datetime.now().strftime("%Y-%m-%d")
-        
-        for block in blocks:
-            q, a = self.qa_from_block(block)
-            if not q and not a:
-                continue
-            
-            # 回答が空なら空文字として出力
-            a = a if a is not None else ""
-            
-            # 質問と回答を結合してコンテンツとする
-            if a:
-                content = f"質問: {q}\n\n回答: {a}"
-            else:
-                content = f"質問: {q}"
-            
-            rec = {
-                "id": f"{id_prefix}.{n:04d}",
-                "type": rec_type,
-                "doc_title": doc_title,
-                "question": q,
-                "answer": a,
-                "content": content,
-                "updated_at": today,
-                "source": f"{doc_title} - {id_prefix}.{n:04d}"
-            }
-            records.append(rec)
-            n += 1
-            
-        return records
-
-    def save_to_chromadb(self, records: List[Dict], update_existing: bool, clear_db: bool):
-        """ChromaDBにレコードを保存"""
-        # OpenAI embeddings初期化
-        embeddings = OpenAIEmbeddings(
-            api_key=settings.OPENAI_API_KEY,
-            model="text-embedding-3-small"
-        )
+    def save_to_chromadb(self, read_records: Callable[[], Iterator[Dict]], doc_type: str, doc_title: str,
+                         clear_db: bool, dry_run: bool = False, concurrency: int = 4, batch_tokens: int = 20000,
+                         batch_size: int = 500, dedupe: bool = True, store: str = None):
+        """ChromaDBとレコードを差分同期
+
+        同じ種別・ドキュメントタイトルの既存ドキュメントと比べて、追加・更新・削除だけを適用する。
+        ほぼ重複したQAは1件にまとめ、他の質問を別名として残す。
+        埋め込みはトークン数で区切ったバッチを並列に計算してベクトルごと upsert する。
+        store を渡すと店舗のシャードだけに同期する（特徴量・マルチベクトル・セントロイドは作らない）。
+        """
+        if store:
+            return self.save_to_store_shard(read_records, doc_type, doc_title, clear_db, store, dry_run=dry_run,
+                                            concurrency=concurrency, batch_tokens=batch_tokens,
+                                            batch_size=batch_size, dedupe=dedupe)
+        # 本文が変わっていないレコードは埋め込みキャッシュから返し、OpenAIには送らない
+        embeddings = ingest_embeddings()
         
         # ChromaDB初期化
-        db = Chroma(
-            collection_name='wdb',
-            persist_directory="./wdb",
-            embedding_function=embeddings
-        )
+        client = PersistentClient(path="./wdb")
+        # 派生特徴量のサイドカーストア（ドキュメントIDをキーに保存）
+        features = FeatureStore()
         
         # 既存データをクリア
-        if clear_db:
+        if clear_db and not dry_run:
             self.stdout.write("Clearing existing database...")
             try:
-                db.delete_collection()
-                db = Chroma(
-                    collection_name='wdb',
-                    persist_directory="./wdb",
-                    embedding_function=embeddings
-                )
+                client.delete_collection('wdb')
+                if QA_VECTOR_COLLECTION in [c.name for c in client.list_collections()]:
+                    client.delete_collection(QA_VECTOR_COLLECTION)
+                features.clear()
                 self.stdout.write("Database cleared")
             except Exception as e:
                 self.stdout.write(f"Warning: Could not clear database: {e}")
+        collection = client.get_or_create_collection('wdb')
+        qa_vectors = client.get_or_create_collection(QA_VECTOR_COLLECTION, metadata=QA_VECTOR_METADATA)
         
-        # ドキュメント作成
-        documents = []
-        metadatas = []
-        ids = []
-        
-        for record in records:
-            # 既存チェック（update_existingがFalseの場合）
-            if not update_existing:
-                try:
-                    existing = db.get(ids=[record['id']])
-                    if existing['ids']:
-                        self.stdout.write(f"Skipping existing document: {record['id']}")
-                        continue
-                except:
-                    pass  # 存在チェックでエラーが出ても継続
-            
-            documents.append(Document(
-                page_content=record['content'],
-                metadata={
-                    'id': record['id'],
-                    'type': record['type'],
-                    'doc_title': record['doc_title'],
-                    'question': record['question'],
-                    'answer': record['answer'],
-                    'updated_at': record['updated_at'],
-                    'source': record['source']
-                }
-            ))
-            metadatas.append({
-                'id': record['id'],
-                'type': record['type'],
-                'doc_title': record['doc_title'],
-                'question': record['question'],
-                'answer': record['answer'],
-                'updated_at': record['updated_at'],
-                'source': record['source']
-            })
-            ids.append(record['id'])
+        final_records = read_records
+        if dedupe:
+            # 候補ペアの埋め込み確認はドライランでは行わない（APIを呼ばない）
+            duplicates = find_duplicates(read_records, embeddings=None if dry_run else embeddings)
+            self.stdout.write(duplicates.summary())
+            final_records = lambda: collapse_duplicates(read_records(), duplicates)
         
-        if not documents:
-            self.stdout.write("No documents to add")
-            return
-        
-        # バッチでデータベースに追加
-        batch_size = 100
-        for i in range(0, len(documents), batch_size):
-            batch_docs = documents[i:i+batch_size]
-            batch_metadatas = metadatas[i:i+batch_size]
-            batch_ids = ids[i:i+batch_size]
-            
-            try:
-                # 既存の場合は削除してから追加（更新）
-                if update_existing:
-                    try:
-                        db.delete(ids=batch_ids)
-                    except:
-                        pass  # 削除エラーは無視
-                
-                db.add_documents(
-                    documents=batch_docs,
-                    ids=batch_ids
-                )
-                
-                self.stdout.write(f"Added batch {i//batch_size + 1}: {len(batch_docs)} documents")
-                
-            except Exception as e:
-                self.stdout.write(f"Error adding batch {i//batch_size + 1}: {e}")
-                continue
+        # 差分を適用（同じファイルから取り込んだ範囲だけを比べる）
+        scope = {'$and': [{'type': doc_type}, {'doc_title': doc_title}]}
+        ingest = IngestStats()
+        stats = sync_stream(
+            collection, batched(final_records(), batch_size), scope,
+            embeddings, features, dry_run=dry_run,
+            concurrency=concurrency, batch_tokens=batch_tokens, on_batch=ingest.add,
+        )
+        # 質問・回答を別ベクトルにしたインデックス（親のIDを parent_id に持つ）も同じ範囲で同期する
+        vector_stats = sync_stream(
+            qa_vectors, batched(iter_child_records(final_records()), batch_size), scope,
+            embeddings, None, dry_run=dry_run,
+            concurrency=concurrency, batch_tokens=batch_tokens, on_batch=ingest.add,
+        )
         
-        self.stdout.write(f"Successfully processed {len(documents)} documents")
\ No newline at end of file
+        if dry_run:
+            self.stdout.write(f"Sync plan: {stats.summary()}")
+            self.stdout.write(f"Question/answer vectors: {vector_stats.summary()}")
+            return stats
+        if stats.inserted or stats.updated or vector_stats.inserted or vector_stats.updated:
+            self.stdout.write(f"Embedded {ingest.summary()}")
+            self.stdout.write(embeddings.summary())
+        self.stdout.write(f"Synced: {stats.summary()}")
+        self.stdout.write(f"Question/answer vectors: {vector_stats.summary()}")
+        self.stdout.write(f"Rebuilt {rebuild_centroids(collection, features)} routing centroids")
+        if (clear_db or stats.changed) and invalidate_index(settings.IVF_INDEX_PATH):
+            self.stdout.write("Removed the IVF index (run build_ivf_index to rebuild it)")
+        return stats
+
+    def save_to_store_shard(self, read_records: Callable[[], Iterator[Dict]], doc_type: str, doc_title: str,
+                            clear_db: bool, store: str, dry_run: bool = False, concurrency: int = 4,
+                            batch_tokens: int = 20000, batch_size: int = 500, dedupe: bool = True):
+        """店舗のシャードとレコードを差分同期する（IDには店舗コードを付ける）"""
+        embeddings = ingest_embeddings()
+        client = PersistentClient(path="./wdb")
+        name = shard_name(store)
+        if clear_db and not dry_run:
+            self.stdout.write(f"Clearing {name}...")
+            if name in [c.name for c in client.list_collections()]:
+                client.delete_collection(name)
+        collection = client.get_or_create_collection(name, metadata=SHARD_METADATA)
+
+        final_records = read_records
+        if dedupe:
+            duplicates = find_duplicates(read_records, embeddings=None if dry_run else embeddings)
+            self.stdout.write(duplicates.summary())
+            final_records = lambda: collapse_duplicates(read_records(), duplicates)
+
+        scope = {'$and': [{'type': doc_type}, {'doc_title': doc_title}]}
+        ingest = IngestStats()
+        stats = sync_stream(
+            collection, batched(store_records(final_records(), store), batch_size), scope,
+            embeddings, None, dry_run=dry_run,
+            concurrency=concurrency, batch_tokens=batch_tokens, on_batch=ingest.add,
+        )
+        if dry_run:
+            self.stdout.write(f"Sync plan: {stats.summary()}")
+            return stats
+        if stats.inserted or stats.updated:
+            self.stdout.write(f"Embedded {ingest.summary()}")
+            self.stdout.write(embeddings.summary())
+        self.stdout.write(f"Synced {name}: {stats.summary()}")
+        return stats
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: /chat/api/chat/ に対するオープンループ負荷試験
+
+到着間隔を指数分布（ポアソン到着）で事前に決め、応答を待たずに予定時刻どおり
+リクエストを送る。レイテンシは「予定送信時刻」から計測するため、サーバーが
+詰まっている間の待ち時間（coordinated omission）も結果に含まれる。
+
+gunicorn_config.py を読み込んだ実際のgunicornを、OpenAIスタブに向けて
+ワーカー設定ごとに起動し、順に計測する。
+
+使い方:
+    python manage.py loadtest_chat --rates 1,2,4 --duration 30
+    python manage.py loadtest_chat --sweep sync:1:1,gthread:1:2,gthread:1:4,uvicorn:1:1
+    python manage.py loadtest_chat --url http://localhost:8000 --rates 2   # 起動済みサーバーを計測
+"""
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.stub_servers import FakeOpenAIServer, fake_openai_env
+from common.timing import summarize_latencies
+from chat_ui.management.commands.bench_chat import load_questions
+
+WORKER_CLASSES = {
+    'sync': ('sync', 'config.wsgi:application'),
+    'gthread': ('gthread', 'config.wsgi:application'),
+    'uvicorn': ('uvicorn.workers.UvicornWorker', 'config.asgi:application'),
+}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def poisson_schedule(rate: float, duration: float, seed: int = 0) -> List[float]:
+    """ポアソン到着の送信予定時刻（開始からの秒数）を返す"""
+    rng = random.Random(seed)
+    schedule = []
+    t = rng.expovariate(rate)
+    while t < duration:
+        schedule.append(t)
+        t += rng.expovariate(rate)
+    return schedule
+
+
+def parse_spec(spec: str):
+    """'worker_class:workers:threads' を分解する（省略部分は1）"""
+    worker_class, workers, threads = (spec.split(':') + ['1', '1'])[:3]
+    if worker_class not in WORKER_CLASSES:
+        raise CommandError(f"不明なworker_classです: {worker_class}")
+    return worker_class, workers, threads
+
+
+def start_gunicorn(spec: str, extra_env: Dict[str, str], log_path: str):
+    """gunicorn_config.py を使ってgunicornを起動し、(process, base_url) を返す"""
+    worker_class, workers, threads = parse_spec(spec)
+    klass, app = WORKER_CLASSES[worker_class]
+    port = free_port()
+    command = [
+        sys.executable, '-m', 'gunicorn', app,
+        '--config', str(settings.BASE_DIR / 'gunicorn_config.py'),
+        '--bind', f'127.0.0.1:{port}',
+        '--workers', workers, '--threads', threads, '--worker-class', klass,
+        '--access-logfile', '/dev/null',
+        # 計測中のワーカー再起動を避ける
+        '--max-requests', '0',
+    ]
+    log = open(log_path, 'w')
+    process = subprocess.Popen(command, env=dict(os.environ, **extra_env), cwd=str(settings.BASE_DIR),
+                               stdout=log, stderr=log)
+    log.close()
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_ready(base_url, process)
+    except CommandError:
+        stop_gunicorn(process)
+        raise
+    return process, base_url
+
+
+def wait_ready(base_url: str, process, timeout: float = 120):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise CommandError("gunicornが起動直後に終了しました。ログを確認してください")
+        try:
+            if requests.get(f"{base_url}/health/", timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    raise CommandError("gunicornの起動待ちがタイムアウトしました")
+
+
+def stop_gunicorn(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+class Command(BaseCommand):
+    help = 'Open-loop HTTP load test for /chat/api/chat/ across gunicorn worker settings'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='計測対象のベースURL（指定時はgunicornを起動しない）')
+        parser.add_argument('--sweep', default='sync:1:1,gthread:1:2,gthread:1:4,uvicorn:1:1',
+                            help='ワーカー設定の一覧（worker_class:workers:threads）')
+        parser.add_argument('--service', choices=['full', 'lite'], default='lite',
+                            help='起動するサーバーのAIサービス（USE_LITE_AI_SERVICE）')
+        parser.add_argument('--rates', default='1,2,4', help='目標リクエストレート（req/s、カンマ区切り）')
+        parser.add_argument('--duration', type=float, default=30, help='各レートの送信時間（秒）')
+        parser.add_argument('--timeout', type=float, default=130, help='1リクエストのタイムアウト（秒）')
+        parser.add_argument('--max-in-flight', type=int, default=256, help='クライアント側の同時送信上限')
+        parser.add_argument('--questions', default='docs/rag-text.txt', help='送信する質問セット')
+        parser.add_argument('--chat-latency-ms', type=float, default=400, help='OpenAIスタブのchatレイテンシ')
+        parser.add_argument('--embedding-latency-ms', type=float, default=50, help='OpenAIスタブの埋め込みレイテンシ')
+        parser.add_argument('--seed', type=int, default=0, help='到着間隔の乱数シード')
+        parser.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    def handle(self, *args, **options):
+        questions = load_questions(options['questions'])
+        if not questions:
+            raise CommandError(f"質問が見つかりません: {options['questions']}")
+        rates = [float(r) for r in options['rates'].split(',') if r.strip()]
+
+        results = []
+        if options['url']:
+            for rate in rates:
+                results.append(self.run_rate(options['url'], rate, questions, options, label='external'))
+        else:
+            openai_stub = FakeOpenAIServer(
+                chat_latency_ms=options['chat_latency_ms'],
+                embedding_latency_ms=options['embedding_latency_ms'],
+            ).start()
+            self.stdout.write(f"OpenAI stand-in: {openai_stub.url}")
+            try:
+                for spec in options['sweep'].split(','):
+                    results.extend(self.run_spec(spec.strip(), rates, questions, options, openai_stub))
+            finally:
+                openai_stub.stop()
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump({'duration': options['duration'], 'results': results}, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def run_spec(self, spec: str, rates: List[float], questions: List[str], options, openai_stub) -> List[Dict]:
+        """1つのワーカー設定でgunicornを起動し、全レートを計測する"""
+        worker_class, workers, threads = parse_spec(spec)
+        if worker_class == 'sync' and int(threads) > 1:
+            # gunicornはsyncでthreads>1を指定するとgthreadに切り替える（Procfileの設定がこれに当たる）
+            self.stdout.write(self.style.WARNING(f"{spec}: sync with threads>1 runs as gthread"))
+        env = fake_openai_env(openai_stub)
+        env['USE_LITE_AI_SERVICE'] = 'true' if options['service'] == 'lite' else 'false'
+        log_path = f"loadtest_gunicorn_{worker_class}_{workers}_{threads}.log"
+        self.stdout.write(f"Starting gunicorn ({spec}), log: {log_path}")
+        process, base_url = start_gunicorn(spec, env, log_path)
+        try:
+            return [self.run_rate(base_url, rate, questions, options, label=spec) for rate in rates]
+        finally:
+            stop_gunicorn(process)
+
+    def run_rate(self, base_url: str, rate: float, questions: List[str], options, label: str) -> Dict:
+        """目標レートでオープンループ送信し、結果を集計する"""
+        schedule = poisson_schedule(rate, options['duration'], options['seed'])
+        url = f"{base_url}/chat/api/chat/"
+        local = threading.local()
+        samples: List[Dict] = []
+        samples_lock = threading.Lock()
+
+        def send(intended: float, question: str):
+            session = getattr(local, 'session', None)
+            if session is None:
+                session = local.session = requests.Session()
+            sent = time.perf_counter()
+            sample = {'intended': intended, 'sent': sent, 'ok': False, 'server_ms': None}
+            try:
+                response = session.post(url, json={'question': question}, timeout=options['timeout'])
+                sample['ok'] = response.status_code == 200
+                if sample['ok']:
+                    info = response.json().get('process_info') or {}
+                    sample['server_ms'] = (info.get('timings') or {}).get('total')
+            except requests.RequestException:
+                pass
+            sample['done'] = time.perf_counter()
+            with samples_lock:
+                samples.append(sample)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['max_in_flight']) as executor:
+            for i, offset in enumerate(schedule):
+                intended = start + offset
+                delay = intended - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                executor.submit(send, intended, questions[i % len(questions)])
+        elapsed = time.perf_counter() - start
+
+        result = self.summarize(samples, rate, elapsed, label)
+        self.print_result(result)
+        return result
+
+    def summarize(self, samples: List[Dict], rate: float, elapsed: float, label: str) -> Dict:
+        ok = [s for s in samples if s['ok']]
+        # 予定時刻基準のレイテンシ（待ち行列を含む）
+        latencies = [(s['done'] - s['intended']) * 1000 for s in ok]
+        # クライアント側の送信遅れ（送信スレッド不足の検出用）
+        send_lag = [(s['sent'] - s['intended']) * 1000 for s in samples]
+        # サーバー処理時間が取れた場合、それ以外の時間を待ち行列遅延とみなす
+        queueing = [
+            (s['done'] - s['intended']) * 1000 - s['server_ms']
+            for s in ok if s['server_ms'] is not None
+        ]
+        return {
+            'server': label,
+            'target_rps': rate,
+            'sent': len(samples),
+            'completed': len(ok),
+            'error_rate': round(1 - len(ok) / len(samples), 4) if samples else None,
+            'throughput_rps': round(len(ok) / elapsed, 3) if elapsed else None,
+            'latency_ms': summarize_latencies(latencies),
+            'queueing_delay_ms': summarize_latencies(queueing),
+            'client_send_lag_ms': summarize_latencies(send_lag),
+        }
+
+    def print_result(self, result: Dict):
+        lat = result['latency_ms']
+        queue: Optional[Dict] = result['queueing_delay_ms']
+        self.stdout.write(
+            f"[{result['server']} @ {result['target_rps']} req/s] "
+            f"throughput {result['throughput_rps']} req/s, errors {result['error_rate']}, "
+            f"p50 {lat['p50']}ms p95 {lat['p95']}ms p99 {lat['p99']}ms, "
+            f"queueing p50 {queue['p50']}ms p99 {queue['p99']}ms"
+        )
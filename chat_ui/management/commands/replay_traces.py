@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: 記録済みトレースを別のパイプライン設定で再実行して比較する
+
+chat_trace.jsonl（ローテーション済みファイルを含む）の質問を再実行し、
+元の実行とのレイテンシ差と、選ばれたドキュメントの違いを集計する。
+
+使い方:
+    python manage.py replay_traces --limit 200
+    python manage.py replay_traces --no-rerank --k 5 --output replay.json
+    python manage.py replay_traces --trace-file traces/chat_trace.jsonl --providers recorded
+"""
+import json
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand, CommandError
+
+from common import tracing
+from common.stubs import Recording
+from common.timing import summarize_latencies
+from chat_ui.management.commands.bench_chat import build_service
+
+
+def jaccard(a: List, b: List) -> float:
+    sa, sb = set(a), set(b)
+    if not sa and not sb:
+        return 1.0
+    return len(sa & sb) / len(sa | sb)
+
+
+class Command(BaseCommand):
+    help = 'Replay recorded chat traces against a different pipeline configuration and diff the results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--trace-file', default=None, help='トレースファイル（既定: settings.TRACE_PATH）')
+        parser.add_argument('--limit', type=int, default=0, help='再実行する件数（0で全件）')
+        parser.add_argument('--providers', choices=['stub', 'recorded', 'live'], default='live')
+        parser.add_argument('--recording', default='bench_recording.json', help='recordedモードの記録ファイル')
+        parser.add_argument('--questions', default='docs/rag-text.txt', help='stubモードのコーパス')
+        parser.add_argument('--no-rewrite', action='store_true', help='質問リライトを無効化')
+        parser.add_argument('--no-rerank', action='store_true', help='再ランクを無効化')
+        parser.add_argument('--k', type=int, default=None, help='一次検索の取得件数')
+        parser.add_argument('--top-n', type=int, default=None, help='再ランク後に残す件数')
+        parser.add_argument('--context-size', type=int, default=None, help='回答生成に渡す件数')
+        parser.add_argument('--output', help='トレースごとの差分を書き出すJSONファイル')
+
+    def handle(self, *args, **options):
+        path = options['trace_file'] or tracing.trace_path()
+        traces = [t for t in tracing.read_traces(path) if t.get('question')]
+        if options['limit']:
+            traces = traces[-options['limit']:]
+        if not traces:
+            raise CommandError(f"トレースが見つかりません: {path}")
+
+        recording = Recording(options['recording']) if options['providers'] == 'recorded' else None
+        service = build_service('full', dict(options, llm_latency_ms=0, embed_latency_ms=0,
+                                             rerank_latency_ms=0, real_reranker=True), recording)
+        service.use_rewrite = not options['no_rewrite']
+        service.use_rerank = not options['no_rerank']
+        if options['k']:
+            service.retrieval_k = options['k']
+        if options['top_n']:
+            service.rerank_top_n = options['top_n']
+        if options['context_size']:
+            service.context_size = options['context_size']
+        self.stdout.write(
+            f"Replaying {len(traces)} traces (rewrite={service.use_rewrite}, rerank={service.use_rerank}, "
+            f"k={service.retrieval_k}, top_n={service.rerank_top_n}, context={service.context_size})"
+        )
+
+        diffs = []
+        for i, old in enumerate(traces, start=1):
+            _, new = service.run_traced(old['question'], store=old.get('store'))
+            diffs.append(self.diff(old, new))
+            if i % 50 == 0:
+                self.stdout.write(f"  {i}/{len(traces)}")
+
+        if recording is not None:
+            recording.save()
+        self.print_summary(diffs)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(diffs, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def diff(self, old: Dict, new: Dict) -> Dict:
+        old_timings = old.get('timings') or {}
+        new_timings = new.get('timings') or {}
+        old_docs = [d.get('id') for d in old.get('documents') or []]
+        new_docs = [d.get('id') for d in new.get('documents') or []]
+        old_context = old.get('context_ids') or []
+        new_context = new.get('context_ids') or []
+        return {
+            'question': old['question'],
+            'old_total_ms': old_timings.get('total'),
+            'new_total_ms': new_timings.get('total'),
+            'stage_delta_ms': {
+                stage: round(new_timings.get(stage, 0) - old_timings.get(stage, 0), 2)
+                for stage in set(old_timings) | set(new_timings) if stage != 'total'
+            },
+            'top1_same': bool(old_docs[:1]) and old_docs[:1] == new_docs[:1],
+            'context_same': old_context == new_context,
+            'documents_jaccard': round(jaccard(old_docs, new_docs), 3),
+            'old_context_ids': old_context,
+            'new_context_ids': new_context,
+            'old_confidence': old.get('confidence_reason'),
+            'new_confidence': new.get('confidence_reason'),
+            'adaptive_action': (new.get('adaptive') or {}).get('action'),
+        }
+
+    def print_summary(self, diffs: List[Dict]):
+        old_totals = [d['old_total_ms'] for d in diffs if d['old_total_ms'] is not None]
+        new_totals = [d['new_total_ms'] for d in diffs if d['new_total_ms'] is not None]
+        old_summary, new_summary = summarize_latencies(old_totals), summarize_latencies(new_totals)
+        self.stdout.write("Latency (recorded → replay):")
+        for key in ('p50', 'p95', 'p99', 'mean'):
+            self.stdout.write(f"  {key:<5} {old_summary[key]}ms → {new_summary[key]}ms")
+
+        stages: Dict[str, List[float]] = {}
+        for d in diffs:
+            for stage, delta in d['stage_delta_ms'].items():
+                stages.setdefault(stage, []).append(delta)
+        for stage, deltas in sorted(stages.items()):
+            self.stdout.write(f"  {stage:<12} mean delta {sum(deltas) / len(deltas):+.1f}ms")
+
+        total = len(diffs)
+        self.stdout.write(
+            f"Selected documents: top-1 unchanged {sum(d['top1_same'] for d in diffs)}/{total}, "
+            f"context unchanged {sum(d['context_same'] for d in diffs)}/{total}, "
+            f"mean Jaccard {sum(d['documents_jaccard'] for d in diffs) / total:.3f}, "
+            f"confidence changed {sum(d['old_confidence'] != d['new_confidence'] for d in diffs)}"
+        )
+
+        # 適応制御の判断ごとのレイテンシと1位の一致（省いた・絞った分の効果を見る）
+        actions: Dict[str, List[Dict]] = {}
+        for d in diffs:
+            if d['adaptive_action']:
+                actions.setdefault(d['adaptive_action'], []).append(d)
+        for action, group in sorted(actions.items()):
+            totals = [d['new_total_ms'] for d in group if d['new_total_ms'] is not None]
+            rerank = [d['stage_delta_ms'].get('rerank', 0) for d in group]
+            self.stdout.write(
+                f"  {action:<14} {len(group)} traces, p50 {summarize_latencies(totals)['p50']}ms, "
+                f"rerank mean delta {sum(rerank) / len(rerank):+.1f}ms, "
+                f"top-1 unchanged {sum(d['top1_same'] for d in group)}/{len(group)}"
+            )
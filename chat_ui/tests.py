@@ -1,3 +1,158 @@
-from django.test import TestCase
+import os
+import sys
+import tempfile
+import threading
+import time
+import types
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+from langchain_core.messages import AIMessage
+
+from common.ai_service import AIService
+from common.ai_service_lite import AIServiceLite
+from common.stubs import FakeChatModel, FakeCrossEncoder, FakeEmbeddings, build_stub_store, install_providers
+
+THREADS = 16
+REQUESTS = 200
+
+
+def make_records(count=30):
+    records = []
+    for i in range(count):
+        question = f"商品{i}の送料はいくらですか"
+        answer = f"商品{i}の送料は{i * 10}円です。"
+        records.append({
+            'id': f"qa-{i}", 'type': 'qa', 'doc_title': question, 'question': question,
+            'answer': answer, 'source': 'rag-text.txt', 'content': f"{question}\n{answer}",
+        })
+    return records
+
+
+class QuestionEcho(FakeChatModel):
+    """プロンプト中の「質問」行をそのまま返すスタブLLM（他スレッドの回答の混入を検出する）"""
+
+    def invoke(self, prompt, *args, **kwargs):
+        super().invoke(prompt)
+        lines = [line for line in str(prompt).splitlines() if line.startswith('質問')]
+        return AIMessage(content=lines[-1] if lines else '')
+
+
+class ConcurrencyProbe(FakeCrossEncoder):
+    """predictの同時実行数の最大値を記録するスタブ"""
+
+    def __init__(self, latency_ms_per_pair=0.2):
+        super().__init__(latency_ms_per_pair)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+
+    def predict(self, pairs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            return super().predict(pairs)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+
+@override_settings(TRACE_ENABLED=False, PROFILING_ENABLED=False, MEMORY_BUDGET_MB=0,
+                   AI_RERANK_CONCURRENCY=1, AI_LLM_CONCURRENCY=4)
+class AIServiceConcurrencyTests(SimpleTestCase):
+    """gthreadワーカーを想定し、1インスタンスを多数のスレッドから同時に使うストレステスト"""
+
+    def setUp(self):
+        # 特徴量ストア・埋め込みキャッシュ・IVFは一時ディレクトリに向け、./wdb には触れない
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        overrides = override_settings(
+            FEATURE_STORE_PATH=os.path.join(tmp.name, 'features.sqlite3'),
+            EMBEDDING_CACHE_PATH=os.path.join(tmp.name, 'embeddings.sqlite3'),
+            IVF_INDEX_PATH=os.path.join(tmp.name, 'ivf.npz'),
+            ADAPTIVE_RETRIEVAL_PATH=os.path.join(tmp.name, 'adaptive.json'),
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # Chromaのクライアントもスタブにする（ストアは install_providers で差し替える）
+        client = mock.MagicMock()
+        client.list_collections.return_value = []
+        patchers = [
+            mock.patch('chromadb.PersistentClient', return_value=client),
+            mock.patch('common.ai_service.Chroma'),
+            mock.patch('common.ai_service_lite.Chroma'),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def build(self, service_class, cross_encoder=None):
+        service = service_class()
+        embeddings = FakeEmbeddings()
+        install_providers(
+            service,
+            llm_rewrite=FakeChatModel(latency_ms=1, seed=1),
+            llm_answer=QuestionEcho(latency_ms=2, seed=2),
+            embeddings=embeddings,
+            store=build_stub_store(make_records(), embeddings),
+            cross_encoder=cross_encoder,
+        )
+        return service
+
+    def run_threads(self, fn, items):
+        with ThreadPoolExecutor(max_workers=THREADS) as pool:
+            return list(pool.map(fn, items))
+
+    def test_cross_encoder_is_loaded_once(self):
+        service = self.build(AIService)
+        loads = []
+
+        def slow_load(*args, **kwargs):
+            loads.append(1)
+            time.sleep(0.05)
+            return FakeCrossEncoder()
+
+        # sentence_transformers が入っていない環境でも動くよう、モジュールごと差し替える
+        stub_module = types.ModuleType('sentence_transformers')
+        stub_module.CrossEncoder = slow_load
+        with mock.patch.dict(sys.modules, {'sentence_transformers': stub_module}):
+            encoders = self.run_threads(lambda _: service.cross_encoder, range(THREADS))
+
+        self.assertEqual(len(loads), 1)
+        self.assertTrue(all(encoder is encoders[0] for encoder in encoders))
+
+    def test_chat_under_concurrency(self):
+        probe = ConcurrencyProbe()
+        service = self.build(AIService, cross_encoder=probe)
+        questions = [f"商品{i % 30}の送料を教えて（{i}）" for i in range(REQUESTS)]
+
+        results = self.run_threads(service.chat, questions)
+
+        for question, result in zip(questions, results):
+            self.assertIn(question, result['answer'])
+            self.assertNotIn('system_error', result['process_info'])
+        self.assertLessEqual(probe.max_active, 1)
+
+    def test_rerank_does_not_mutate_search_results(self):
+        service = self.build(AIService, cross_encoder=FakeCrossEncoder())
+        documents = service.vector_search("商品1の送料", doc_type='qa', k=10)
+        snapshot = [dict(doc) for doc in documents]
+
+        reranked = self.run_threads(
+            lambda query: service.rerank_documents(query, documents, top_n=5),
+            [f"商品{i}の送料" for i in range(REQUESTS)],
+        )
+
+        self.assertEqual(documents, snapshot)
+        self.assertEqual(len({id(doc) for docs in reranked for doc in docs}), sum(len(docs) for docs in reranked))
+
+    def test_lite_chat_under_concurrency(self):
+        service = self.build(AIServiceLite)
+        questions = [f"商品{i % 30}の送料を教えて（{i}）" for i in range(REQUESTS)]
+
+        answers = self.run_threads(service.chat, questions)
+
+        for question, answer in zip(questions, answers):
+            self.assertIn(question, answer)
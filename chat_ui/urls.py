@@ -6,4 +6,8 @@ app_name = 'chat_ui'
 urlpatterns = [
     path('', views.chat_view, name='chat'),
     path('api/chat/', views.chat_api, name='chat_api'),
+    path('admin/profiles/', views.profiles_view, name='profiles'),
+    path('admin/memory/', views.memory_view, name='memory'),
+    path('admin/pipeline/', views.pipeline_stats_view, name='pipeline_stats'),
+    path('admin/profiles/<str:name>', views.profile_file_view, name='profile_file'),
 ]
\ No newline at end of file
@@ -1,16 +1,43 @@
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.http import Http404, HttpResponse, JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 from django.conf import settings
+import io
 import json
+import os
+import pstats
+import re
+import threading
+
+from common import memory, profiling
 
 # Use lightweight AI service on memory-constrained environments
+# （どちらも最初のリクエストで作る。import しただけでは ./wdb を開かない）
 if getattr(settings, 'USE_LITE_AI_SERVICE', False):
     from common.ai_service_lite import AIServiceLite
-    ai_service = AIServiceLite()
+    _lite_service = None
+    _lite_service_lock = threading.Lock()
+
+    def get_ai_service():
+        global _lite_service
+        if _lite_service is None:
+            with _lite_service_lock:
+                if _lite_service is None:
+                    _lite_service = AIServiceLite()
+        return _lite_service
 else:
-    from common.ai_service import ai_service
+    from common.ai_service import get_ai_service
+
+def int_param(request, name: str, default: int, maximum: int = 1000) -> int:
+    """クエリパラメータの整数（数値でない・範囲外なら既定値・上限に丸める）"""
+    try:
+        value = int(request.GET.get(name, default))
+    except (TypeError, ValueError):
+        return default
+    return min(max(value, 1), maximum)
+
 
 def chat_view(request):
     """チャット画面のビュー"""
@@ -28,7 +55,7 @@ def chat_api(request):
             return JsonResponse({'error': '質問が入力されていません'}, status=400)
         
         # AIサービスを使用して回答を生成
-        result = ai_service.chat(question)
+        result = get_ai_service().chat(question)
         
         if isinstance(result, dict):
             return JsonResponse({
@@ -42,4 +69,51 @@ def chat_api(request):
     except json.JSONDecodeError:
         return JsonResponse({'error': '無効なリクエストです'}, status=400)
     except Exception as e:
-        return JsonResponse({'error': f'エラーが発生しました: {str(e)}'}, status=500)
\ No newline at end of file
+        return JsonResponse({'error': f'エラーが発生しました: {str(e)}'}, status=500)
+
+
+@staff_member_required
+def profiles_view(request):
+    """遅いリクエストのプロファイル一覧（管理者のみ）"""
+    return render(request, 'chat_ui/profiles.html', {
+        'profiles': profiling.recent_profiles(limit=int_param(request, 'limit', 20)),
+        'enabled': profiling.is_enabled(),
+        'mode': getattr(settings, 'PROFILING_MODE', 'sampling'),
+        'sample_rate': getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0),
+    })
+
+
+@staff_member_required
+def profile_file_view(request, name):
+    """プロファイル本体を表示（pstatsは累積時間順のテキストに変換）"""
+    if not re.fullmatch(r'[\w.-]+\.(prof|collapsed)', name):
+        raise Http404
+    path = os.path.join(profiling.profile_dir(), name)
+    if not os.path.exists(path):
+        raise Http404
+    if name.endswith('.prof'):
+        if request.GET.get('download'):
+            with open(path, 'rb') as f:
+                response = HttpResponse(f.read(), content_type='application/octet-stream')
+            response['Content-Disposition'] = f'attachment; filename="{name}"'
+            return response
+        stream = io.StringIO()
+        pstats.Stats(path, stream=stream).sort_stats('cumulative').print_stats(50)
+        return HttpResponse(stream.getvalue(), content_type='text/plain; charset=utf-8')
+    with open(path, 'r', encoding='utf-8') as f:
+        return HttpResponse(f.read(), content_type='text/plain; charset=utf-8')
+
+
+@staff_member_required
+def memory_view(request):
+    """ワーカーのメモリ内訳（RSS・登録コンポーネント・tracemalloc集計）をJSONで返す（管理者のみ）"""
+    return JsonResponse(memory.report(top=int_param(request, 'top', 10)),
+                        json_dumps_params={'ensure_ascii': False})
+
+
+@staff_member_required
+def pipeline_stats_view(request):
+    """サーキットブレーカー・LLMヘッジ・回答キャッシュ・シャードごとの件数とレイテンシをJSONで返す（管理者のみ）"""
+    service = get_ai_service()
+    stats = service.pipeline_stats() if hasattr(service, 'pipeline_stats') else {}
+    return JsonResponse(stats, json_dumps_params={'ensure_ascii': False})
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+一次検索のスコア分布から、後段（再ランク・ガイドライン補完）の深さを決める適応制御
+
+一次検索の上位が他を大きく引き離している質問では、10件の再ランクもガイドライン補完も結果を変えない。
+スコアの 差（1位 - 2位）と エントロピー（スコアをsoftmaxにした分布の正規化エントロピー）から、
+リクエストごとに次のいずれかを選ぶ。
+
+    skip_rerank:   1位が明確（スコア・差とも閾値以上）。再ランクもガイドライン補完も省く
+    shrink_rerank: 上位数件に分布が集中している（エントロピーが閾値以下）。上位 shrink_n 件だけ再ランクする
+    full_rerank:   従来どおり全件を再ランクする
+
+閾値は検索方式（search_type）ごとに、calibrate_retrieval コマンドがオフラインで
+「全件再ランクと1位が変わらない割合」を保つ範囲で求めて JSON に書き出す。
+ファイルが無ければ settings の既定値を使う。
+"""
+import json
+import math
+import os
+from typing import Dict, List, Optional, Sequence
+
+ACTIONS = ('skip_rerank', 'shrink_rerank', 'full_rerank')
+
+
+def score_signals(scores: Sequence[float], temperature: float = 0.05) -> Dict[str, float]:
+    """スコア列（降順）の 1位・差・正規化エントロピー（0: 1件に集中 〜 1: 一様）"""
+    if not scores:
+        return {'top_score': 0.0, 'margin': 0.0, 'entropy': 1.0}
+    top = scores[0]
+    margin = top - scores[1] if len(scores) > 1 else top
+    if len(scores) == 1:
+        return {'top_score': top, 'margin': margin, 'entropy': 0.0}
+    weights = [math.exp((score - top) / temperature) for score in scores]
+    total = sum(weights)
+    entropy = -sum(w / total * math.log(w / total) for w in weights if w > 0)
+    return {'top_score': top, 'margin': margin, 'entropy': entropy / math.log(len(scores))}
+
+
+class AdaptiveThresholds:
+    """1つの検索方式の閾値"""
+
+    def __init__(self, skip_score: float = 0.65, skip_margin: float = 0.05, shrink_entropy: float = 0.5,
+                 shrink_n: int = 3, temperature: float = 0.05):
+        self.skip_score = skip_score
+        self.skip_margin = skip_margin
+        self.shrink_entropy = shrink_entropy
+        self.shrink_n = shrink_n
+        self.temperature = temperature
+
+    def to_dict(self) -> Dict:
+        return {
+            'skip_score': self.skip_score,
+            'skip_margin': self.skip_margin,
+            'shrink_entropy': self.shrink_entropy,
+            'shrink_n': self.shrink_n,
+            'temperature': self.temperature,
+        }
+
+
+class RetrievalDecision:
+    """1リクエストの判断（process_info['adaptive'] に載せる）"""
+
+    def __init__(self, action: str, rerank_n: int, skip_fallback: bool, signals: Dict[str, float]):
+        self.action = action
+        self.rerank_n = rerank_n
+        self.skip_fallback = skip_fallback
+        self.signals = signals
+
+    def as_dict(self) -> Dict:
+        return {
+            'action': self.action,
+            'rerank_n': self.rerank_n,
+            'skip_fallback': self.skip_fallback,
+            **{key: round(value, 4) for key, value in self.signals.items()},
+        }
+
+
+class AdaptiveController:
+    """検索方式ごとの閾値で一次検索の結果を判定する"""
+
+    def __init__(self, default: Optional[AdaptiveThresholds] = None,
+                 by_search_type: Optional[Dict[str, AdaptiveThresholds]] = None):
+        self.default = default or AdaptiveThresholds()
+        self.by_search_type = by_search_type or {}
+
+    @classmethod
+    def load(cls, path: str, default: Optional[AdaptiveThresholds] = None) -> 'AdaptiveController':
+        """calibrate_retrieval が書き出した JSON から作る（無い・壊れている場合は既定値だけ）"""
+        controller = cls(default)
+        if not path or not os.path.exists(path):
+            return controller
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            controller.by_search_type = {
+                search_type: AdaptiveThresholds(**values)
+                for search_type, values in data.get('thresholds', {}).items()
+            }
+        except (OSError, ValueError, TypeError) as e:
+            print(f"Warning: adaptive retrieval thresholds unavailable: {e}")
+        return controller
+
+    def thresholds(self, search_type: str) -> AdaptiveThresholds:
+        return self.by_search_type.get(search_type, self.default)
+
+    def decide(self, documents: List[Dict], search_type: str) -> RetrievalDecision:
+        thresholds = self.thresholds(search_type)
+        scores = sorted((doc.get('score', 0) for doc in documents), reverse=True)
+        signals = score_signals(scores, thresholds.temperature)
+        if (documents and signals['top_score'] >= thresholds.skip_score
+                and signals['margin'] >= thresholds.skip_margin):
+            return RetrievalDecision('skip_rerank', 0, True, signals)
+        if len(documents) > thresholds.shrink_n and signals['entropy'] <= thresholds.shrink_entropy:
+            return RetrievalDecision('shrink_rerank', thresholds.shrink_n, False, signals)
+        return RetrievalDecision('full_rerank', len(documents), False, signals)
@@ -4,9 +4,37 @@ from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_chroma import Chroma
 from django.conf import settings
 from typing import List, Dict, Optional
-import re
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from common import memory, profiling, tracing
+from common.answer_cache import AnswerCache
+from common.adaptive import AdaptiveController, AdaptiveThresholds
+from common.circuit import CircuitBreaker, CircuitOpen
+from common.context_packer import SEPARATOR, pack_context
+from common.facts import FactIndex, extract_numeric_facts, facts_contradict
+from common.features import FeatureStore
+from common.hedging import HedgedCaller
+from common.ivf import IVFIndex, collection_digest
+from common.lexical import LexicalIndex, normalize_text
+from common.multivector import QA_VECTOR_COLLECTION, max_per_parent
+from common.router import IntentRouter, RouteDecision
+from common.shards import BRAND_SHARD, ShardStats, StoreShards, distance_from_cosine, shard_name, validate_store
+from common.timing import Deadline, StageTimeout, StageTimer, call_with_timeout
+from common.tokens import count_tokens
 
 class AIService:
+    """RAGチャットサービス
+
+    gthreadワーカーで1インスタンスを複数スレッドから共有する前提:
+    - LLM / 埋め込み / Chroma のクライアントはスレッドセーフなので共有し、同時呼び出し数だけ制限する
+    - 遅延初期化（Cross-Encoder）はロックで1回だけ行う
+    - 検索結果の辞書はリクエストごとに新しく作り、共有オブジェクトを書き換えない
+    """
+
     def __init__(self):
         # OpenAI Embeddings（日本語対応）
         self.embeddings_model = OpenAIEmbeddings(
@@ -20,7 +48,9 @@ class AIService:
             api_key=settings.OPENAI_API_KEY,
             model="gpt-4o-mini",
             temperature=0,
-            max_tokens=100
+            max_tokens=100,
+            # リトライは締め切りを見ながら HedgedCaller が行う
+            max_retries=0
         )
 
         # LLM設定（最終回答生成用：中型）
@@ -28,7 +58,8 @@ class AIService:
             api_key=settings.OPENAI_API_KEY,
             model="gpt-4o-mini",
             temperature=0,
-            max_tokens=500
+            max_tokens=500,
+            max_retries=0
         )
 
         # ChromaDB（ベクトルデータベース）
@@ -61,8 +92,97 @@ class AIService:
                 embedding_function=self.embeddings_model
             )
 
+        # QAの質問・回答を別ベクトルにしたインデックス（取り込み済みの場合だけ使う）
+        # 一次検索の精度が上がるので k を絞る
+        self.use_multi_vector = getattr(settings, 'MULTI_VECTOR_ENABLED', True)
+        self.multi_vector_k = getattr(settings, 'MULTI_VECTOR_K', 5)
+        self.qa_vectors = self._open_qa_vectors()
+
+        # クラスタ分割（IVF）インデックス（build_ivf_index で作った場合だけ、'wdb' の検索をプロセス内で行う）
+        self.ivf_n_probe = getattr(settings, 'IVF_N_PROBE', 8)
+        self.ivf = self._load_ivf() if getattr(settings, 'IVF_ENABLED', False) else None
+
+        # 店舗ごとのシャード（取り込みの --store で作る）。質問したユーザーの店舗のシャードだけを追加で検索する
+        self.use_store_shards = getattr(settings, 'STORE_SHARDS_ENABLED', True)
+        self.shards = self._open_shards() if self.use_store_shards else None
+        self.shard_stats = ShardStats()
+
+        # 一次検索のスコア分布で再ランク・ガイドライン補完を省く/絞る適応制御
+        # （検索方式ごとの閾値は calibrate_retrieval で求めたファイル、無ければ settings の既定値）
+        self.use_adaptive = getattr(settings, 'ADAPTIVE_RETRIEVAL_ENABLED', True)
+        self.adaptive = AdaptiveController.load(
+            getattr(settings, 'ADAPTIVE_RETRIEVAL_PATH', ''),
+            AdaptiveThresholds(
+                skip_score=getattr(settings, 'RERANK_SKIP_SCORE', 0.65),
+                skip_margin=getattr(settings, 'RERANK_SKIP_MARGIN', 0.05),
+                shrink_entropy=getattr(settings, 'RERANK_SHRINK_ENTROPY', 0.5),
+                shrink_n=getattr(settings, 'RERANK_SHRINK_N', 3),
+            ),
+        )
+
         # Cross-Encoderモデル（遅延初期化）
         self._cross_encoder = None
+        # メモリ予算超過で退避された場合は再読み込みしない
+        self._cross_encoder_disabled = False
+        self._cross_encoder_lock = threading.Lock()
+
+        # 推論の同時実行数（Cross-EncoderはCPUを使い切るため少なく、LLMはAPIのレート制限に合わせる）
+        self._rerank_slots = threading.BoundedSemaphore(getattr(settings, 'AI_RERANK_CONCURRENCY', 1))
+        self._llm_slots = threading.BoundedSemaphore(getattr(settings, 'AI_LLM_CONCURRENCY', 4))
+
+        # Chroma・埋め込みクライアントは大きさを見積もれないので登録せず、tracemallocの集計（COMPONENT_MODULES）で見る
+        memory.register('ivf_index', sizer=lambda: self.ivf.nbytes if self.ivf is not None else 0)
+        memory.register('cross_encoder', sizer=self._cross_encoder_bytes,
+                        evict=self._evict_cross_encoder, priority=50)
+
+        # パイプライン設定（replay_traces等で差し替えて比較する）
+        self.use_rewrite = True
+        self.use_rerank = True
+        self.retrieval_k = 10
+        self.rerank_top_n = 5
+        self.context_size = 3
+        # 回答生成プロンプトの文書部分のトークン予算（0で無制限）
+        self.context_token_budget = getattr(settings, 'CONTEXT_TOKEN_BUDGET', 1500)
+
+        # 締め切りとステージ予算（秒）。予算を超えたステージは縮退して先へ進む
+        self.deadline_s = getattr(settings, 'CHAT_DEADLINE_S', 0)
+        self.stage_budgets = dict(getattr(settings, 'CHAT_STAGE_BUDGETS', {}))
+        self.generate_reserve_s = getattr(settings, 'CHAT_GENERATE_RESERVE_S', 0)
+        self._stage_executor = ThreadPoolExecutor(max_workers=getattr(settings, 'AI_STAGE_WORKERS', 8),
+                                                  thread_name_prefix='ai-stage')
+
+        # 取り込み時に計算した特徴量（数値・トークン数・語彙トークン）
+        # 数値ファクトのインデックス（数値を聞く質問へのLLMを使わない高速パスと矛盾判定）
+        self.use_fact_index = getattr(settings, 'FACT_INDEX_ENABLED', False)
+        self.fact_min_score = getattr(settings, 'FACT_INDEX_MIN_SCORE', 0.8)
+        # 稼働中の取り込みでファクトが変わったら読み直す（特徴量ストアの版を確認する間隔）
+        self.fact_index_refresh_s = getattr(settings, 'FACT_INDEX_REFRESH_S', 60)
+        self._fact_index_lock = threading.Lock()
+        self._fact_index_checked_at = time.monotonic()
+        try:
+            self.features = FeatureStore()
+            self._fact_index_version = self.features.facts_version()
+            self.fact_index = FactIndex.from_store(self.features)
+        except sqlite3.Error as e:
+            print(f"Warning: feature store unavailable: {e}")
+            self.features = None
+            self._fact_index_version = None
+            self.fact_index = FactIndex([])
+
+        # 取り込み時に作った 種別/カテゴリ のセントロイドで検索前に振り分ける（無ければ従来どおりQA優先）
+        self.use_router = getattr(settings, 'ROUTER_ENABLED', True)
+        self.router = self._load_router(getattr(settings, 'ROUTER_MARGIN', 0.03))
+
+        # 上流ごとのサーキットブレーカーと、開いている間に使う縮退用の回答キャッシュ・語彙検索
+        self.breakers = {name: CircuitBreaker.from_settings(name) for name in ('embeddings', 'rewrite', 'answer')}
+        self.answer_cache = AnswerCache(max_entries=getattr(settings, 'ANSWER_CACHE_SIZE', 500),
+                                        ttl_s=getattr(settings, 'ANSWER_CACHE_TTL_S', 24 * 60 * 60))
+        self._lexical_indexes: Dict[Optional[str], LexicalIndex] = {}
+        self._lexical_lock = threading.Lock()
+        # LLM呼び出しのヘッジとリトライ（統計は管理画面・bench_chatで確認）
+        self.hedgers = {name: HedgedCaller.from_settings(name) for name in ('rewrite', 'answer')}
+        memory.register('caches', sizer=self.answer_cache.approx_bytes, evict=self.clear_caches,
+                        priority=10, repeatable=True)
 
         # 質問リライト用プロンプト
         self.rewrite_prompt = PromptTemplate(
@@ -98,72 +218,348 @@ class AIService:
 
     @property
     def cross_encoder(self):
-        """Cross-Encoderモデルの遅延初期化"""
-        if self._cross_encoder is None:
+        """Cross-Encoderモデルの遅延初期化（複数スレッドから呼ばれても読み込みは1回）"""
+        if self._cross_encoder is not None or self._cross_encoder_disabled:
+            return self._cross_encoder
+        with self._cross_encoder_lock:
+            if self._cross_encoder is None and not self._cross_encoder_disabled:
+                try:
+                    from sentence_transformers import CrossEncoder
+                    self._cross_encoder = CrossEncoder('sonoisa/sentence-bert-base-ja-mean-tokens-v2')
+                except Exception as e:
+                    print(f"Warning: Cross-Encoder initialization failed: {e}")
+                    # 失敗したモデルを毎リクエスト読み直さない
+                    self._cross_encoder_disabled = True
+            return self._cross_encoder
+
+    def _cross_encoder_bytes(self) -> int:
+        """Cross-Encoderの重みのバイト数（torchのネイティブメモリはtracemallocで見えないため）"""
+        model = getattr(self._cross_encoder, 'model', None)
+        if model is None:
+            return 0
+        return sum(p.numel() * p.element_size() for p in model.parameters())
+
+    def _evict_cross_encoder(self):
+        """メモリ予算超過時にCross-Encoderを解放し、以降はベクトルスコアのみで順位付けする"""
+        with self._cross_encoder_lock:
+            self._cross_encoder_disabled = True
+            self._cross_encoder = None
+
+    def _open_qa_vectors(self) -> Optional[Chroma]:
+        """マルチベクトルのコレクション（未作成・空なら None）"""
+        try:
+            from chromadb import PersistentClient
+            client = PersistentClient(path="./wdb")
+            if QA_VECTOR_COLLECTION not in [c.name for c in client.list_collections()]:
+                return None
+            store = Chroma(client=client, collection_name=QA_VECTOR_COLLECTION,
+                           embedding_function=self.embeddings_model)
+            return store if store._collection.count() else None
+        except Exception as e:
+            print(f"Warning: multi-vector index unavailable: {e}")
+            return None
+
+    def _open_shards(self) -> Optional[StoreShards]:
+        """店舗シャードの検索（Chromaが開けなければ None で、ブランドシャードだけを検索する）"""
+        try:
+            from chromadb import PersistentClient
+            return StoreShards(PersistentClient(path="./wdb"),
+                               refresh_s=getattr(settings, 'STORE_SHARDS_REFRESH_S', 60))
+        except Exception as e:
+            print(f"Warning: store shards unavailable: {e}")
+            return None
+
+    def store_shard(self, store: Optional[str]) -> Optional[str]:
+        """店舗のシャードがあれば店舗コードを、無ければ None を返す（ブランドシャードだけで答える）"""
+        if not store or self.shards is None:
+            return None
+        try:
+            store = validate_store(store)
+            return store if self.shards.collection(store) is not None else None
+        except ValueError:
+            return None
+        except Exception as e:
+            print(f"Warning: store shard lookup failed: {e}")
+            return None
+
+    def _load_ivf(self) -> Optional[IVFIndex]:
+        """IVFインデックスを読む（無い・作った後にコレクションが変わった場合は None）
+
+        件数に加えて ID と sync_hash のダイジェストを比べるので、差分同期で本文だけ更新された場合や
+        削除と追加で件数が変わらなかった場合も古いインデックスは使わない。
+        """
+        path = getattr(settings, 'IVF_INDEX_PATH', '')
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            index = IVFIndex.load(path)
+            count = self.db._collection.count()
+            digest = collection_digest(self.db._collection) if index.source_count == count else None
+        except Exception as e:
+            print(f"Warning: IVF index unavailable: {e}")
+            return None
+        if index.source_count != count or index.source_digest != digest:
+            print(f"Warning: IVF index is stale ({index.source_count} vectors built {index.built_at}, "
+                  f"collection has {count} and has changed since); run build_ivf_index")
+            return None
+        return index
+
+    def _load_router(self, margin: float) -> Optional[IntentRouter]:
+        """特徴量ストアのセントロイドからルーターを作る（QAとそれ以外の両方が無ければ None）"""
+        if self.features is None:
+            return None
+        try:
+            router = IntentRouter(self.features.load_centroids(), margin=margin)
+        except sqlite3.Error as e:
+            print(f"Warning: intent router unavailable: {e}")
+            return None
+        return router if router.usable else None
+
+    def current_fact_index(self) -> FactIndex:
+        """特徴量ストアのファクトの版が変わっていれば読み直したインデックスを返す（確認は refresh 秒に1回）"""
+        if self.features is None or time.monotonic() - self._fact_index_checked_at < self.fact_index_refresh_s:
+            return self.fact_index
+        with self._fact_index_lock:
+            if time.monotonic() - self._fact_index_checked_at < self.fact_index_refresh_s:
+                return self.fact_index
+            self._fact_index_checked_at = time.monotonic()
             try:
-                from sentence_transformers import CrossEncoder
-                self._cross_encoder = CrossEncoder('sonoisa/sentence-bert-base-ja-mean-tokens-v2')
-            except Exception as e:
-                print(f"Warning: Cross-Encoder initialization failed: {e}")
-                self._cross_encoder = None
-        return self._cross_encoder
+                # 版を先に読む（読み込み中に書き換えられても、次の確認でもう一度読み直す）
+                version = self.features.facts_version()
+                if version != self._fact_index_version:
+                    self.fact_index = FactIndex.from_store(self.features)
+                    self._fact_index_version = version
+            except sqlite3.Error as e:
+                print(f"Warning: fact index reload failed: {e}")
+        return self.fact_index
+
+    def clear_caches(self):
+        """回答キャッシュと語彙インデックスを破棄する（メモリ予算超過時）"""
+        self.answer_cache.clear()
+        with self._lexical_lock:
+            self._lexical_indexes = {}
+
+    def lexical_search(self, query: str, doc_type: Optional[str] = None, k: int = 10) -> List[Dict]:
+        """埋め込みを使わない語彙検索（QAのインデックスは初回に構築してプロセス内で使い回す）"""
+        with self._lexical_lock:
+            index = self._lexical_indexes.get(doc_type)
+            if index is None:
+                index = LexicalIndex.from_store(self.db, doc_type, features=self.features)
+                self._lexical_indexes[doc_type] = index
+        return [{**doc, 'id': doc['metadata'].get('id')} for doc in index.search(query, k=k)]
 
-    def rewrite_query(self, question: str) -> str:
+    def invoke_llm(self, llm, prompt: str, hedger: Optional[HedgedCaller] = None,
+                   deadline: Optional[Deadline] = None):
+        """LLM呼び出し（hedger を渡すと遅い応答へのヘッジと、締め切り内でのリトライを行う）"""
+        if hedger is None:
+            return self._invoke_limited(llm, prompt)
+        return hedger.call(self._invoke_limited, llm, prompt, deadline=deadline,
+                           has_capacity=self._llm_slot_free)
+
+    def _llm_slot_free(self) -> bool:
+        """LLMの同時実行枠に空きがあるか（ヘッジを送ってよいかの判定。枠は確保しない）"""
+        if not self._llm_slots.acquire(blocking=False):
+            return False
+        self._llm_slots.release()
+        return True
+
+    def _invoke_limited(self, llm, prompt: str):
+        """同時実行数を AI_LLM_CONCURRENCY に制限して呼び出す"""
+        with self._llm_slots:
+            return llm.invoke(prompt)
+
+    def pipeline_stats(self) -> Dict:
+        """サーキットブレーカー・ヘッジ・シャードの状態（管理画面用）"""
+        return {
+            'circuits': {name: breaker.snapshot() for name, breaker in self.breakers.items()},
+            'hedging': {name: hedger.stats() for name, hedger in self.hedgers.items()},
+            'answer_cache': {'entries': len(self.answer_cache), 'hits': self.answer_cache.hits,
+                             'misses': self.answer_cache.misses},
+            'shards': self.shard_stats.stats(self.shard_sizes()),
+        }
+
+    def shard_sizes(self) -> Dict[str, int]:
+        """シャードごとのドキュメント数（ブランドシャードと店舗シャード）"""
+        try:
+            sizes = {BRAND_SHARD: self.db._collection.count()}
+            if self.shards is not None:
+                sizes.update(self.shards.sizes())
+        except Exception as e:
+            print(f"Warning: shard sizes unavailable: {e}")
+            return {}
+        return sizes
+
+    def rewrite_query(self, question: str, deadline: Optional[Deadline] = None) -> str:
         """質問をリライト"""
         prompt = self.rewrite_prompt.format(question=question)
-        response = self.llm_rewrite.invoke(prompt)
+        response = self.invoke_llm(self.llm_rewrite, prompt, self.hedgers['rewrite'], deadline)
         return response.content.strip()
 
-    def vector_search(self, query: str, doc_type: Optional[str] = None, k: int = 10) -> List[Dict]:
-        """ベクトル検索（シンプル版）"""
+    @staticmethod
+    def search_with_scores(store, query: str, k: int, filter_dict: Optional[Dict],
+                           embedding: Optional[List[float]] = None):
+        """関連度スコア付きの検索（埋め込み済みなら再計算しない）"""
+        if embedding is None:
+            return store.similarity_search_with_relevance_scores(query, k=k, filter=filter_dict)
+        relevance = store._select_relevance_score_fn()
+        hits = store.similarity_search_by_vector_with_relevance_scores(embedding, k=k, filter=filter_dict)
+        return [(doc, relevance(distance)) for doc, distance in hits]
+
+    def vector_search(self, query: str, doc_type=None, k: int = 10,
+                      embedding: Optional[List[float]] = None) -> List[Dict]:
+        """ベクトル検索（シンプル版）
+
+        Args:
+            doc_type: 種別（リストなら複数の種別）。None なら全種別
+            embedding: 質問の埋め込み（振り分けで計算済みの場合）
+        """
+        if self.ivf is not None:
+            return self.ivf_search(query, doc_type, k, embedding)
+
         # メタデータフィルタ
-        filter_dict = {"type": doc_type} if doc_type else None
+        if isinstance(doc_type, (list, tuple)):
+            filter_dict = {"type": {"$in": list(doc_type)}}
+        else:
+            filter_dict = {"type": doc_type} if doc_type else None
         
-        # LangChainのsimilarity_search_with_relevance_scoresを直接使用
-        results = self.db.similarity_search_with_relevance_scores(
-            query, 
-            k=k,
-            filter=filter_dict
-        )
+        results = self.search_with_scores(self.db, query, k, filter_dict, embedding)
         
         # 結果を整形
         documents = []
         for doc, score in results:
             documents.append({
+                'id': getattr(doc, 'id', None) or doc.metadata.get('id'),
                 'content': doc.page_content,
-                'metadata': doc.metadata,
+                'metadata': dict(doc.metadata),
                 'score': score
             })
         
         return documents
 
+    def documents_by_id(self, ids: List[str]) -> Dict[str, tuple]:
+        """ID → (本文, メタデータ)。同期の途中で消えたIDは含まれない"""
+        found = self.db.get(ids=ids, include=['documents', 'metadatas'])
+        return {doc_id: (content, dict(metadata or {})) for doc_id, content, metadata
+                in zip(found['ids'], found['documents'], found['metadatas'])}
+
+    def ivf_search(self, query: str, doc_type=None, k: int = 10,
+                   embedding: Optional[List[float]] = None) -> List[Dict]:
+        """IVFインデックスで近いクラスタだけを比べるベクトル検索（スコアはChromaの検索と同じ尺度）"""
+        if embedding is None:
+            embedding = self.embeddings_model.embed_query(query)
+        types = [doc_type] if isinstance(doc_type, str) else doc_type
+        hits, _ = self.ivf.search(embedding, k=k, n_probe=self.ivf_n_probe, types=types)
+        if not hits:
+            return []
+        relevance = self.db._select_relevance_score_fn()
+        found = self.documents_by_id([doc_id for doc_id, _ in hits])
+        return [
+            {'id': doc_id, 'content': found[doc_id][0], 'metadata': found[doc_id][1], 'score': relevance(distance)}
+            for doc_id, distance in hits if doc_id in found
+        ]
+
+    def multi_vector_search(self, query: str, k: int = 5, fetch_factor: int = 3,
+                            embedding: Optional[List[float]] = None) -> List[Dict]:
+        """質問・回答ベクトルを検索し、親のQAごとに最大スコアを採って上位 k 件を返す"""
+        hits = self.search_with_scores(self.qa_vectors, query, k * fetch_factor, {"type": "qa"}, embedding)
+        ranked = max_per_parent((dict(doc.metadata), score) for doc, score in hits)[:k]
+        if not ranked:
+            return []
+        found = self.documents_by_id([parent_id for parent_id, _, _ in ranked])
+        documents = []
+        for parent_id, score, kind in ranked:
+            # 親が同期の途中で消えている場合は飛ばす
+            if parent_id not in found:
+                continue
+            content, metadata = found[parent_id]
+            documents.append({
+                'id': parent_id,
+                'content': content,
+                'metadata': metadata,
+                'score': score,
+                'matched_vector': kind,
+            })
+        return documents
+
+    def store_shard_search(self, store: str, embedding: List[float], doc_type=None, k: int = 10,
+                           scale_like=None) -> List[Dict]:
+        """店舗のシャードを検索する（スコアは scale_like（既定はブランドシャード）の検索と同じ尺度にする）
+
+        Args:
+            doc_type: 種別（リストなら複数の種別）。None なら全種別
+        """
+        if isinstance(doc_type, (list, tuple)):
+            where = {"type": {"$in": list(doc_type)}}
+        else:
+            where = {"type": doc_type} if doc_type else None
+        scale_like = scale_like if scale_like is not None else self.db
+        space = (scale_like._collection.metadata or {}).get('hnsw:space', 'l2')
+        relevance = scale_like._select_relevance_score_fn()
+        start = time.perf_counter()
+        hits = self.shards.search(store, embedding, k=k, where=where)
+        self.shard_stats.record(shard_name(store), (time.perf_counter() - start) * 1000)
+        return [{**doc, 'score': relevance(distance_from_cosine(cosine, space))} for doc, cosine in hits]
+
+    @staticmethod
+    def merge_by_score(documents: List[Dict], k: int) -> List[Dict]:
+        return sorted(documents, key=lambda x: x['score'], reverse=True)[:k]
+
+    @staticmethod
+    def keep_vector_scores(documents: List[Dict], top_n: int, default: float = 0.5) -> List[Dict]:
+        """ベクトルスコアをそのまま最終スコアにした新しい辞書を返す"""
+        scored = [{**doc, 'final_score': doc.get('score', default)} for doc in documents]
+        return sorted(scored, key=lambda x: x['final_score'], reverse=True)[:top_n]
+
     def rerank_documents(self, query: str, documents: List[Dict], top_n: int = 10) -> List[Dict]:
-        """Cross-Encoderで再ランク（シンプル版）"""
+        """Cross-Encoderで再ランク（入力の辞書は変更せず、新しい辞書を返す）"""
         if not documents:
             return []
         
+        # 退避と競合しないよう、このリクエストで使うモデルを先に確定する
+        cross_encoder = self.cross_encoder
         # Cross-Encoderが利用できない場合は元のスコアを維持
-        if self.cross_encoder is None:
-            for doc in documents:
-                doc['final_score'] = doc.get('score', 0.5)
-            return sorted(documents, key=lambda x: x['final_score'], reverse=True)[:top_n]
+        if cross_encoder is None:
+            return self.keep_vector_scores(documents, top_n)
         
         try:
             # Cross-Encoderで再スコアリング
             pairs = [[query, doc['content']] for doc in documents]
-            scores = self.cross_encoder.predict(pairs)
+            with self._rerank_slots:
+                scores = cross_encoder.predict(pairs)
             
-            for i, doc in enumerate(documents):
-                doc['rerank_score'] = float(scores[i])
-                # ベクトルスコアと再ランクスコアを組み合わせ
-                doc['final_score'] = 0.4 * doc.get('score', 0) + 0.6 * doc['rerank_score']
+            reranked = []
+            for doc, score in zip(documents, scores):
+                rerank_score = float(score)
+                reranked.append({
+                    **doc,
+                    'rerank_score': rerank_score,
+                    # ベクトルスコアと再ランクスコアを組み合わせ
+                    'final_score': 0.4 * doc.get('score', 0) + 0.6 * rerank_score,
+                })
             
-            return sorted(documents, key=lambda x: x['final_score'], reverse=True)[:top_n]
+            return sorted(reranked, key=lambda x: x['final_score'], reverse=True)[:top_n]
         except Exception as e:
             print(f"Warning: Cross-Encoder reranking failed: {e}")
-            for doc in documents:
-                doc['final_score'] = doc.get('score', 0.5)
-            return sorted(documents, key=lambda x: x['final_score'], reverse=True)[:top_n]
+            return self.keep_vector_scores(documents, top_n)
+
+    def with_features(self, documents: List[Dict]) -> List[Dict]:
+        """特徴量ストアの値を 'features' に付けた新しい辞書を返す（無いドキュメントはそのまま）"""
+        if self.features is None or not documents:
+            return documents
+        try:
+            found = self.features.get_many([doc.get('id') for doc in documents])
+        except sqlite3.Error as e:
+            print(f"Warning: feature lookup failed: {e}")
+            return documents
+        return [{**doc, 'features': found[doc['id']]} if doc.get('id') in found else doc for doc in documents]
+
+    @staticmethod
+    def numeric_facts(doc: Dict) -> List[tuple]:
+        """(数値, 単位) の組。特徴量が無い（取り込み前の）ドキュメントだけ本文から抽出する"""
+        features = doc.get('features')
+        if features is not None:
+            return features['numeric_facts']
+        return extract_numeric_facts(doc['content'])
 
     def check_confidence(self, documents: List[Dict]) -> tuple[bool, str]:
         """簡易的な確信度チェック"""
@@ -175,50 +571,350 @@ class AIService:
         if top_score < 0.3:
             return False, "low_confidence"
         
-        # 簡易的な矛盾チェック（数値の食い違い）
+        # 簡易的な矛盾チェック（同じ単位で異なる数値があるか。数値は取り込み時に抽出済みの特徴量）
         if len(documents) >= 2:
-            numbers_pattern = r'\d+[時間分円%枚個]'
-            nums1 = set(re.findall(numbers_pattern, documents[0]['content']))
-            nums2 = set(re.findall(numbers_pattern, documents[1]['content']))
-            
-            # 同じ単位で異なる数値があるか簡易チェック
-            for n1 in nums1:
-                unit1 = re.sub(r'\d+', '', n1)
-                for n2 in nums2:
-                    unit2 = re.sub(r'\d+', '', n2)
-                    if unit1 == unit2 and n1 != n2:
-                        return False, "contradiction"
+            if facts_contradict(self.numeric_facts(documents[0]), self.numeric_facts(documents[1])):
+                return False, "contradiction"
         
         return True, "ok"
 
-    def chat(self, question: str) -> dict:
-        """メイン処理（シンプル版）"""
+    def chat(self, question: str, deadline_s: Optional[float] = None, store: Optional[str] = None) -> dict:
+        """メイン処理（プロファイリング対象の場合は計測しながら実行）
+
+        Args:
+            deadline_s: 全体の締め切り（秒）。省略時は CHAT_DEADLINE_S
+            store: 質問したユーザーの店舗コード。その店舗のシャードがあればブランドシャードと合わせて検索する
+        """
+        with profiling.profile('chat'):
+            result, trace = self.run_traced(question, deadline_s, store)
+            profiling.annotate(question=question, timings=result['process_info'].get('timings'))
+        tracing.record(trace)
+        memory.enforce_budget()
+        return result
+
+    def run_traced(self, question: str, deadline_s: Optional[float] = None,
+                   store: Optional[str] = None) -> tuple[dict, dict]:
+        """パイプラインを実行し、結果とトレース（JSONL用の辞書）を返す"""
+        trace = {'question': question, 'normalized_question': normalize_text(question)}
+        if store:
+            trace['store'] = store
+        deadline = Deadline(self.deadline_s if deadline_s is None else deadline_s)
+        result = self._chat(question, trace, deadline, store)
+        info = result['process_info']
+        trace['timings'] = info.get('timings')
+        trace['degradations'] = info.get('degradations', [])
+        for key in ('search_type', 'fast_path', 'fallback_used', 'fallback_attempted', 'error_fallback', 'degraded_mode',
+                    'system_error'):
+            if key in info:
+                trace[key] = info[key]
+        return result, trace
+
+    def run_stage(self, name: str, deadline: Deadline, fn, *args, **kwargs):
+        """ステージ予算（CHAT_STAGE_BUDGETS）と残り時間の短い方で fn を実行する"""
+        timeout = deadline.budget(self.stage_budgets.get(name))
+        # 計測中ならステージのスレッドもプロファイルに含める
+        return call_with_timeout(self._stage_executor, timeout, profiling.bind(fn), *args, **kwargs)
+
+    def run_upstream(self, breaker_name: str, name: str, deadline: Deadline, fn, *args, **kwargs):
+        """ブレーカー越しにステージを実行する
+
+        失敗として数えるのは fn の例外と、ステージ予算いっぱいを使ったタイムアウトだけ。
+        開始前に時間が残っていない場合や、締め切りの残りが予算より短くて打ち切った場合は
+        上流の障害ではないので数えない（短い締め切りや前のステージの遅れでブレーカーを開かない）。
+        """
+        breaker = self.breakers[breaker_name]
+        stage_budget = self.stage_budgets.get(name)
+        timeout = deadline.budget(stage_budget)
+        if timeout <= 0:
+            raise StageTimeout("no time left")
+        if not breaker.allow():
+            raise CircuitOpen(breaker.name)
         try:
-            # 1. 質問リライト
-            rewritten_query = self.rewrite_query(question)
-            
-            # 2. ベクトル検索（QA優先）
-            qa_results = self.vector_search(rewritten_query, doc_type="qa", k=10)
-            search_type = 'qa'
+            result = call_with_timeout(self._stage_executor, timeout, profiling.bind(fn), *args, **kwargs)
+        except StageTimeout:
+            if stage_budget and timeout >= stage_budget:
+                breaker.record_failure()
+            else:
+                breaker.record_ignored()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+        breaker.record_success()
+        return result
+
+    def can_afford(self, name: str, deadline: Deadline) -> bool:
+        """ステージの予算を使っても回答生成の分の時間が残るか"""
+        return deadline.allows((self.stage_budgets.get(name) or 0) + self.generate_reserve_s)
+
+    def retrieve(self, query: str, route: Optional[str] = None,
+                 embedding: Optional[List[float]] = None) -> tuple[List[Dict], str]:
+        """QAを優先して検索し、見つからなければ全体から検索する
+
+        振り分け（route）が guideline ならQA以外だけを、both なら全種別を1回で検索する。
+        """
+        if route == 'guideline':
+            results = self.vector_search(query, doc_type=self.router.other_types, k=self.retrieval_k,
+                                         embedding=embedding)
+            if results:
+                return results, 'guideline'
+        elif route == 'both':
+            return self.vector_search(query, doc_type=None, k=self.retrieval_k, embedding=embedding), 'both'
+        if self.use_multi_vector and self.qa_vectors is not None:
+            results = self.multi_vector_search(query, k=self.multi_vector_k, embedding=embedding)
+            if results:
+                return results, 'qa_multivector'
+        results = self.vector_search(query, doc_type="qa", k=self.retrieval_k, embedding=embedding)
+        if results:
+            return results, 'qa'
+        return self.vector_search(query, doc_type=None, k=self.retrieval_k, embedding=embedding), 'all'
+
+    def route_query(self, query: str) -> tuple[Optional[RouteDecision], Optional[List[float]]]:
+        """質問を埋め込んで振り分け先を決める（埋め込みは検索でも使う）"""
+        if not self.use_router or self.router is None:
+            return None, None
+        embedding = self.embeddings_model.embed_query(query)
+        return self.router.route(embedding), embedding
+
+    def routed_retrieve(self, query: str, store: Optional[str] = None) -> tuple[List[Dict], str, Optional[RouteDecision]]:
+        """振り分けてから検索する
+
+        store（シャードのある店舗）を渡すと、ブランドシャードで決まった検索方式と同じ種別で
+        店舗のシャードも検索し、スコア順に統合する（質問の埋め込みは1回だけ計算する）。
+        """
+        routing, embedding = self.route_query(query)
+        if store and embedding is None:
+            embedding = self.embeddings_model.embed_query(query)
+        start = time.perf_counter()
+        results, search_type = self.retrieve(query, routing.route if routing else None, embedding)
+        self.shard_stats.record(BRAND_SHARD, (time.perf_counter() - start) * 1000)
+        if store:
+            if search_type in ('qa', 'qa_multivector'):
+                doc_type = 'qa'
+            elif search_type == 'guideline':
+                doc_type = self.router.other_types
+            else:
+                doc_type = None
+            multi_vector = search_type == 'qa_multivector'
+            k = self.multi_vector_k if multi_vector else self.retrieval_k
+            try:
+                store_results = self.store_shard_search(store, embedding, doc_type, k,
+                                                        scale_like=self.qa_vectors if multi_vector else None)
+            except Exception as e:
+                # 店舗のシャードが読めなくてもブランドシャードの結果で答える
+                print(f"Warning: store shard search failed ({store}): {e}")
+                store_results = []
+            results = self.merge_by_score(results + store_results, k)
+        return results, search_type, routing
+
+    def guideline_fallback(self, query: str, store: Optional[str] = None) -> List[Dict]:
+        """ガイドライン（店舗のシャードがあればその店舗のガイドラインも）を検索して再ランクした結果を返す"""
+        if store:
+            embedding = self.embeddings_model.embed_query(query)
+            guideline_results = self.vector_search(query, doc_type="guideline", k=5, embedding=embedding)
+            try:
+                store_results = self.store_shard_search(store, embedding, doc_type="guideline", k=5)
+            except Exception as e:
+                # 店舗のシャードが読めなくてもブランドのガイドラインで補完する
+                print(f"Warning: store shard search failed ({store}): {e}")
+                store_results = []
+            guideline_results = self.merge_by_score(guideline_results + store_results, 5)
+        else:
+            guideline_results = self.vector_search(query, doc_type="guideline", k=5)
+        if not guideline_results:
+            return []
+        return self.with_features(self.rerank_documents(query, guideline_results, top_n=3))
+
+    @staticmethod
+    def extractive_answer(documents: List[Dict]) -> str:
+        """回答生成が間に合わないときに、最上位の文書をそのまま回答にする"""
+        top = documents[0]
+        return top['metadata'].get('answer') or top['content']
+
+    def fact_answer(self, question: str, fact: Dict, timer: StageTimer, trace: dict) -> dict:
+        """ファクトインデックスの高速パスの応答"""
+        source = fact['source'] or 'マニュアル'
+        trace['context_ids'] = [fact['doc_id']]
+        return {
+            'answer': f"{fact['sentence']}\n\n【参照元：{source}】",
+            'process_info': {
+                'original_query': question,
+                'search_type': 'fact_index',
+                'fast_path': 'fact_index',
+                'fact': {'doc_id': fact['doc_id'], 'value': fact['value'], 'unit': fact['unit'],
+                         'score': fact['score']},
+                'sources_count': 1,
+                'sources': [source],
+                'degradations': [],
+                'timings': timer.as_dict()
+            }
+        }
+
+    def degraded_answer(self, question: str, timer: StageTimer, degradations: List[str], error: bool = False,
+                        store: Optional[str] = None) -> dict:
+        """上流を呼ばずに回答する（回答キャッシュ → QAの回答メタデータの語彙検索）"""
+        process_info = {'original_query': question, 'degradations': degradations}
+        with timer.stage('degraded'):
+            cached = self.answer_cache.get(question, scope=store)
+            if cached is not None:
+                degradations.append('answer_cache')
+                answer = cached['answer']
+                process_info['degraded_mode'] = 'cache'
+            else:
+                answer = None
+                try:
+                    results = self.lexical_search(question, doc_type='qa', k=1)
+                except Exception as e:
+                    print(f"Warning: lexical fallback failed: {e}")
+                    results = []
+                if results and results[0]['metadata'].get('answer'):
+                    degradations.append('lexical_answer')
+                    metadata = results[0]['metadata']
+                    source = metadata.get('source', '')
+                    answer = (
+                        "（現在AIによる回答を生成できないため、よくある質問から近い回答を表示しています）\n\n"
+                        f"{metadata['answer']}\n\n【参照元：{source}(qa)】"
+                    )
+                    process_info['degraded_mode'] = 'lexical'
+        if answer is None:
+            process_info['system_error'] = True
+            answer = "申し訳ございません。システムエラーが発生しました。"
+        elif error:
+            process_info['error_fallback'] = True
+        process_info['timings'] = timer.as_dict()
+        return {'answer': answer, 'process_info': process_info}
+
+    def _chat(self, question: str, trace: dict, deadline: Deadline, store: Optional[str] = None) -> dict:
+        """メイン処理（シンプル版）
+
+        ステージが予算を超えた、または残り時間が足りない場合は品質を落として続行し、
+        行った縮退を process_info['degradations'] に記録する。
+        """
+        timer = StageTimer()
+        degradations = []
+        # シャードの無い店舗はブランドシャードだけで答える（回答キャッシュもブランドと共有する）
+        store = self.store_shard(store)
+        if store:
+            trace['shards'] = [BRAND_SHARD, shard_name(store)]
+        # 0. 数値を聞く質問で、ファクトが一意に見つかればLLMを呼ばずに答える
+        # （ファクトはブランドシャードのものだけなので、店舗のシャードがある場合は店舗の規定を優先して使わない）
+        if self.use_fact_index and store is None:
+            with timer.stage('fact_lookup'):
+                fact = self.current_fact_index().lookup(question, min_score=self.fact_min_score)
+            if fact is not None:
+                return self.fact_answer(question, fact, timer, trace)
+        # 回答生成のブレーカーが開いている間は上流を一切呼ばずに即答する
+        if self.breakers['answer'].is_open():
+            degradations.append('answer_circuit_open')
+            return self.degraded_answer(question, timer, degradations, store=store)
+        try:
+            # 1. 質問リライト（間に合わない・失敗した場合は元の質問で検索）
+            rewritten_query = question
+            with timer.stage('rewrite'):
+                if not self.use_rewrite:
+                    pass
+                elif not self.can_afford('rewrite', deadline):
+                    degradations.append('rewrite_skipped')
+                else:
+                    try:
+                        rewritten_query = self.run_upstream(
+                            'rewrite', 'rewrite', deadline, self.rewrite_query, question, deadline)
+                    except StageTimeout:
+                        degradations.append('rewrite_timeout')
+                    except CircuitOpen:
+                        degradations.append('rewrite_circuit_open')
+                    except Exception as e:
+                        print(f"Warning: query rewrite failed: {e}")
+                        degradations.append('rewrite_failed')
+            trace['rewritten_query'] = rewritten_query
             
-            # QAが見つからない場合は全体から検索
-            if not qa_results:
-                qa_results = self.vector_search(rewritten_query, doc_type=None, k=10)
-                search_type = 'all'
+            # 2. ベクトル検索（振り分け先、なければQA優先。埋め込みが使えない場合は語彙検索）
+            with timer.stage('retrieve'):
+                try:
+                    qa_results, search_type, routing = self.run_upstream(
+                        'embeddings', 'retrieve', deadline, self.routed_retrieve, rewritten_query, store)
+                    if routing is not None:
+                        trace['routing'] = routing.as_dict()
+                except Exception as e:
+                    if isinstance(e, StageTimeout):
+                        degradations.append('retrieve_timeout')
+                    elif isinstance(e, CircuitOpen):
+                        degradations.append('embeddings_circuit_open')
+                    else:
+                        print(f"Warning: vector search failed: {e}")
+                        degradations.append('retrieve_failed')
+                    qa_results = self.lexical_search(rewritten_query, doc_type='qa', k=self.retrieval_k)
+                    search_type = 'lexical'
             
-            # 3. 再ランク
-            reranked_docs = self.rerank_documents(rewritten_query, qa_results, top_n=5)
+            # 3. 再ランク（一次検索の上位が明確なら省く・絞る。間に合わなければベクトルスコアのまま）
+            # 語彙検索のスコアはベクトルの類似度と尺度が違うので適応制御の対象外
+            decision = None
+            if self.use_adaptive and search_type != 'lexical':
+                decision = self.adaptive.decide(qa_results, search_type)
+                trace['adaptive'] = decision.as_dict()
+            with timer.stage('rerank'):
+                if not self.use_rerank:
+                    reranked_docs = [{**doc, 'final_score': doc.get('score', 0)} for doc in qa_results[:self.rerank_top_n]]
+                elif decision is not None and decision.action == 'skip_rerank':
+                    reranked_docs = self.keep_vector_scores(qa_results, self.rerank_top_n, default=0)
+                elif not self.can_afford('rerank', deadline):
+                    degradations.append('rerank_skipped')
+                    reranked_docs = self.keep_vector_scores(qa_results, self.rerank_top_n, default=0)
+                else:
+                    candidates = qa_results
+                    if decision is not None and decision.action == 'shrink_rerank':
+                        candidates = sorted(qa_results, key=lambda x: x.get('score', 0),
+                                            reverse=True)[:decision.rerank_n]
+                    try:
+                        reranked_docs = self.run_stage('rerank', deadline, self.rerank_documents,
+                                                       rewritten_query, candidates, top_n=self.rerank_top_n)
+                    except StageTimeout:
+                        degradations.append('rerank_timeout')
+                        reranked_docs = self.keep_vector_scores(qa_results, self.rerank_top_n, default=0)
             
-            # 4. 確信度チェック
-            is_confident, reason = self.check_confidence(reranked_docs)
+            # 4. 確信度チェック（数値は取り込み時に抽出済みの特徴量を使う）
+            with timer.stage('features'):
+                reranked_docs = self.with_features(reranked_docs)
+            with timer.stage('confidence'):
+                is_confident, reason = self.check_confidence(reranked_docs)
+            trace['confidence_reason'] = reason
             
             # 5. 低確信の場合はガイドラインから補完
-            if not is_confident:
-                guideline_results = self.vector_search(rewritten_query, doc_type="guideline", k=5)
-                if guideline_results:
-                    guideline_reranked = self.rerank_documents(rewritten_query, guideline_results, top_n=3)
-                    reranked_docs.extend(guideline_reranked)
-                    reranked_docs = sorted(reranked_docs, key=lambda x: x['final_score'], reverse=True)[:5]
+            # （一次検索で明確に決まった場合・既にガイドラインを検索した場合・間に合わない場合は省略）
+            # fallback_used は補完したガイドラインが実際に結果に加わった場合だけ真にする
+            fallback_attempted = (not is_confident and search_type not in ('guideline', 'both')
+                                  and not (decision is not None and decision.skip_fallback))
+            fallback_used = False
+            if fallback_attempted:
+                with timer.stage('fallback'):
+                    guideline_reranked = []
+                    if not self.can_afford('fallback', deadline):
+                        degradations.append('fallback_skipped')
+                    else:
+                        try:
+                            guideline_reranked = self.run_upstream(
+                                'embeddings', 'fallback', deadline, self.guideline_fallback, rewritten_query, store)
+                        except StageTimeout:
+                            degradations.append('fallback_timeout')
+                        except CircuitOpen:
+                            degradations.append('fallback_skipped')
+                        except Exception as e:
+                            # 補完に失敗しても一次検索の結果で答える
+                            print(f"Warning: guideline fallback failed: {e}")
+                            degradations.append('fallback_failed')
+                    if guideline_reranked:
+                        fallback_used = True
+                        reranked_docs = sorted(reranked_docs + guideline_reranked, key=lambda x: x['final_score'], reverse=True)[:self.rerank_top_n]
+            trace['documents'] = [
+                {
+                    'id': doc.get('id'),
+                    'shard': doc.get('shard', BRAND_SHARD),
+                    'vector_score': round(doc.get('score', 0), 4),
+                    'rerank_score': round(doc['rerank_score'], 4) if 'rerank_score' in doc else None,
+                    'final_score': round(doc.get('final_score', 0), 4),
+                }
+                for doc in reranked_docs
+            ]
             
             # 6. 最終回答生成
             if not reranked_docs:
@@ -230,13 +926,21 @@ class AIService:
                         'search_type': search_type,
                         'confidence_check': None,
                         'fallback_used': False,
-                        'sources_count': 0
+                        'fallback_attempted': fallback_attempted,
+                        'adaptive': trace.get('adaptive'),
+                        'routing': trace.get('routing'),
+                        'sources_count': 0,
+                        'degradations': degradations,
+                        'timings': timer.as_dict()
                     }
                 }
             
-            # 上位文書を結合
-            top_documents = reranked_docs[:3]
-            documents_text = "\n---\n".join([doc['content'] for doc in top_documents])
+            # 上位文書をトークン予算内で結合（重複は捨て、溢れる文書は文の境界で切り詰める）
+            top_documents, packing = pack_context(reranked_docs, self.context_token_budget,
+                                                  max_documents=self.context_size)
+            trace['context_ids'] = [doc.get('id') for doc in top_documents]
+            trace['context_packing'] = packing
+            documents_text = SEPARATOR.join([doc['content'] for doc in top_documents])
             
             # 出典情報
             sources = []
@@ -247,56 +951,68 @@ class AIService:
                     sources.append(f"{source}({doc_type})")
             sources_text = "、".join(sources) if sources else "マニュアル"
             
-            # LLMで回答生成
+            # LLMで回答生成（間に合わない・失敗した場合は最上位の文書をそのまま返す）
             filled_prompt = self.answer_prompt.format(
                 documents=documents_text,
                 question=question
             )
-            response = self.llm_answer.invoke(filled_prompt)
+            trace['prompt_tokens'] = {
+                'documents': count_tokens(documents_text),
+                'total': count_tokens(filled_prompt),
+            }
+            with timer.stage('generate'):
+                try:
+                    response = self.run_upstream(
+                        'answer', 'generate', deadline, self.invoke_llm, self.llm_answer, filled_prompt,
+                        self.hedgers['answer'], deadline)
+                    answer = response.content
+                except Exception as e:
+                    if isinstance(e, StageTimeout):
+                        degradations.append('generate_timeout')
+                    elif isinstance(e, CircuitOpen):
+                        degradations.append('answer_circuit_open')
+                    else:
+                        print(f"Warning: answer generation failed: {e}")
+                        degradations.append('generate_failed')
+                    answer = self.extractive_answer(top_documents or reranked_docs)
             
-            return {
-                'answer': f"{response.content}\n\n【参照元：{sources_text}】",
+            result = {
+                'answer': f"{answer}\n\n【参照元：{sources_text}】",
                 'process_info': {
                     'original_query': question,
                     'rewritten_query': rewritten_query,
                     'search_type': search_type,
                     'confidence_check': {'is_confident': is_confident, 'reason': reason},
-                    'fallback_used': not is_confident,
+                    'fallback_used': fallback_used,
+                    'fallback_attempted': fallback_attempted,
+                    'adaptive': trace.get('adaptive'),
+                    'routing': trace.get('routing'),
                     'sources_count': len(top_documents),
-                    'sources': sources
+                    'sources': sources,
+                    'context': packing,
+                    'degradations': degradations,
+                    'timings': timer.as_dict()
                 }
             }
+            if not degradations:
+                self.answer_cache.put(question, result, scope=store)
+            return result
             
         except Exception as e:
             print(f"Error in chat: {str(e)}")
-            # エラー時のフォールバック
-            try:
-                # シンプルなベクトル検索のみ
-                results = self.db.similarity_search(question, k=3)
-                if results:
-                    context = "\n---\n".join([doc.page_content for doc in results])
-                    filled_prompt = self.answer_prompt.format(
-                        documents=context,
-                        question=question
-                    )
-                    response = self.llm_answer.invoke(filled_prompt)
-                    return {
-                        'answer': response.content,
-                        'process_info': {
-                            'original_query': question,
-                            'error_fallback': True
-                        }
-                    }
-            except:
-                pass
-            
-            return {
-                'answer': "申し訳ございません。システムエラーが発生しました。",
-                'process_info': {
-                    'original_query': question,
-                    'system_error': True
-                }
-            }
+            trace['error'] = str(e)
+            # エラー時は上流に再度問い合わせず（障害中の負荷を倍にしないため）、キャッシュと語彙検索で答える
+            return self.degraded_answer(question, timer, degradations, error=True, store=store)
+
+# シングルトンインスタンス（初回の呼び出しで作る。import しただけでは ./wdb を開かない）
+_ai_service: Optional[AIService] = None
+_ai_service_lock = threading.Lock()
+
 
-# シングルトンインスタンス
-ai_service = AIService()
\ No newline at end of file
+def get_ai_service() -> AIService:
+    global _ai_service
+    if _ai_service is None:
+        with _ai_service_lock:
+            if _ai_service is None:
+                _ai_service = AIService()
+    return _ai_service
\ No newline at end of file
@@ -3,14 +3,26 @@ Lightweight AI Service for memory-constrained environments
 Disables heavy ML models when running on Render free tier
 """
 import os
+import threading
 from typing import List
+from django.conf import settings
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_chroma import Chroma
 from langchain.prompts import PromptTemplate
 from langchain_core.documents import Document
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from common import memory, profiling
+from common.context_packer import pack_context
+from common.embedding_cache import CachedEmbeddings
+
 class AIServiceLite:
+    """軽量版RAGチャットサービス
+
+    AIServiceと同様に1インスタンスを複数スレッドで共有する。遅延初期化は無く、
+    LLM呼び出しの同時実行数の制限と、ベクトルストアへの書き込みの直列化だけを行う。
+    """
+
     def __init__(self):
         self.openai_api_key = os.environ.get("OPENAI_API_KEY")
         
@@ -27,10 +39,13 @@ class AIServiceLite:
             openai_api_key=self.openai_api_key
         )
         
-        # Initialize embeddings
-        self.embeddings = OpenAIEmbeddings(
-            model="text-embedding-3-small",
-            openai_api_key=self.openai_api_key
+        # Initialize embeddings（追加するドキュメントの埋め込みは本文ハッシュでキャッシュする）
+        self.embeddings = CachedEmbeddings(
+            OpenAIEmbeddings(
+                model="text-embedding-3-small",
+                openai_api_key=self.openai_api_key
+            ),
+            "text-embedding-3-small"
         )
         
         # Initialize vector store - use existing wdb folder
@@ -41,6 +56,9 @@ class AIServiceLite:
             persist_directory=persist_directory
         )
         
+        self._llm_slots = threading.BoundedSemaphore(getattr(settings, 'AI_LLM_CONCURRENCY', 4))
+        self._write_lock = threading.Lock()
+
         # Define prompts
         self.qa_prompt = PromptTemplate(
             input_variables=["context", "question"],
@@ -72,11 +90,16 @@ class AIServiceLite:
 最適化されたクエリ（日本語で、簡潔に）："""
         )
     
+    def invoke_llm(self, llm, prompt: str):
+        """LLM呼び出し（同時実行数を AI_LLM_CONCURRENCY に制限）"""
+        with self._llm_slots:
+            return llm.invoke(prompt)
+
     def rewrite_query(self, question: str) -> str:
         """質問をリライト（軽量版）"""
         try:
             prompt = self.rewrite_prompt.format(question=question)
-            response = self.llm_rewrite.invoke(prompt)
+            response = self.invoke_llm(self.llm_rewrite, prompt)
             return response.content.strip()
         except Exception as e:
             print(f"Query rewrite failed: {e}")
@@ -96,19 +119,32 @@ class AIServiceLite:
         if not documents:
             return "申し訳ございません。関連する情報が見つかりませんでした。"
         
-        # ドキュメントのコンテンツを結合
-        context = "\n\n".join([doc.page_content for doc in documents[:5]])
+        # ドキュメントのコンテンツをトークン予算内で結合
+        packed, _ = pack_context(
+            [{'content': doc.page_content, 'metadata': doc.metadata} for doc in documents],
+            getattr(settings, 'CONTEXT_TOKEN_BUDGET', 1500),
+            max_documents=5,
+        )
+        context = "\n\n".join([doc['content'] for doc in packed])
         
         # プロンプトの作成
         prompt = self.qa_prompt.format(context=context, question=question)
         
         try:
-            response = self.llm.invoke(prompt)
+            response = self.invoke_llm(self.llm, prompt)
             return response.content
         except Exception as e:
             return f"回答の生成中にエラーが発生しました: {str(e)}"
     
     def chat(self, question: str) -> str:
+        """メイン処理（プロファイリング対象の場合は計測しながら実行）"""
+        with profiling.profile('chat_lite'):
+            profiling.annotate(question=question)
+            answer = self._chat(question)
+        memory.enforce_budget()
+        return answer
+
+    def _chat(self, question: str) -> str:
         """メイン処理（軽量版）"""
         try:
             # クエリのリライト
@@ -141,8 +177,9 @@ class AIServiceLite:
                 metadatas=[metadata] if metadata else None
             )
             
-            # ベクトルストアに追加
-            self.vector_store.add_documents(documents)
+            # ベクトルストアに追加（同時追加で同じIDやインデックス更新が衝突しないよう直列化）
+            with self._write_lock:
+                self.vector_store.add_documents(documents)
             
             return True
         except Exception as e:
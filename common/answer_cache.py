@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+正規化した質問をキーにした回答のLRUキャッシュ（TTL付き）
+
+上流（OpenAI）が使えない間の縮退モードで、過去に生成した回答を返すために使う。
+店舗のシャードを使った回答は scope（店舗コード）ごとに分け、他の店舗には返さない。
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from common.lexical import normalize_text
+
+
+class AnswerCache:
+    """スレッドセーフなLRU + TTLキャッシュ"""
+
+    def __init__(self, max_entries: int = 500, ttl_s: float = 24 * 60 * 60):
+        self.max_entries = max_entries
+        self.ttl_s = ttl_s
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(question: str, scope: Optional[str] = None) -> str:
+        normalized = normalize_text(question)
+        return f"{scope}\t{normalized}" if scope else normalized
+
+    def get(self, question: str, scope: Optional[str] = None) -> Optional[Dict]:
+        key = self.key(question, scope)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl_s:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, question: str, result: Dict, scope: Optional[str] = None):
+        if self.max_entries <= 0:
+            return
+        key = self.key(question, scope)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def approx_bytes(self) -> int:
+        """キーと回答文字列のおおよそのサイズ（メモリ予算の表示用）"""
+        with self._lock:
+            return sum(sys.getsizeof(key) + sys.getsizeof(result.get('answer', ''))
+                       for key, (_, result) in self._entries.items())
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+上流サービス（OpenAIの埋め込み・LLM）ごとのサーキットブレーカー
+
+closed:    直近 window 件の呼び出しの失敗率が failure_rate 以上（min_calls 件以上）になったら open
+open:      open_seconds の間は上流を呼ばずに CircuitOpen を送出する（即座に縮退モードへ）
+half_open: 試行を probes 件だけ通し、成功すれば closed、失敗すれば再び open
+"""
+import threading
+import time
+from collections import deque
+from typing import Dict
+
+from django.conf import settings
+
+
+class CircuitOpen(Exception):
+    """ブレーカーが開いているため呼び出さなかった"""
+
+
+class CircuitBreaker:
+    """失敗率ウィンドウと半開プローブを持つサーキットブレーカー"""
+
+    def __init__(self, name: str, window: int = 20, min_calls: int = 5, failure_rate: float = 0.5,
+                 open_seconds: float = 30, probes: int = 1):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window)
+        self._probes_in_flight = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, name: str) -> 'CircuitBreaker':
+        return cls(
+            name,
+            window=getattr(settings, 'CIRCUIT_WINDOW', 20),
+            min_calls=getattr(settings, 'CIRCUIT_MIN_CALLS', 5),
+            failure_rate=getattr(settings, 'CIRCUIT_FAILURE_RATE', 0.5),
+            open_seconds=getattr(settings, 'CIRCUIT_OPEN_SECONDS', 30),
+            probes=getattr(settings, 'CIRCUIT_HALF_OPEN_PROBES', 1),
+        )
+
+    def _transition(self, state: str):
+        if state != self.state:
+            print(f"[circuit] {self.name}: {self.state} -> {state}")
+        self.state = state
+        if state == 'open':
+            self.opened_at = time.monotonic()
+            self.times_opened += 1
+            self._probes_in_flight = 0
+        elif state == 'half_open':
+            self._probes_in_flight = 0
+        else:
+            self._outcomes.clear()
+
+    def is_open(self) -> bool:
+        """呼び出しても拒否される状態か（プローブ枠は消費しない）"""
+        with self._lock:
+            if self.state == 'open':
+                return time.monotonic() - self.opened_at < self.open_seconds
+            if self.state == 'half_open':
+                return self._probes_in_flight >= self.probes
+            return False
+
+    def allow(self) -> bool:
+        """呼び出してよいか（half_open ではプローブ枠を1つ消費する）"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open':
+                if time.monotonic() - self.opened_at < self.open_seconds:
+                    self.rejected += 1
+                    return False
+                self._transition('half_open')
+            if self._probes_in_flight < self.probes:
+                self._probes_in_flight += 1
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state == 'half_open':
+                self._transition('closed')
+            else:
+                self._outcomes.append(True)
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == 'half_open':
+                self._transition('open')
+                return
+            self._outcomes.append(False)
+            failures = self._outcomes.count(False)
+            if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.failure_rate:
+                self._transition('open')
+
+    def record_ignored(self):
+        """成功・失敗のどちらとも数えない（締め切りで打ち切った場合など。half_open のプローブ枠だけ返す）"""
+        with self._lock:
+            if self.state == 'half_open' and self._probes_in_flight:
+                self._probes_in_flight -= 1
+
+    def call(self, fn, *args, **kwargs):
+        """ブレーカー越しに fn を呼び出す（例外は失敗として数えて再送出する）"""
+        if not self.allow():
+            raise CircuitOpen(self.name)
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def snapshot(self) -> Dict:
+        with self._lock:
+            total = len(self._outcomes)
+            return {
+                'state': self.state,
+                'window_calls': total,
+                'window_failure_rate': round(self._outcomes.count(False) / total, 3) if total else 0.0,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+            }
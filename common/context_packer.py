@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+回答生成プロンプトに渡すコンテキストのトークン予算内での詰め込み
+
+- スコア順に貪欲に詰め、予算に収まらない文書は文の境界で切り詰める
+- 最上位の文書は必ず入れる（文の境界で収まらなければ文字数で切る）
+- 既に採用した文書とほぼ同じ文書（文字bigramのJaccard係数が閾値以上）は捨てる
+- トークン数は取り込み時に保存した値（メタデータまたは特徴量ストア）を使い、無ければその場で数える
+"""
+import re
+from typing import Dict, List, Tuple
+
+from common.lexical import tokenize
+from common.tokens import count_tokens
+
+SEPARATOR = "\n---\n"
+# 文末（句点・感嘆符・疑問符・改行）で区切る。区切り文字は前の文に含める
+SENTENCE_END = re.compile(r'(?<=[。！？!?\n])')
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s for s in SENTENCE_END.split(text) if s]
+
+
+def document_tokens(doc: Dict) -> int:
+    """取り込み時に計算済みのトークン数（メタデータ → 特徴量ストア。どちらも無ければ数える）"""
+    cached = doc.get('metadata', {}).get('token_count')
+    if cached is None:
+        cached = doc.get('features', {}).get('token_count')
+    return int(cached) if cached is not None else count_tokens(doc['content'])
+
+
+def truncate_to_tokens(text: str, budget: int) -> Tuple[str, int]:
+    """文の境界で budget トークン以内に切り詰める（1文も入らなければ空文字）"""
+    kept, used = [], 0
+    for sentence in split_sentences(text):
+        tokens = count_tokens(sentence)
+        if used + tokens > budget:
+            break
+        kept.append(sentence)
+        used += tokens
+    return "".join(kept).rstrip(), used
+
+
+def hard_truncate(text: str, budget: int) -> Tuple[str, int]:
+    """文の境界に関係なく、budget トークン以内に収まる最長の先頭部分を返す（文字数の二分探索）"""
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(text[:middle]) <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    content = text[:low].rstrip()
+    return content, count_tokens(content)
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def pack_context(documents: List[Dict], budget_tokens: int, max_documents: int = 3,
+                 duplicate_threshold: float = 0.8, min_truncated_tokens: int = 40) -> Tuple[List[Dict], Dict]:
+    """スコア順の文書リストからトークン予算内のコンテキストを組み立てる
+
+    Args:
+        documents: 'content' と 'metadata' を持つ辞書（スコアの高い順）
+        budget_tokens: 文書部分に使えるトークン数（0以下なら無制限）
+        max_documents: 採用する文書数の上限
+        duplicate_threshold: これ以上似ている文書は重複として捨てる
+        min_truncated_tokens: 切り詰めた結果がこれ未満なら採用しない（最上位の文書は文字数で切ってでも採用する）
+
+    Returns:
+        (採用した文書のリスト（切り詰めた場合は content を置き換えた新しい辞書）, 集計)
+    """
+    unlimited = budget_tokens <= 0
+    separator_tokens = count_tokens(SEPARATOR)
+    packed: List[Dict] = []
+    packed_shingles: List[set] = []
+    stats = {'budget_tokens': budget_tokens, 'packed_tokens': 0, 'dropped_tokens': 0,
+             'packed_documents': 0, 'dropped_documents': 0, 'duplicates': 0, 'truncated': 0}
+
+    for doc in documents:
+        tokens = document_tokens(doc)
+        if len(packed) >= max_documents:
+            stats['dropped_tokens'] += tokens
+            stats['dropped_documents'] += 1
+            continue
+
+        shingles = set(tokenize(doc['content']))
+        if any(jaccard(shingles, other) >= duplicate_threshold for other in packed_shingles):
+            stats['duplicates'] += 1
+            stats['dropped_tokens'] += tokens
+            stats['dropped_documents'] += 1
+            continue
+
+        remaining = budget_tokens - stats['packed_tokens'] - (separator_tokens if packed else 0)
+        if unlimited or tokens <= remaining:
+            packed.append(doc)
+            stats['packed_tokens'] += tokens + (separator_tokens if len(packed) > 1 else 0)
+        elif remaining >= min_truncated_tokens or not packed:
+            content, used = truncate_to_tokens(doc['content'], remaining)
+            if used < min_truncated_tokens and not packed:
+                # 文書が1件も無いプロンプトにしないよう、最上位の文書は文字数で切って入れる
+                content, used = hard_truncate(doc['content'], remaining)
+            elif used < min_truncated_tokens:
+                stats['dropped_tokens'] += tokens
+                stats['dropped_documents'] += 1
+                continue
+            packed.append({**doc, 'content': content, 'truncated': True})
+            stats['packed_tokens'] += used + (separator_tokens if len(packed) > 1 else 0)
+            stats['dropped_tokens'] += tokens - used
+            stats['truncated'] += 1
+        else:
+            stats['dropped_tokens'] += tokens
+            stats['dropped_documents'] += 1
+            continue
+        packed_shingles.append(shingles)
+
+    stats['packed_documents'] = len(packed)
+    return packed, stats
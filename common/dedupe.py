@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+取り込み時のほぼ重複したレコードの検出と集約
+
+- 正規化した本文の文字3-gramからMinHash署名を作り、LSH（バンド分割）で候補ペアを絞る
+- 推定Jaccard係数が threshold 以上なら重複とみなす
+- candidate_floor 以上 threshold 未満のペアは、埋め込みのコサイン類似度が embedding_threshold 以上なら重複とみなす
+- 本文に出てくる数字の並び（単位に関係なく、日付・部屋番号・階・電話番号なども含む）が違うペアは、
+  文面が似ていても重複としない（3,000円 と 5,500円 の料金、2階 と 3階 の案内など）
+- 最初に出現したレコードを正として残し、正のレコードと直接重複と判定されたレコードだけをまとめる
+  （A〜B・B〜C の連鎖で A と C をまとめない）。まとめたレコードの質問（タイトル）は正のレコードの別名にする
+
+ファイルを何度か読み直す（署名 → 埋め込み確認 → 集約）ので、保持するのは署名と見出しだけで済む。
+"""
+import re
+import unicodedata
+import zlib
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from common.lexical import normalize_text
+
+# 数字の並び（3,000 や 10.5 は1つの数として読む）
+DIGITS_PATTERN = re.compile(r'\d+(?:[.,]\d+)*')
+
+# ハッシュ値（32bit）より大きい素数。a・b・ハッシュ値がいずれも2^32未満なら a*h+b は uint64 に収まる
+PRIME = np.uint64(4294967311)
+
+
+def digit_sequences(text: str) -> frozenset:
+    """本文に出てくる数字の集合（全角は半角に揃え、桁区切りのカンマは除く）"""
+    normalized = unicodedata.normalize('NFKC', text)
+    return frozenset(match.replace(',', '') for match in DIGITS_PATTERN.findall(normalized))
+
+
+def shingles(text: str, size: int = 3) -> List[str]:
+    compact = normalize_text(text)
+    if len(compact) <= size:
+        return [compact] if compact else []
+    return [compact[i:i + size] for i in range(len(compact) - size + 1)]
+
+
+class MinHasher:
+    """文字n-gram集合のMinHash署名"""
+
+    def __init__(self, num_perm: int = 64, shingle_size: int = 3, seed: int = 1):
+        rng = np.random.RandomState(seed)
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.a = rng.randint(1, 2 ** 32 - 1, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, 2 ** 32 - 1, size=num_perm, dtype=np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        hashes = np.array(sorted({zlib.crc32(s.encode('utf-8')) for s in shingles(text, self.shingle_size)}),
+                          dtype=np.uint64)
+        if not len(hashes):
+            return np.full(self.num_perm, int(PRIME), dtype=np.uint64)
+        return ((np.outer(hashes, self.a) + self.b) % PRIME).min(axis=0)
+
+
+def estimated_jaccard(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    return float(np.mean(sig_a == sig_b))
+
+
+def cosine(a: List[float], b: List[float]) -> float:
+    a, b = np.asarray(a), np.asarray(b)
+    denom = np.linalg.norm(a) * np.linalg.norm(b)
+    return float(a @ b / denom) if denom else 0.0
+
+
+def record_label(record: Dict) -> str:
+    """別名として残す見出し（QAなら質問、ガイドラインならタイトル）"""
+    metadata = record['metadata']
+    return metadata.get('question') or metadata.get('title') or record['content'].split('\n', 1)[0]
+
+
+class DuplicatePlan:
+    """重複ID → 正のID と、正のID → 別名 の対応"""
+
+    def __init__(self, canonical_of: Dict[str, str], aliases: Dict[str, List[str]], checked_by_embedding: int = 0):
+        self.canonical_of = canonical_of
+        self.aliases = aliases
+        self.checked_by_embedding = checked_by_embedding
+
+    def summary(self) -> str:
+        return (f"collapsed {len(self.canonical_of)} near-duplicates into {len(self.aliases)} canonical records "
+                f"({self.checked_by_embedding} pairs checked by embedding)")
+
+
+def find_duplicates(records_factory: Callable[[], Iterable[Dict]], embeddings=None, threshold: float = 0.8,
+                    candidate_floor: float = 0.5, embedding_threshold: float = 0.95,
+                    hasher: Optional[MinHasher] = None, bands: int = 16) -> DuplicatePlan:
+    """ほぼ重複したレコードを求める
+
+    Args:
+        records_factory: 同期用レコードのイテレータを毎回新しく返す関数（ファイルを読み直す）
+        embeddings: グレーゾーンのペアの確認に使う埋め込み（None なら MinHash だけで判定）
+    """
+    hasher = hasher or MinHasher()
+    rows = hasher.num_perm // bands
+    ids: List[str] = []
+    labels: List[str] = []
+    signatures: List[np.ndarray] = []
+    numbers: List[frozenset] = []
+    buckets: Dict[Tuple[int, bytes], List[int]] = defaultdict(list)
+    for record in records_factory():
+        index = len(ids)
+        signature = hasher.signature(record['content'])
+        ids.append(record['id'])
+        labels.append(record_label(record))
+        signatures.append(signature)
+        numbers.append(digit_sequences(record['content']))
+        for band in range(bands):
+            buckets[(band, signature[band * rows:(band + 1) * rows].tobytes())].append(index)
+
+    duplicate_pairs, gray_pairs = [], []
+    seen_pairs = set()
+    for members in buckets.values():
+        for i, left in enumerate(members):
+            for right in members[i + 1:]:
+                if (left, right) in seen_pairs:
+                    continue
+                seen_pairs.add((left, right))
+                if numbers[left] != numbers[right]:
+                    continue
+                similarity = estimated_jaccard(signatures[left], signatures[right])
+                if similarity >= threshold:
+                    duplicate_pairs.append((left, right))
+                elif similarity >= candidate_floor:
+                    gray_pairs.append((left, right))
+
+    if gray_pairs and embeddings is not None:
+        # グレーゾーンのレコードだけ本文を読み直して埋め込む（取り込み時と同じキャッシュに入る）
+        wanted = {ids[i] for pair in gray_pairs for i in pair}
+        contents = {record['id']: record['content'] for record in records_factory() if record['id'] in wanted}
+        order = list(contents)
+        vectors = dict(zip(order, embeddings.embed_documents([contents[doc_id] for doc_id in order])))
+        for left, right in gray_pairs:
+            if cosine(vectors[ids[left]], vectors[ids[right]]) >= embedding_threshold:
+                duplicate_pairs.append((left, right))
+
+    # 出現順に、まだまとめられていないレコードを正とし、正と直接重複のレコードだけをまとめる
+    neighbors: Dict[int, List[int]] = defaultdict(list)
+    for left, right in duplicate_pairs:
+        neighbors[min(left, right)].append(max(left, right))
+
+    canonical_of: Dict[str, str] = {}
+    aliases: Dict[str, List[str]] = {}
+    merged = set()
+    for root in range(len(ids)):
+        if root in merged:
+            continue
+        for i in sorted(neighbors.get(root, ())):
+            if i in merged:
+                continue
+            merged.add(i)
+            canonical_of[ids[i]] = ids[root]
+            names = aliases.setdefault(ids[root], [])
+            if labels[i] != labels[root] and labels[i] not in names:
+                names.append(labels[i])
+    return DuplicatePlan(canonical_of, dict(aliases), checked_by_embedding=len(gray_pairs) if embeddings else 0)
+
+
+def collapse_duplicates(records: Iterable[Dict], plan: DuplicatePlan) -> Iterator[Dict]:
+    """重複レコードを除き、正のレコードに別名を付けて返す
+
+    QAでは別名の質問を本文の質問行の次に「別の聞き方:」として加え、別の言い回しでも検索に掛かるようにする。
+    """
+    for record in records:
+        if record['id'] in plan.canonical_of:
+            continue
+        if record['id'] not in plan.aliases:
+            yield record
+            continue
+        aliases = plan.aliases[record['id']]
+        metadata = dict(record['metadata'])
+        metadata['alias_questions'] = "\n".join(aliases)
+        content = record['content']
+        if aliases and metadata.get('question'):
+            first, _, rest = content.partition('\n')
+            content = f"{first}\n別の聞き方: {' / '.join(aliases)}" + (f"\n{rest}" if rest else "")
+        yield {'id': record['id'], 'content': content, 'metadata': metadata}
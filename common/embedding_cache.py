@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+埋め込みベクトルの永続キャッシュ（取り込みの再実行で同じ本文を再度埋め込まない）
+
+キーは (モデル名, 本文のSHA-256)。IDではなく本文で引くので、ブロックの挿入でIDがずれても
+本文が変わっていなければOpenAIには送らない。
+SQLite（既定: wdb/embeddings.sqlite3）に float32 のバイト列で保存する。
+キャッシュするのはドキュメント（embed_documents）だけで、検索クエリ（embed_query）は毎回そのまま埋め込む。
+
+使い方:
+    embeddings = CachedEmbeddings(OpenAIEmbeddings(model="text-embedding-3-small"), "text-embedding-3-small")
+    vectors = embeddings.embed_documents(texts)
+    print(embeddings.summary())   # 実行ごとのヒット率
+"""
+import os
+import sqlite3
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from langchain_core.embeddings import Embeddings
+
+from common.features import content_hash
+
+
+def embedding_cache_path() -> str:
+    return str(getattr(settings, 'EMBEDDING_CACHE_PATH', os.path.join(settings.BASE_DIR, 'wdb', 'embeddings.sqlite3')))
+
+
+class EmbeddingCache:
+    """(モデル名, 本文ハッシュ) → ベクトル のSQLiteストア（スレッド間で1接続を共有）"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or embedding_cache_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                PRIMARY KEY (model, content_hash)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get_many(self, model: str, hashes: Iterable[str]) -> Dict[str, List[float]]:
+        hashes = list(dict.fromkeys(hashes))
+        results = {}
+        with self._lock:
+            # SQLiteのバインド変数の上限を超えないよう分割して問い合わせる
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT content_hash, vector FROM embeddings WHERE model = ? AND content_hash IN ({placeholders})",
+                    [model, *chunk]
+                ).fetchall()
+                for digest, blob in rows:
+                    results[digest] = array('f', blob).tolist()
+        return results
+
+    def put_many(self, model: str, items: Dict[str, List[float]]):
+        rows = [(model, digest, array('f', vector).tobytes()) for digest, vector in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """埋め込みクライアントをキャッシュで包む（Chromaの embedding_function にもそのまま渡せる）"""
+
+    def __init__(self, embeddings: Embeddings, model: str, cache: Optional[EmbeddingCache] = None):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache or EmbeddingCache()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        hashes = [content_hash(text) for text in texts]
+        cached = self.cache.get_many(self.model, hashes)
+        # 同じ本文が1バッチに複数あっても1回だけ送る
+        missing = {digest: text for digest, text in zip(hashes, texts) if digest not in cached}
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            fresh = dict(zip(missing.keys(), vectors))
+            self.cache.put_many(self.model, fresh)
+            cached.update(fresh)
+        with self._lock:
+            self.misses += len(missing)
+            self.hits += len(texts) - len(missing)
+        return [cached[digest] for digest in hashes]
+
+    def embed_query(self, text: str) -> List[float]:
+        """検索クエリの埋め込み（キャッシュしない。ヒット率の集計にも含めない）
+
+        クエリは使い捨てで同じ文が繰り返されることが少なく、利用者の入力をディスクに残さないため。
+        """
+        return self.embeddings.embed_query(text)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def summary(self) -> str:
+        stats = self.stats()
+        return (f"embedding cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"(hit rate {stats['hit_rate']:.1%})")
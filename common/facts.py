@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+"""
+数値ファクトのインデックス（取り込み時に抽出）
+
+マニュアル中の「(主題となる語, 数値, 単位, 出典ID)」を文単位で抽出して特徴量ストアに保存し、
+起動時にメモリ上の転置インデックスへ読み込む。
+
+- 「チェックアウトは何時？」「延長料金はいくら？」のような数値を聞く質問に、
+  LLMを呼ばずにファクトの文をそのまま返す（高速パス）。対象はQAの回答の文だけで、
+  質問とそのQAの質問の主題bigramが双方向に min_score 以上重なる場合に限る
+  （「チェックアウト」を含むだけの別の話題の文を返さないため）
+- 確信度チェックの矛盾判定（特徴量ストアの numeric_facts）も同じ FACT_PATTERN で抽出し、
+  facts_contradict() で比べる（抽出の仕方で同じ文書の組の判定が変わらないように）
+"""
+import re
+import unicodedata
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from common.context_packer import split_sentences
+from common.lexical import tokenize
+
+# 数値（「2,000」のような桁区切りも1つの数値として読む）
+NUMBER = r'(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+)?'
+# 数値と単位（「時間」を「時」より先に照合する）
+FACT_PATTERN = re.compile(rf'({NUMBER})\s*(時間|時|分|円|%|枚|個)')
+
+# QAの本文（質問: ...\n\n回答: ...）
+QA_PATTERN = re.compile(r'^質問\s*:\s*(.*?)\n+回答\s*:\s*(.*)$', re.S)
+
+# QAの本文に付いている見出し（回答文として返すときは除く）
+LABEL_PATTERN = re.compile(r'^(質問|回答)\s*:\s*')
+
+# 質問が求めている単位
+QUESTION_UNITS = [
+    ('時間', re.compile(r'何時間|どのくらいの時間|どれくらいの時間')),
+    ('時', re.compile(r'何時')),
+    ('分', re.compile(r'何分')),
+    # 「料金」「価格」などの名詞だけでは金額を聞いているとは限らない（「料金プランの違いは？」）
+    ('円', re.compile(r'いくら|何円')),
+    ('%', re.compile(r'何%|何パーセント|割引率')),
+    ('枚', re.compile(r'何枚')),
+    ('個', re.compile(r'何個')),
+]
+
+# 主題語の照合から除く疑問・依頼表現
+QUESTION_NOISE = re.compile(
+    r'何時間|どのくらいの時間|どれくらいの時間|何時|何分|いくら|何円|何%|何パーセント|何枚|何個'
+    r'|ですか|ますか|でしょうか|を教えて(ください|下さい)?|教えて|について|[?？。、]'
+)
+
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize('NFKC', text)
+
+
+def fact_value(number: str) -> str:
+    """桁区切りを除いた数値の文字列（「2,000」→「2000」）"""
+    return number.replace(',', '')
+
+
+def extract_numeric_facts(text: str) -> List[Tuple[str, str]]:
+    """本文中の (数値, 単位) の組を重複なしで返す（全角数字・桁区切りは揃える）"""
+    return sorted({(fact_value(value), unit) for value, unit in FACT_PATTERN.findall(normalize(text))})
+
+
+def facts_contradict(facts_a: Iterable[Tuple[str, str]], facts_b: Iterable[Tuple[str, str]]) -> bool:
+    """同じ単位で異なる数値を持つか（どちらかの組で単位が同じで数値が違うものがあれば矛盾）"""
+    units_a: Dict[str, set] = defaultdict(set)
+    for value, unit in facts_a:
+        units_a[unit].add(value)
+    for value, unit in facts_b:
+        if units_a.get(unit, {value}) - {value}:
+            return True
+    return False
+
+
+def question_tokens(question: str) -> List[str]:
+    """疑問・依頼表現を除いた質問の主題bigram"""
+    return sorted(set(tokenize(QUESTION_NOISE.sub('', normalize(question)))))
+
+
+def extract_facts(content: str) -> List[Dict]:
+    """本文を文に分け、数値を含む文ごとにファクトを抽出する
+
+    QAの回答の文のファクトには、そのQAの質問の主題bigram（question_tokens）を付ける。
+    高速パスで返すのはこれが付いたファクトだけ。
+    """
+    content = normalize(content)
+    match = QA_PATTERN.match(content)
+    if match:
+        parts = [(match.group(1), []), (match.group(2), question_tokens(match.group(1)))]
+    else:
+        parts = [(content, [])]
+    facts = []
+    for text, qa_tokens in parts:
+        for sentence in split_sentences(text):
+            sentence = LABEL_PATTERN.sub('', sentence.strip())
+            matches = FACT_PATTERN.findall(sentence)
+            if not matches:
+                continue
+            subject = FACT_PATTERN.sub('', sentence)
+            tokens = sorted(set(tokenize(subject)))
+            for value, unit in dict.fromkeys((fact_value(value), unit) for value, unit in matches):
+                facts.append({'value': value, 'unit': unit, 'sentence': sentence, 'subject_tokens': tokens,
+                              'question_tokens': qa_tokens})
+    return facts
+
+
+def expected_unit(question: str) -> Optional[str]:
+    """数値を聞く質問なら求めている単位を返す"""
+    question = normalize(question)
+    for unit, pattern in QUESTION_UNITS:
+        if pattern.search(question):
+            return unit
+    return None
+
+
+class FactIndex:
+    """単位ごとの QAの質問bigram → ファクト の転置インデックス"""
+
+    def __init__(self, facts: List[Dict]):
+        """
+        Args:
+            facts: doc_id / value / unit / sentence / subject_tokens / question_tokens / source を持つ辞書のリスト
+        """
+        self.facts = facts
+        self._postings: Dict[str, Dict[str, List[int]]] = defaultdict(lambda: defaultdict(list))
+        for i, fact in enumerate(facts):
+            # QAの回答以外のファクトは索引に入れない
+            for token in fact.get('question_tokens') or ():
+                self._postings[fact['unit']][token].append(i)
+
+    @classmethod
+    def from_store(cls, feature_store) -> 'FactIndex':
+        """特徴量ストア（common.features.FeatureStore）に保存済みのファクトから構築する"""
+        return cls(feature_store.load_facts())
+
+    def __len__(self) -> int:
+        return len(self.facts)
+
+    def lookup(self, question: str, min_score: float = 0.8, margin: float = 0.1) -> Optional[Dict]:
+        """数値を聞く質問に一意に対応するファクトを返す（曖昧・該当なしなら None）
+
+        スコアは 質問の主題bigramのうちQAの質問に含まれる割合 と
+        QAの質問の主題bigramのうち質問に含まれる割合 の小さい方（双方向の重なり）。
+        別の値を持つファクトが margin 以内のスコアで競合する場合は答えない。
+        """
+        unit = expected_unit(question)
+        if unit is None or unit not in self._postings:
+            return None
+        query_tokens = set(question_tokens(question))
+        if not query_tokens:
+            return None
+        postings = self._postings[unit]
+        hits: Dict[int, int] = defaultdict(int)
+        for token in query_tokens:
+            for i in postings.get(token, ()):
+                hits[i] += 1
+        if not hits:
+            return None
+        scores = {
+            i: min(count / len(query_tokens), count / len(self.facts[i]['question_tokens']))
+            for i, count in hits.items()
+        }
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        best_index, best_score = ranked[0]
+        if best_score < min_score:
+            return None
+        best = self.facts[best_index]
+        for i, score in ranked[1:]:
+            if score < best_score - margin:
+                break
+            if self.facts[i]['value'] != best['value']:
+                return None
+        return dict(best, score=round(best_score, 3))
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+ドキュメントごとの派生特徴量（取り込み時に計算するサイドカーストア）
+
+取り込み（load_qa_data / import_guidelines）で1回だけ計算し、ドキュメントIDをキーに
+SQLite（既定: wdb/features.sqlite3）へ保存する。検索時のステージはここから読むだけで、
+本文の正規化・数値抽出・トークン化をやり直さない。
+
+特徴量:
+    content_hash:   本文のSHA-256
+    normalized:     正規化済みテキスト（common.lexical.normalize_text）
+    numeric_facts:  (数値, 単位) の組（確信度チェックの矛盾判定用）
+    token_count:    tiktokenでのトークン数（コンテキスト詰め込み用）
+    lexical_tokens: 文字bigram（語彙検索インデックス用）
+
+同じファイルの facts テーブルには数値ファクト（common.facts）を文単位で保存する。
+centroids テーブルには 種別/カテゴリ ごとの埋め込みのセントロイド（common.router）を保存する。
+meta テーブルの facts_version はファクトを書き換えるたびに増やす（稼働中のプロセスが読み直すかの判定用）。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+from common.facts import extract_facts, extract_numeric_facts
+from common.lexical import normalize_text, tokenize
+from common.tokens import count_tokens
+
+# 特徴量の計算方法の版（変えたら上げる。古い版のストアは次の取り込みで作り直す）
+# 2: numeric_facts を common.facts.FACT_PATTERN で抽出（「時間」を「時」「間」に分けない）
+FEATURES_VERSION = 2
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def compute_features(content: str) -> Dict:
+    """1ドキュメント分の特徴量を計算する"""
+    return {
+        'content_hash': content_hash(content),
+        'normalized': normalize_text(content),
+        'numeric_facts': extract_numeric_facts(content),
+        'token_count': count_tokens(content),
+        'lexical_tokens': tokenize(content),
+    }
+
+
+def feature_store_path() -> str:
+    return str(getattr(settings, 'FEATURE_STORE_PATH', os.path.join(settings.BASE_DIR, 'wdb', 'features.sqlite3')))
+
+
+class FeatureStore:
+    """ドキュメントID → 特徴量 のSQLiteストア（スレッド間で1接続を共有）"""
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or feature_store_path()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS document_features (
+                id TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                normalized TEXT NOT NULL,
+                numeric_facts TEXT NOT NULL,
+                token_count INTEGER NOT NULL,
+                lexical_tokens TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS facts (
+                doc_id TEXT NOT NULL,
+                value TEXT NOT NULL,
+                unit TEXT NOT NULL,
+                sentence TEXT NOT NULL,
+                subject_tokens TEXT NOT NULL,
+                source TEXT NOT NULL,
+                question_tokens TEXT NOT NULL DEFAULT '[]'
+            )
+            """
+        )
+        self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self._migrate_facts()
+        self._migrate_features()
+        self._conn.execute("CREATE INDEX IF NOT EXISTS facts_doc_id ON facts (doc_id)")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS centroids (
+                label TEXT PRIMARY KEY,
+                doc_type TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                vector BLOB NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def _migrate_facts(self):
+        """question_tokens の無い古いストアは列を足し、特徴量を消して次の取り込みで作り直させる
+
+        （数値の読み方も変わったので、残っている numeric_facts・ファクトは使わない）
+        """
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(facts)")]
+        if 'question_tokens' in columns:
+            return
+        print("Feature store schema changed: features will be recomputed on the next ingest")
+        self._conn.execute("ALTER TABLE facts ADD COLUMN question_tokens TEXT NOT NULL DEFAULT '[]'")
+        self._conn.execute("DELETE FROM facts")
+        self._conn.execute("DELETE FROM document_features")
+        self._bump_facts_version()
+
+    def _migrate_features(self):
+        """計算方法の版が古い特徴量を消して、次の取り込みで作り直させる（backfill_features が補う）"""
+        version = self._conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= FEATURES_VERSION:
+            return
+        if self._conn.execute("SELECT 1 FROM document_features LIMIT 1").fetchone():
+            print("Feature extraction changed: features will be recomputed on the next ingest")
+            self._conn.execute("DELETE FROM facts")
+            self._conn.execute("DELETE FROM document_features")
+            self._bump_facts_version()
+        self._conn.execute(f"PRAGMA user_version = {FEATURES_VERSION}")
+
+    def _bump_facts_version(self):
+        """ファクトを書き換えたことを記録する（書き換えと同じトランザクションで呼ぶ）"""
+        self._conn.execute(
+            "INSERT INTO meta VALUES ('facts_version', 1) ON CONFLICT(key) DO UPDATE SET value = value + 1"
+        )
+
+    def facts_version(self) -> int:
+        """ファクトの版（別プロセスの取り込みで書き換えられても増える）"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'facts_version'").fetchone()
+        return row[0] if row else 0
+
+    def upsert(self, items: Iterable[Tuple[str, str, str]]) -> int:
+        """(ドキュメントID, 本文, 出典) の組の特徴量とファクトを計算して保存する"""
+        rows = []
+        fact_rows = []
+        for doc_id, content, source in items:
+            features = compute_features(content)
+            for fact in extract_facts(content):
+                fact_rows.append((doc_id, fact['value'], fact['unit'], fact['sentence'],
+                                  json.dumps(fact['subject_tokens'], ensure_ascii=False), source or '',
+                                  json.dumps(fact['question_tokens'], ensure_ascii=False)))
+            rows.append((
+                doc_id,
+                features['content_hash'],
+                features['normalized'],
+                json.dumps(features['numeric_facts'], ensure_ascii=False),
+                features['token_count'],
+                json.dumps(features['lexical_tokens'], ensure_ascii=False),
+            ))
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO document_features VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+            self._conn.executemany("DELETE FROM facts WHERE doc_id = ?", [(row[0],) for row in rows])
+            self._conn.executemany("INSERT INTO facts VALUES (?, ?, ?, ?, ?, ?, ?)", fact_rows)
+            self._bump_facts_version()
+            self._conn.commit()
+        return len(rows)
+
+    def load_facts(self) -> List[Dict]:
+        """保存済みの全ファクト（common.facts.FactIndex の構築用）"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT doc_id, value, unit, sentence, subject_tokens, source, question_tokens FROM facts"
+            ).fetchall()
+        return [
+            {'doc_id': row[0], 'value': row[1], 'unit': row[2], 'sentence': row[3],
+             'subject_tokens': json.loads(row[4]), 'source': row[5], 'question_tokens': json.loads(row[6])}
+            for row in rows
+        ]
+
+    def replace_centroids(self, centroids: Iterable[Tuple[str, str, int, np.ndarray]]):
+        """(ラベル, 種別, 件数, ベクトル) の組でセントロイドを置き換える"""
+        rows = [(label, doc_type, count, np.asarray(vector, dtype=np.float32).tobytes())
+                for label, doc_type, count, vector in centroids]
+        with self._lock:
+            self._conn.execute("DELETE FROM centroids")
+            self._conn.executemany("INSERT INTO centroids VALUES (?, ?, ?, ?)", rows)
+            self._conn.commit()
+
+    def load_centroids(self) -> List[Tuple[str, str, int, np.ndarray]]:
+        """保存済みのセントロイド（common.router.IntentRouter の構築用）"""
+        with self._lock:
+            rows = self._conn.execute("SELECT label, doc_type, count, vector FROM centroids ORDER BY label").fetchall()
+        return [(label, doc_type, count, np.frombuffer(vector, dtype=np.float32))
+                for label, doc_type, count, vector in rows]
+
+    def get_many(self, ids: Iterable[str], lexical: bool = False) -> Dict[str, Dict]:
+        """IDごとの特徴量（lexical=True のときだけ lexical_tokens も読む）"""
+        ids = [doc_id for doc_id in ids if doc_id]
+        if not ids:
+            return {}
+        columns = "id, content_hash, normalized, numeric_facts, token_count" + (", lexical_tokens" if lexical else "")
+        results = {}
+        with self._lock:
+            # SQLiteのバインド変数の上限を超えないよう分割して問い合わせる
+            for i in range(0, len(ids), 500):
+                chunk = ids[i:i + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = self._conn.execute(
+                    f"SELECT {columns} FROM document_features WHERE id IN ({placeholders})", chunk
+                ).fetchall()
+                for row in rows:
+                    features = {
+                        'content_hash': row[1],
+                        'normalized': row[2],
+                        'numeric_facts': [tuple(fact) for fact in json.loads(row[3])],
+                        'token_count': row[4],
+                    }
+                    if lexical:
+                        features['lexical_tokens'] = json.loads(row[5])
+                    results[row[0]] = features
+        return results
+
+    def delete(self, ids: Iterable[str]):
+        ids = list(ids)
+        with self._lock:
+            self._conn.executemany("DELETE FROM document_features WHERE id = ?", [(doc_id,) for doc_id in ids])
+            self._conn.executemany("DELETE FROM facts WHERE doc_id = ?", [(doc_id,) for doc_id in ids])
+            self._bump_facts_version()
+            self._conn.commit()
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM document_features")
+            self._conn.execute("DELETE FROM facts")
+            self._conn.execute("DELETE FROM centroids")
+            self._bump_facts_version()
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+LLM呼び出しのヘッジ（投機的な重複リクエスト）とリトライ
+
+- 直近のレイテンシの HEDGE_PERCENTILE パーセンタイルを過ぎても応答が無ければ、
+  同じリクエストをもう1本送り、先に返った方を採用する（遅い方は結果を捨てる）
+- 実行中のリクエストは取り消せない（負けた側も最後まで走る）ので、ヘッジ用スレッドが
+  埋まっている場合や、LLMの同時実行枠（AI_LLM_CONCURRENCY）に空きが無い場合はヘッジを送らない
+  （過負荷時にヘッジが枠を奪い合って遅延を悪化させない）
+- レート制限・タイムアウト・接続エラー・5xxは、ジッター付き指数バックオフで
+  締め切りに収まる範囲でリトライする
+- ヘッジ率と、ヘッジで短縮できた時間（負けた側の完了時刻との差）を集計する
+"""
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Optional
+
+from django.conf import settings
+
+from common import profiling
+from common.timing import Deadline, percentile, summarize_latencies
+
+try:
+    import openai
+    RETRYABLE_ERRORS = (openai.RateLimitError, openai.APITimeoutError,
+                        openai.APIConnectionError, openai.InternalServerError,
+                        TimeoutError, ConnectionError)
+except ImportError:
+    RETRYABLE_ERRORS = (TimeoutError, ConnectionError)
+
+
+class HedgedCaller:
+    """1つの上流（リライト用LLM・回答用LLM）に対するヘッジとリトライ"""
+
+    def __init__(self, name: str, hedge_percentile: float = 90, min_samples: int = 20,
+                 min_delay_s: float = 0.3, max_retries: int = 2, backoff_s: float = 0.25,
+                 max_workers: int = 8, window: int = 200):
+        self.name = name
+        self.hedge_percentile = hedge_percentile
+        self.min_samples = min_samples
+        self.min_delay_s = min_delay_s
+        self.max_retries = max_retries
+        self.backoff_s = backoff_s
+        self.max_workers = max_workers
+        self._in_flight = 0
+        self._latencies = deque(maxlen=window)
+        self._saved_ms = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"hedge-{name}")
+        self.reset_stats()
+
+    @classmethod
+    def from_settings(cls, name: str) -> 'HedgedCaller':
+        return cls(
+            name,
+            hedge_percentile=getattr(settings, 'HEDGE_PERCENTILE', 90),
+            min_samples=getattr(settings, 'HEDGE_MIN_SAMPLES', 20),
+            min_delay_s=getattr(settings, 'HEDGE_MIN_DELAY_S', 0.3),
+            max_retries=getattr(settings, 'LLM_MAX_RETRIES', 2),
+            backoff_s=getattr(settings, 'LLM_RETRY_BACKOFF_S', 0.25),
+            max_workers=getattr(settings, 'HEDGE_MAX_WORKERS', 8),
+        )
+
+    def reset_stats(self):
+        with self._lock:
+            self.calls = 0
+            self.hedged = 0
+            self.hedge_wins = 0
+            self.hedges_skipped = 0
+            self.retries = 0
+            self._saved_ms.clear()
+
+    def hedge_delay(self) -> Optional[float]:
+        """ヘッジを送るまでの待ち時間（秒）。サンプル不足・無効時は None"""
+        if self.hedge_percentile <= 0:
+            return None
+        with self._lock:
+            if len(self._latencies) < self.min_samples:
+                return None
+            delay = percentile(list(self._latencies), self.hedge_percentile)
+        return max(delay, self.min_delay_s)
+
+    def call(self, fn: Callable, *args, deadline: Optional[Deadline] = None,
+             has_capacity: Optional[Callable[[], bool]] = None):
+        """fn(*args) をヘッジ・リトライ付きで実行する
+
+        Args:
+            has_capacity: ヘッジを送る直前に呼ぶ。False ならヘッジを送らずに元のリクエストを待つ
+        """
+        with self._lock:
+            self.calls += 1
+        attempt = 0
+        while True:
+            try:
+                return self._hedged(fn, args, deadline, has_capacity)
+            except RETRYABLE_ERRORS as e:
+                # ジッター付き指数バックオフ（締め切りを越えるならリトライしない）
+                wait_s = self.backoff_s * (2 ** attempt) * random.uniform(0.5, 1.5)
+                if attempt >= self.max_retries or (deadline is not None and not deadline.allows(wait_s)):
+                    raise
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                print(f"Retrying {self.name} after {type(e).__name__} ({attempt}/{self.max_retries})")
+                time.sleep(wait_s)
+
+    def _submit(self, fn: Callable, args: tuple):
+        with self._lock:
+            self._in_flight += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _can_hedge(self, has_capacity: Optional[Callable[[], bool]]) -> bool:
+        """ヘッジ用スレッドと上流の同時実行枠に空きがあるか（無ければスキップとして数える）"""
+        with self._lock:
+            free_worker = self._in_flight < self.max_workers
+        if free_worker and (has_capacity is None or has_capacity()):
+            return True
+        with self._lock:
+            self.hedges_skipped += 1
+        return False
+
+    def _hedged(self, fn: Callable, args: tuple, deadline: Optional[Deadline],
+                has_capacity: Optional[Callable[[], bool]] = None):
+        # 計測中ならヘッジ用スレッドでのLLM呼び出しもプロファイルに含める
+        fn = profiling.bind(fn)
+        primary_start = time.perf_counter()
+        primary = self._submit(fn, args)
+        primary.add_done_callback(lambda f: self._record_latency(f, primary_start))
+
+        delay = self.hedge_delay()
+        if delay is None or (deadline is not None and not deadline.allows(delay)):
+            return primary.result()
+        done, _ = wait([primary], timeout=delay)
+        if done or not self._can_hedge(has_capacity):
+            return primary.result()
+
+        with self._lock:
+            self.hedged += 1
+        hedge = self._submit(fn, args)
+        pending = {primary, hedge}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    continue
+                # 負けた側は実行中なら取り消せず最後まで走る（結果は捨てる）。ヘッジ前の空き確認で数を抑える
+                if future is hedge:
+                    won_at = time.perf_counter()
+                    with self._lock:
+                        self.hedge_wins += 1
+                    # 短縮時間は負けた（元の）リクエストが終わった時点で記録する
+                    primary.add_done_callback(lambda f: self._record_saved(won_at))
+                return future.result()
+        # 両方失敗した場合は元のリクエストの例外を送出する
+        return primary.result()
+
+    def _record_latency(self, future, started: float):
+        if not future.cancelled() and future.exception() is None:
+            with self._lock:
+                self._latencies.append(time.perf_counter() - started)
+
+    def _record_saved(self, won_at: float):
+        with self._lock:
+            self._saved_ms.append((time.perf_counter() - won_at) * 1000)
+
+    def stats(self) -> Dict:
+        delay = self.hedge_delay()
+        with self._lock:
+            return {
+                'calls': self.calls,
+                'hedged': self.hedged,
+                'hedge_rate': round(self.hedged / self.calls, 4) if self.calls else 0.0,
+                'hedge_wins': self.hedge_wins,
+                'hedges_skipped': self.hedges_skipped,
+                'retries': self.retries,
+                'hedge_delay_ms': round(delay * 1000, 1) if delay is not None else None,
+                'saved_ms': summarize_latencies(list(self._saved_ms)),
+            }
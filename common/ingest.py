@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+埋め込みの一括・並列計算とChromaへの一括書き込み（取り込みコマンド共通）
+
+- トークン数で区切ったバッチを並列に埋め込みAPIへ送る
+- レート制限などの一時的なエラーはジッター付き指数バックオフ（Retry-Afterがあれば優先）で再試行する
+- 計算済みのベクトルを大きな単位で collection.upsert に渡す
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+from chromadb import PersistentClient
+from django.conf import settings
+from langchain_openai import OpenAIEmbeddings
+
+from common.embedding_cache import CachedEmbeddings
+from common.hedging import RETRYABLE_ERRORS
+from common.tokens import count_tokens
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+
+def ingest_embeddings() -> CachedEmbeddings:
+    """取り込み用の埋め込みクライアント（キャッシュ付き。リトライは embed_with_retry が行う）"""
+    return CachedEmbeddings(
+        OpenAIEmbeddings(api_key=settings.OPENAI_API_KEY, model=EMBEDDING_MODEL, max_retries=0),
+        EMBEDDING_MODEL
+    )
+
+
+def iter_collection(collection, include: List[str], page_size: int = 1000) -> Iterator[Dict]:
+    """コレクションの全件を page_size 件ずつ読む（collection.get() の結果をページごとに返す）"""
+    offset = 0
+    while True:
+        page = collection.get(include=include, limit=page_size, offset=offset)
+        if not len(page['ids']):
+            return
+        yield page
+        offset += len(page['ids'])
+
+
+def open_collection(path: str = "./wdb", name: str = "wdb", metadata: Optional[Dict] = None):
+    """取り込み先のChromaコレクション（無ければ作る）"""
+    return PersistentClient(path=path).get_or_create_collection(name, metadata=metadata)
+
+
+def token_batches(token_counts: Sequence[int], max_tokens: int, max_items: int = 2048) -> List[List[int]]:
+    """合計トークン数が max_tokens を超えないようにインデックスをバッチへ分ける"""
+    batches, current, current_tokens = [], [], 0
+    for i, tokens in enumerate(token_counts):
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_items):
+            batches.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """APIエラーのレスポンスに Retry-After があれば秒数を返す"""
+    response = getattr(error, 'response', None)
+    headers = getattr(response, 'headers', None) or {}
+    value = headers.get('retry-after')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def embed_with_retry(embeddings, texts: List[str], max_retries: int = 5, backoff_s: float = 1.0) -> List[List[float]]:
+    """1バッチ分を埋め込む（一時的なエラーはバックオフして再試行）"""
+    attempt = 0
+    while True:
+        try:
+            return embeddings.embed_documents(texts)
+        except RETRYABLE_ERRORS as e:
+            if attempt >= max_retries:
+                raise
+            wait_s = retry_after(e) or backoff_s * (2 ** attempt) * random.uniform(0.5, 1.5)
+            attempt += 1
+            print(f"Embedding batch failed ({type(e).__name__}), retrying in {wait_s:.1f}s ({attempt}/{max_retries})")
+            time.sleep(wait_s)
+
+
+def embed_concurrently(embeddings, texts: List[str], token_counts: Optional[List[int]] = None,
+                       batch_tokens: int = 20000, concurrency: int = 4, max_retries: int = 5,
+                       on_batch: Optional[Callable[[int, int], None]] = None) -> List[List[float]]:
+    """トークン数で区切ったバッチを並列に埋め込み、入力順のベクトルを返す
+
+    Args:
+        token_counts: 各テキストのトークン数（省略時は数える）
+        on_batch: バッチ完了ごとに (件数, トークン数) で呼ばれるコールバック
+    """
+    if token_counts is None:
+        token_counts = [count_tokens(text) for text in texts]
+    batches = token_batches(token_counts, batch_tokens)
+    vectors: List[Optional[List[float]]] = [None] * len(texts)
+
+    def run(batch: List[int]):
+        result = embed_with_retry(embeddings, [texts[i] for i in batch], max_retries=max_retries)
+        for i, vector in zip(batch, result):
+            vectors[i] = vector
+        if on_batch is not None:
+            on_batch(len(batch), sum(token_counts[i] for i in batch))
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        # list() で例外を呼び出し元へ伝える
+        list(executor.map(run, batches))
+    return vectors
+
+
+def upsert_vectors(collection, ids: List[str], texts: List[str], vectors: List[List[float]],
+                   metadatas: List[Dict], batch_size: int = 5000) -> int:
+    """計算済みベクトルをChromaコレクションへまとめて書き込む"""
+    for i in range(0, len(ids), batch_size):
+        collection.upsert(
+            ids=ids[i:i + batch_size],
+            documents=texts[i:i + batch_size],
+            embeddings=vectors[i:i + batch_size],
+            metadatas=metadatas[i:i + batch_size],
+        )
+    return len(ids)
+
+
+class IngestStats:
+    """取り込みのスループット（docs/sec・tokens/sec）"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.documents = 0
+        self.tokens = 0
+        self._lock = threading.Lock()
+
+    def add(self, documents: int, tokens: int):
+        with self._lock:
+            self.documents += documents
+            self.tokens += tokens
+
+    def summary(self) -> str:
+        elapsed = time.perf_counter() - self.started_at
+        return (f"{self.documents} docs, {self.tokens} tokens in {elapsed:.2f}s "
+                f"({self.documents / elapsed if elapsed else 0:.1f} docs/s, "
+                f"{self.tokens / elapsed if elapsed else 0:.0f} tokens/s)")
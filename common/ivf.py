@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+'wdb' コレクションのクラスタ分割（IVF）ベクトルインデックス
+
+店舗ごとのマニュアルが増えてコーパスが数千〜数万チャンクになっても、検索のコストを
+全件比較（または全件のHNSW）ではなく、近いクラスタの分だけに抑えるための任意のインデックス。
+
+- オフライン（build_ivf_index コマンド）でコレクションの全埋め込みを球面k-meansでクラスタに分け、
+  ベクトルをクラスタ順に並べ替えた連続ブロックとして .npz に保存する
+- 検索時はプロセス内で質問に近い n_probe 個のクラスタのブロックだけと距離を計算する
+  （クラスタ数 ≈ √N なら1回の検索で比べるのは おおよそ (1 + n_probe)・√N 本）
+- 距離はコレクションの距離空間（hnsw:space）に合わせるので、関連度スコアはChromaの検索と同じ尺度になる
+- 本文・メタデータは保存せず、上位のIDだけをChromaから読む
+- 作成時のコレクションの ID と sync_hash のダイジェストを保存し、読み込み時に一致しなければ使わない
+  （差分同期で本文だけ変わった・削除と追加で件数が同じになった場合も古いベクトルを返さない）。
+  取り込みコマンドはブランドシャードを変えたらインデックスファイルを消す
+"""
+import hashlib
+import os
+from datetime import datetime
+from typing import Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from common.ingest import iter_collection
+
+
+def source_digest(entries: Iterable[Tuple[str, str]]) -> str:
+    """(ID, sync_hash) の組の順序に依らないダイジェスト"""
+    digest = hashlib.sha256()
+    for doc_id, doc_hash in sorted(entries):
+        digest.update(f"{doc_id}\t{doc_hash}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+
+def page_entries(page) -> List[Tuple[str, str]]:
+    return [(doc_id, (metadata or {}).get('sync_hash') or '') for doc_id, metadata in zip(page['ids'], page['metadatas'])]
+
+
+def collection_digest(collection, page_size: int = 1000) -> str:
+    """コレクションの現在の (ID, sync_hash) のダイジェスト（埋め込みは読まない）"""
+    return source_digest(entry for page in iter_collection(collection, ['metadatas'], page_size)
+                         for entry in page_entries(page))
+
+
+def invalidate_index(path: str) -> bool:
+    """取り込みでブランドシャードが変わったときにインデックスファイルを消す（消したら True）"""
+    if path and os.path.exists(path):
+        os.remove(path)
+        return True
+    return False
+
+
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+def kmeans(vectors: np.ndarray, n_clusters: int, iterations: int = 20, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """球面k-means（コサイン類似度）。(単位ベクトルのセントロイド, 各ベクトルのクラスタ番号) を返す"""
+    rng = np.random.RandomState(seed)
+    unit = normalize_rows(vectors.astype(np.float32))
+    n_clusters = max(1, min(n_clusters, len(unit)))
+    centroids = unit[rng.choice(len(unit), n_clusters, replace=False)]
+    assignments = np.zeros(len(unit), dtype=np.int64)
+    for iteration in range(iterations):
+        new_assignments = (unit @ centroids.T).argmax(axis=1)
+        if iteration and np.array_equal(new_assignments, assignments):
+            break
+        assignments = new_assignments
+        for cluster in range(n_clusters):
+            members = unit[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+            else:
+                # 空のクラスタは最も遠いベクトルから作り直す
+                farthest = (unit * centroids[assignments]).sum(axis=1).argmin()
+                centroids[cluster] = unit[farthest]
+        centroids = normalize_rows(centroids)
+    return centroids, assignments
+
+
+class IVFIndex:
+    """クラスタごとの連続ブロックに並べたベクトルと、そのセントロイド"""
+
+    def __init__(self, centroids: np.ndarray, offsets: np.ndarray, vectors: np.ndarray, ids: np.ndarray,
+                 type_codes: np.ndarray, type_names: List[str], space: str = 'l2',
+                 built_at: str = '', source_count: int = 0, source_digest: str = ''):
+        self.centroids = centroids
+        # クラスタ c のベクトルは vectors[offsets[c]:offsets[c + 1]]
+        self.offsets = offsets
+        self.vectors = vectors
+        self.ids = ids
+        self.type_codes = type_codes
+        self.type_names = list(type_names)
+        self.space = space
+        self.built_at = built_at
+        self.source_count = source_count
+        self.source_digest = source_digest
+
+    @classmethod
+    def build(cls, ids: Sequence[str], vectors: np.ndarray, types: Sequence[str], n_clusters: Optional[int] = None,
+              space: str = 'l2', iterations: int = 20, seed: int = 0, source_digest: str = '') -> 'IVFIndex':
+        """ベクトルをクラスタに分け、クラスタ順の連続ブロックに並べ替える（既定のクラスタ数は √N）"""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        n_clusters = n_clusters or max(1, int(round(np.sqrt(len(vectors)))))
+        centroids, assignments = kmeans(vectors, n_clusters, iterations=iterations, seed=seed)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=len(centroids))
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        type_names = sorted(set(types))
+        codes = np.array([type_names.index(t) for t in types], dtype=np.int16)
+        return cls(centroids, offsets, vectors[order], np.asarray(ids)[order], codes[order], type_names,
+                   space=space, built_at=datetime.now().isoformat(timespec='seconds'), source_count=len(vectors),
+                   source_digest=source_digest)
+
+    @classmethod
+    def from_collection(cls, collection, n_clusters: Optional[int] = None, page_size: int = 1000,
+                        **kwargs) -> 'IVFIndex':
+        """Chromaコレクションの全埋め込みから作る"""
+        ids, vectors, types, entries = [], [], [], []
+        for page in iter_collection(collection, ['embeddings', 'metadatas'], page_size):
+            ids.extend(page['ids'])
+            vectors.extend(page['embeddings'])
+            types.extend((metadata or {}).get('type') or '' for metadata in page['metadatas'])
+            entries.extend(page_entries(page))
+        if not ids:
+            raise ValueError("collection is empty")
+        space = (collection.metadata or {}).get('hnsw:space', 'l2')
+        return cls.build(ids, np.asarray(vectors, dtype=np.float32), types, n_clusters, space=space,
+                         source_digest=source_digest(entries), **kwargs)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # np.savez は拡張子が無いと .npz を付けるので、一時ファイルにも付けておく
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids, offsets=self.offsets, vectors=self.vectors,
+                 ids=self.ids.astype(str), type_codes=self.type_codes, type_names=np.array(self.type_names),
+                 space=np.array(self.space), built_at=np.array(self.built_at),
+                 source_count=np.array(self.source_count), source_digest=np.array(self.source_digest))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> 'IVFIndex':
+        with np.load(path) as data:
+            return cls(data['centroids'], data['offsets'], data['vectors'], data['ids'], data['type_codes'],
+                       [str(name) for name in data['type_names']], space=str(data['space']),
+                       built_at=str(data['built_at']), source_count=int(data['source_count']),
+                       # ダイジェストの無い古いインデックスは常に作り直しが必要とみなす
+                       source_digest=str(data['source_digest']) if 'source_digest' in data.files else '')
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @property
+    def dimensions(self) -> int:
+        return self.vectors.shape[1]
+
+    @property
+    def nbytes(self) -> int:
+        return self.vectors.nbytes + self.centroids.nbytes + self.ids.nbytes + self.type_codes.nbytes
+
+    def distances(self, query: np.ndarray, block: np.ndarray) -> np.ndarray:
+        """コレクションの距離空間での距離（l2 はChromaと同じく二乗距離）"""
+        if self.space == 'cosine':
+            return 1 - normalize_rows(block) @ (query / (np.linalg.norm(query) or 1))
+        if self.space == 'ip':
+            return 1 - block @ query
+        return ((block - query) ** 2).sum(axis=1)
+
+    def search(self, embedding: Sequence[float], k: int = 10, n_probe: int = 8,
+               types: Optional[Sequence[str]] = None) -> Tuple[List[Tuple[str, float]], int]:
+        """近い n_probe 個のクラスタから上位 k 件の (ID, 距離) を返す。2つ目の値は距離を計算したベクトル数"""
+        query = np.asarray(embedding, dtype=np.float32)
+        allowed = None
+        if types is not None:
+            allowed = np.array([i for i, name in enumerate(self.type_names) if name in types], dtype=np.int16)
+            if not len(allowed):
+                return [], 0
+        unit = query / (np.linalg.norm(query) or 1)
+        probes = np.argsort(-(self.centroids @ unit))[:n_probe]
+        positions = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in probes])
+        if allowed is not None:
+            positions = positions[np.isin(self.type_codes[positions], allowed)]
+        if not len(positions):
+            return [], 0
+        distances = self.distances(query, self.vectors[positions])
+        if len(distances) > k:
+            top = np.argpartition(distances, k)[:k]
+            top = top[np.argsort(distances[top])]
+        else:
+            top = np.argsort(distances)
+        return [(str(self.ids[positions[i]]), float(distances[i])) for i in top], len(positions)
+
+    def exhaustive_search(self, embedding: Sequence[float], k: int = 10,
+                          types: Optional[Sequence[str]] = None) -> List[Tuple[str, float]]:
+        """全件と比べる検索（再現率の基準）"""
+        results, _ = self.search(embedding, k=k, n_probe=len(self.centroids), types=types)
+        return results
+
+    def summary(self) -> str:
+        sizes = np.diff(self.offsets)
+        return (f"{len(self)} vectors in {len(self.centroids)} clusters "
+                f"(size min {sizes.min()} / median {int(np.median(sizes))} / max {sizes.max()}, "
+                f"{self.nbytes / 1024 / 1024:.1f}MB, space={self.space}, built {self.built_at})")
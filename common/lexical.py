@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+文字bigramによる軽量な語彙検索（BM25）
+
+MeCabなどの形態素解析器に依存せず、日本語テキストをそのまま検索できる。
+ハイブリッド検索の語彙側スコアとして使用する。
+"""
+import unicodedata
+from typing import Dict, List, Optional
+
+from rank_bm25 import BM25Okapi
+
+
+def normalize_text(text: str) -> str:
+    """NFKC正規化・小文字化・空白除去を行う"""
+    return "".join(unicodedata.normalize('NFKC', text).lower().split())
+
+
+def tokenize(text: str) -> List[str]:
+    """正規化したテキストを文字bigramに分割する"""
+    compact = normalize_text(text)
+    if len(compact) < 2:
+        return [compact] if compact else []
+    return [compact[i:i + 2] for i in range(len(compact) - 1)]
+
+
+class LexicalIndex:
+    """ドキュメント一覧に対するBM25インデックス"""
+
+    def __init__(self, documents: List[Dict], tokens: Optional[List[List[str]]] = None):
+        """
+        Args:
+            documents: 'content' と 'metadata' を持つ辞書のリスト
+            tokens: 事前計算済みのトークン列（省略時はcontentから生成）
+        """
+        self.documents = documents
+        corpus = tokens if tokens is not None else [tokenize(doc['content']) for doc in documents]
+        # 空ドキュメントがあるとBM25Okapiが0除算するため1トークン入れておく
+        self.bm25 = BM25Okapi([t or ['\u0000'] for t in corpus]) if documents else None
+
+    def search(self, query: str, k: int = 10) -> List[Dict]:
+        """BM25スコアの上位k件を返す（scoreは最大値で0〜1に正規化）"""
+        if self.bm25 is None:
+            return []
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return []
+        scores = self.bm25.get_scores(query_tokens)
+        ranked = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
+        top = float(scores[ranked[0]]) if ranked else 0.0
+        results = []
+        for i in ranked:
+            if scores[i] <= 0:
+                break
+            doc = self.documents[i]
+            results.append({
+                'content': doc['content'],
+                'metadata': doc['metadata'],
+                'score': float(scores[i]) / top if top else 0.0,
+            })
+        return results
+
+    @classmethod
+    def from_store(cls, store, doc_type: Optional[str] = None, features=None) -> 'LexicalIndex':
+        """Chromaコレクションの内容からインデックスを構築する
+
+        features（common.features.FeatureStore）を渡すと、取り込み時に保存した
+        トークン列を使い、保存されていないドキュメントだけトークン化する。
+        """
+        data = store.get(where={"type": doc_type} if doc_type else None, include=['documents', 'metadatas'])
+        documents = [
+            {'content': content, 'metadata': metadata or {}}
+            for content, metadata in zip(data['documents'], data['metadatas'])
+        ]
+        if features is None:
+            return cls(documents)
+        stored = features.get_many(data['ids'], lexical=True)
+        tokens = [
+            stored[doc_id]['lexical_tokens'] if doc_id in stored else tokenize(doc['content'])
+            for doc_id, doc in zip(data['ids'], documents)
+        ]
+        return cls(documents, tokens=tokens)
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Dict]], k: int = 60, limit: int = 10) -> List[Dict]:
+    """複数の検索結果をRRFで統合する（同一contentは1件にまとめる）"""
+    fused: Dict[str, Dict] = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = doc['content']
+            entry = fused.setdefault(key, {'doc': doc, 'rrf': 0.0})
+            entry['rrf'] += 1.0 / (k + rank + 1)
+    ranked = sorted(fused.values(), key=lambda e: e['rrf'], reverse=True)[:limit]
+    if not ranked:
+        return []
+    top = ranked[0]['rrf']
+    # 後段の閾値判定と互換になるよう、RRFスコアを0〜1に正規化してscoreに入れる
+    return [{**e['doc'], 'score': e['rrf'] / top} for e in ranked]
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+メモリ使用量の計測と予算（MEMORY_BUDGET_MB）による自動退避
+
+- RSSを /proc から取得する（psutil不要）
+- tracemalloc が有効（MEMORY_TRACEMALLOC）なら、割り当て元のモジュールからコンポーネント別に集計する
+- 各サービスは重いコンポーネントを register() し、予算超過時に優先度の低い順
+  （キャッシュ → 再ランクモデル）に退避させる
+- 大きさを見積もれず退避もできないもの（Chroma・埋め込みクライアント）は登録せず、tracemallocの集計で見る
+- 登録は名前ごとに1件で、同じ名前で登録し直すと置き換える（テストやベンチマークでサービスを
+  作り直しても、古いインスタンスの sizer / evict を保持し続けない）
+"""
+import gc
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from django.conf import settings
+
+# tracemallocの割り当て元ファイルパスからコンポーネントを判定するための断片
+COMPONENT_MODULES = {
+    'chroma': ('chromadb', 'langchain_chroma', 'hnswlib', 'onnxruntime'),
+    'embeddings_client': ('langchain_openai', 'openai', 'httpx', 'httpcore', 'tiktoken'),
+    'cross_encoder': ('sentence_transformers', 'transformers', 'torch', 'tokenizers'),
+    'langchain': ('langchain', 'langchain_core', 'pydantic'),
+    'caches': (os.path.join('common', ''),),
+    'django': ('django',),
+}
+
+_lock = threading.Lock()
+_components: Dict[str, Dict] = {}
+# enforce_budget() の実行中フラグを兼ねる（同時に2つのスレッドが退避しないように）
+_check_lock = threading.Lock()
+_last_check = 0.0
+
+
+def register(name: str, sizer: Optional[Callable[[], int]] = None,
+             evict: Optional[Callable[[], None]] = None, priority: int = 100, repeatable: bool = False):
+    """コンポーネントを登録する（同じ名前の登録があれば置き換える）
+
+    Args:
+        name: 表示名（COMPONENT_MODULES のキーと揃えるとtracemallocの集計と並ぶ）
+        sizer: 推定使用バイト数を返す関数（tracemallocで見えないネイティブメモリ用）
+        evict: 予算超過時に呼ばれる退避関数（Noneなら退避対象外）
+        priority: 小さいほど先に退避される
+        repeatable: Trueなら退避後も再び対象にする（キャッシュのクリア等）
+    """
+    with _lock:
+        _components[name] = {'name': name, 'sizer': sizer, 'evict': evict, 'priority': priority,
+                             'repeatable': repeatable, 'evicted': False}
+
+
+def rss_mb() -> float:
+    """現在のRSS（MB）。/procが無い環境ではピークRSSで代用する"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024, 1)
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    divisor = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    return round(peak / divisor, 1)
+
+
+def budget_mb() -> float:
+    return getattr(settings, 'MEMORY_BUDGET_MB', 0)
+
+
+def tracemalloc_by_component(top: int = 10) -> Dict:
+    """tracemallocのスナップショットをコンポーネント別・ファイル別に集計する
+
+    tracemallocは MEMORY_TRACEMALLOC=true のとき config/wsgi.py で開始される。
+    """
+    if not tracemalloc.is_tracing():
+        return {'enabled': False}
+    snapshot = tracemalloc.take_snapshot()
+    stats = snapshot.statistics('filename')
+    totals: Dict[str, int] = {}
+    for stat in stats:
+        filename = stat.traceback[0].filename
+        component = 'other'
+        for name, fragments in COMPONENT_MODULES.items():
+            if any(f"{os.sep}{fragment}" in filename for fragment in fragments):
+                component = name
+                break
+        totals[component] = totals.get(component, 0) + stat.size
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        'enabled': True,
+        'traced_mb': round(current / 1024 / 1024, 2),
+        'traced_peak_mb': round(peak / 1024 / 1024, 2),
+        'by_component_mb': {k: round(v / 1024 / 1024, 2) for k, v in sorted(totals.items(), key=lambda i: -i[1])},
+        'top_allocators': [
+            {'file': stat.traceback[0].filename, 'size_mb': round(stat.size / 1024 / 1024, 3), 'count': stat.count}
+            for stat in stats[:top]
+        ],
+    }
+
+
+def report(top: int = 10) -> Dict:
+    """管理画面・ログ用のメモリレポート"""
+    with _lock:
+        components = list(_components.values())
+    entries = []
+    for component in components:
+        estimated = None
+        if component['sizer'] is not None:
+            try:
+                estimated = round(component['sizer']() / 1024 / 1024, 2)
+            except Exception:
+                estimated = None
+        entries.append({
+            'name': component['name'],
+            'estimated_mb': estimated,
+            'evictable': component['evict'] is not None,
+            'evicted': component['evicted'],
+        })
+    return {
+        'pid': os.getpid(),
+        'rss_mb': rss_mb(),
+        'peak_rss_mb': peak_rss_mb(),
+        'budget_mb': budget_mb() or None,
+        'components': entries,
+        'tracemalloc': tracemalloc_by_component(top),
+    }
+
+
+def log_memory(event: str):
+    """ワーカー起動・再起動時などにメモリ状況を1行で出力する"""
+    data = report(top=5)
+    components = ", ".join(
+        f"{c['name']}={c['estimated_mb']}MB" for c in data['components'] if c['estimated_mb'] is not None
+    )
+    traced = data['tracemalloc']
+    by_component = traced.get('by_component_mb', {}) if traced.get('enabled') else {}
+    print(f"[memory] {event}: pid={data['pid']} rss={data['rss_mb']}MB peak={data['peak_rss_mb']}MB "
+          f"budget={data['budget_mb']}MB {components} traced={by_component}")
+
+
+def enforce_budget() -> List[str]:
+    """RSSが予算を超えていれば、優先度順に退避して予算内に戻す
+
+    /proc の読み取りだけで済むためリクエストごとに呼んでよいが、
+    MEMORY_CHECK_INTERVAL 秒以内の再チェックは省略する。
+
+    Returns:
+        退避したコンポーネント名のリスト
+    """
+    global _last_check
+    limit = budget_mb()
+    if not limit:
+        return []
+    # 他のスレッドがチェック・退避中なら待たずに任せる
+    if not _check_lock.acquire(blocking=False):
+        return []
+    try:
+        now = time.monotonic()
+        if now - _last_check < getattr(settings, 'MEMORY_CHECK_INTERVAL', 5):
+            return []
+        _last_check = now
+        if rss_mb() <= limit:
+            return []
+
+        evicted = []
+        with _lock:
+            candidates = sorted(
+                (c for c in _components.values() if c['evict'] is not None and not c['evicted']),
+                key=lambda c: c['priority'],
+            )
+        for component in candidates:
+            try:
+                component['evict']()
+            except Exception as e:
+                print(f"Warning: failed to evict {component['name']}: {e}")
+                continue
+            component['evicted'] = not component['repeatable']
+            evicted.append(component['name'])
+            gc.collect()
+            if rss_mb() <= limit:
+                break
+    finally:
+        _check_lock.release()
+    if evicted:
+        print(f"[memory] budget {limit}MB exceeded, evicted: {', '.join(evicted)} (rss={rss_mb()}MB)")
+    return evicted
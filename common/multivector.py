@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+"""
+QAレコードの質問・回答を別々のベクトルにするマルチベクトルインデックス
+
+質問と回答をまとめて1本のベクトルにすると、長い回答に質問の意味が薄められる。
+そこでQAごとに「質問ベクトル」（別名の質問も含む）と「回答ベクトル」を
+別コレクション（QA_VECTOR_COLLECTION）に持ち、どちらも parent_id で元のレコードを指す。
+検索では子ベクトルを多めに取り、親ごとに最大スコアを採る。
+
+親レコードは従来どおり 'wdb' コレクションにあり、語彙検索・特徴量・回答の本文はそちらを使う。
+"""
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+QA_VECTOR_COLLECTION = 'wdb_qa_vectors'
+# コサイン類似度をそのまま関連度スコアにする
+QA_VECTOR_METADATA = {"hnsw:space": "cosine"}
+
+
+def child_records(record: Dict) -> List[Dict]:
+    """QAの同期用レコードから 質問 / 回答 の子レコードを作る（質問・回答の無いレコードは空）"""
+    metadata = record['metadata']
+    question = metadata.get('question') or ''
+    answer = metadata.get('answer') or ''
+    if not question:
+        return []
+    base = {
+        'parent_id': record['id'],
+        'type': metadata.get('type', 'qa'),
+        'doc_title': metadata.get('doc_title', ''),
+        'source': metadata.get('source', ''),
+    }
+    # 別名の質問（ほぼ重複として集約されたレコードの質問）も質問ベクトルに含める
+    aliases = metadata.get('alias_questions')
+    children = [{
+        'id': f"{record['id']}#q",
+        'content': question + (f"\n{aliases}" if aliases else ""),
+        'metadata': {**base, 'vector_kind': 'question'},
+    }]
+    if answer:
+        children.append({
+            'id': f"{record['id']}#a",
+            'content': answer,
+            'metadata': {**base, 'vector_kind': 'answer'},
+        })
+    return children
+
+
+def iter_child_records(records: Iterable[Dict]) -> Iterator[Dict]:
+    for record in records:
+        yield from child_records(record)
+
+
+def max_per_parent(hits: Iterable[Tuple[Dict, float]]) -> List[Tuple[str, float, str]]:
+    """子ベクトルの (メタデータ, スコア) を親ごとの最大スコアにまとめ、スコア順の (親ID, スコア, 一致した種類) を返す"""
+    best: Dict[str, Tuple[float, str]] = {}
+    for metadata, score in hits:
+        parent_id = metadata.get('parent_id')
+        if parent_id and (parent_id not in best or score > best[parent_id][0]):
+            best[parent_id] = (score, metadata.get('vector_kind', ''))
+    ranked = sorted(best.items(), key=lambda item: item[1][0], reverse=True)
+    return [(parent_id, score, kind) for parent_id, (score, kind) in ranked]
@@ -0,0 +1,327 @@
+# -*- coding: utf-8 -*-
+"""
+マニュアルファイルの逐次パーサ（取り込みコマンド共通）
+
+ファイル全体を読み込んで split せず、1行ずつ読んで1ブロックずつレコードを返すジェネレータ。
+batched() と組み合わせて一定件数ずつ埋め込み・書き込みに流すので、
+マニュアルが大きくなっても取り込み中のメモリは1バッチ分で済む。
+
+対応形式（PARSERS に登録。register_parser で追加できる）:
+    qa:        ===== 区切りのブロック（1行目が質問、残りが回答）
+    guideline: --- 区切りのブロック（タイトル: / カテゴリ: / 内容: の各行）
+    text:      見出しの無い地の文（コンセプト・沿革・理念など）をトークン数で区切って重ねながらチャンクにする
+
+どのパーサも 取り込み元の設定（source_config() の辞書）を受け取り、
+同期用レコード（'id' / 'content' / 'metadata'）を返す。
+"""
+import os
+import re
+from datetime import datetime
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from common.context_packer import split_sentences
+from common.sync import stable_id
+from common.tokens import count_tokens
+
+SEP_PATTERN = re.compile(r"^\s*={3,}\s*$")
+GUIDELINE_SEP_PATTERN = re.compile(r"^---\s*$")
+# 地の文の見出し（①〜⑳・「第N章」・【】で始まる行）。チャンクの category になる
+HEADING_PATTERN = re.compile(r"^\s*(?:[①-⑳]|第[0-9一二三四五六七八九十]+[章節]|【)")
+
+# 参照元（【参照元】として利用者に見える）に載せる質問の最大文字数
+SOURCE_QUESTION_CHARS = 30
+
+# 形式 → パーサ
+PARSERS: Dict[str, Callable[[Iterable[str], Dict], Iterator[Dict]]] = {}
+
+# docs/ 以下の既知のファイル（ファイル名 → 取り込み設定）
+DOCUMENT_SOURCES = {
+    'rag-text.txt': {'format': 'qa', 'type': 'qa', 'doc_title': 'フロントFAQ', 'id_prefix': 'qa'},
+    'guideline_unified.txt': {'format': 'guideline', 'type': 'guideline', 'doc_title': 'guideline_unified',
+                              'id_prefix': 'guideline'},
+    'concept.txt': {'format': 'text', 'type': 'concept', 'doc_title': 'Wブランドコンセプト', 'id_prefix': 'concept'},
+    'history.txt': {'format': 'text', 'type': 'history', 'doc_title': 'W越谷本店の歴史', 'id_prefix': 'history'},
+    'rinenn.txt': {'format': 'text', 'type': 'philosophy', 'doc_title': '経営理念', 'id_prefix': 'philosophy'},
+}
+
+
+def register_parser(name: str):
+    """形式名でパーサを登録するデコレータ"""
+    def decorator(fn):
+        PARSERS[name] = fn
+        return fn
+    return decorator
+
+
+def source_config(path: str, **overrides) -> Dict:
+    """ファイルの取り込み設定（既知のファイルは DOCUMENT_SOURCES、それ以外は地の文として扱う）"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    config = {'format': 'text', 'type': 'document', 'doc_title': stem, 'id_prefix': stem,
+              'chunk_tokens': 400, 'overlap_tokens': 60}
+    config.update(DOCUMENT_SOURCES.get(os.path.basename(path), {}))
+    config.update({key: value for key, value in overrides.items() if value is not None})
+    config['path'] = path
+    return config
+
+
+def source_scope(config: Dict) -> Dict:
+    """差分同期で比べる既存ドキュメントの範囲（種別とタイトル。ファイルごとに分かれるので、
+    あるファイルの同期で別のファイルから取り込んだドキュメントを削除しない）"""
+    doc_type = 'guideline' if config['format'] == 'guideline' else config['type']
+    return {'$and': [{'type': doc_type}, {'doc_title': config['doc_title']}]}
+
+
+def parse_source(config: Dict) -> Iterator[Dict]:
+    """設定の形式に対応するパーサでファイルを1件ずつ解析する"""
+    if config['format'] not in PARSERS:
+        raise ValueError(f"Unknown format: {config['format']} (available: {', '.join(sorted(PARSERS))})")
+    return PARSERS[config['format']](read_lines(config['path']), config)
+
+
+def read_lines(path: str) -> Iterator[str]:
+    """ファイルを1行ずつ読む（改行コードは \\n に揃える）"""
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            yield line.rstrip('\r\n')
+
+
+def batched(items: Iterable, size: int) -> Iterator[List]:
+    """size 件ずつのリストに区切る"""
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def iter_blocks(lines: Iterable[str], separator: re.Pattern) -> Iterator[List[str]]:
+    """区切り行でブロックに分ける（空のブロックは飛ばす）"""
+    block: List[str] = []
+    for line in lines:
+        if separator.match(line):
+            if any(l.strip() for l in block):
+                yield block
+            block = []
+        else:
+            block.append(line)
+    if any(l.strip() for l in block):
+        yield block
+
+
+def qa_from_block(lines: List[str]) -> Tuple[Optional[str], Optional[str]]:
+    """ブロックから質問と回答を抽出"""
+    lines = list(lines)
+    # 先頭・末尾の空行を除去
+    while lines and not lines[0].strip():
+        lines.pop(0)
+    while lines and not lines[-1].strip():
+        lines.pop()
+
+    if not lines:
+        return None, None
+
+    q = lines[0].strip()
+    a_lines = lines[1:]
+
+    # 先頭に空行が1つ入っているケースに対応
+    while a_lines and not a_lines[0].strip():
+        a_lines.pop(0)
+
+    a = "\n".join(a_lines).strip()
+    return q, a
+
+
+def qa_source(doc_title: str, question: str) -> str:
+    """QAの参照元の表示（IDのハッシュではなく、文書タイトルと質問の先頭）"""
+    question = " ".join((question or "").split())
+    if len(question) > SOURCE_QUESTION_CHARS:
+        question = question[:SOURCE_QUESTION_CHARS] + "…"
+    return f"{doc_title} - {question}" if question else doc_title
+
+
+def iter_qa_records(lines: Iterable[str], doc_title: str, rec_type: str, id_prefix: str) -> Iterator[Dict]:
+    """QA形式の行からレコードを1件ずつ返す（IDは質問文から作る）"""
+    seen: Dict[str, int] = {}
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    for block in iter_blocks(lines, SEP_PATTERN):
+        q, a = qa_from_block(block)
+        if not q and not a:
+            continue
+
+        # 回答が空なら空文字として出力
+        a = a if a is not None else ""
+
+        # 質問と回答を結合してコンテンツとする
+        if a:
+            content = f"質問: {q}\n\n回答: {a}"
+        else:
+            content = f"質問: {q}"
+
+        doc_id = stable_id(id_prefix, q or a, seen)
+        yield {
+            "id": doc_id,
+            "type": rec_type,
+            "doc_title": doc_title,
+            "question": q,
+            "answer": a,
+            "content": content,
+            "updated_at": today,
+            "source": qa_source(doc_title, q or a)
+        }
+
+
+def iter_guideline_sections(lines: Iterable[str]) -> Iterator[Dict]:
+    """ガイドライン形式の行から (title, category, content) を1件ずつ返す"""
+    for block in iter_blocks(lines, GUIDELINE_SEP_PATTERN):
+        title = ""
+        category = ""
+        content_lines = []
+
+        for line in block:
+            if line.startswith('タイトル: '):
+                title = line.replace('タイトル: ', '').strip()
+            elif line.startswith('カテゴリ: '):
+                category = line.replace('カテゴリ: ', '').strip()
+            elif line.startswith('内容: '):
+                content_lines.append(line.replace('内容: ', '').strip())
+            elif content_lines:  # 内容の続き
+                content_lines.append(line.strip())
+
+        if title and category and content_lines:
+            yield {'title': title, 'category': category, 'content': '\n'.join(content_lines).rstrip('\n')}
+
+
+def iter_guideline_records(lines: Iterable[str], source_label: str = 'ガイドライン',
+                           doc_title: str = 'guideline_unified', id_prefix: str = 'guideline') -> Iterator[Dict]:
+    """ガイドライン形式の行から同期用レコード（id / content / metadata）を1件ずつ返す
+
+    doc_title は取り込み元のファイルを表し、差分同期の範囲（source_scope）になる。
+    id_prefix もファイルごとに変えるので、別のファイルに同じタイトルがあってもIDが衝突しない。
+    """
+    seen: Dict[str, int] = {}
+    for section in iter_guideline_sections(lines):
+        title = section['title']
+        content = section['content']
+        # タイトルから作る安定したID（特徴量ストアのキーにもなる）
+        doc_id = stable_id(id_prefix, title, seen)
+        yield {
+            'id': doc_id,
+            'content': content,
+            'metadata': {
+                'id': doc_id,
+                'title': title,
+                'type': 'guideline',
+                'doc_title': doc_title,
+                'category': section['category'],
+                'token_count': count_tokens(content),
+                'source': f'{source_label} - {title}'
+            }
+        }
+
+
+def qa_sync_record(record: Dict) -> Dict:
+    """iter_qa_records() のレコードを同期用レコードに変換する"""
+    return {
+        'id': record['id'],
+        'content': record['content'],
+        'metadata': {key: record[key] for key in
+                     ('id', 'type', 'doc_title', 'question', 'answer', 'updated_at', 'source')},
+    }
+
+
+def split_to_tokens(text: str, max_tokens: int) -> Iterator[Tuple[str, int]]:
+    """max_tokens を超える行を文、それでも超える文は文字数で分ける"""
+    tokens = count_tokens(text)
+    if tokens <= max_tokens:
+        yield text, tokens
+        return
+    for sentence in split_sentences(text):
+        tokens = count_tokens(sentence)
+        if tokens <= max_tokens:
+            yield sentence, tokens
+            continue
+        # 1文がチャンクより長い場合はトークン数に比例した文字数で切る
+        step = max(1, len(sentence) * max_tokens // tokens)
+        for i in range(0, len(sentence), step):
+            piece = sentence[i:i + step]
+            yield piece, count_tokens(piece)
+
+
+def iter_text_chunks(lines: Iterable[str], chunk_tokens: int = 400,
+                     overlap_tokens: int = 60) -> Iterator[Tuple[str, str]]:
+    """地の文を (見出し, チャンク本文) に分ける
+
+    行を chunk_tokens まで詰め、次のチャンクの先頭には直前の末尾 overlap_tokens 分の行を重ねる
+    （重ねた行と次の行の合計が chunk_tokens を超えないよう、重ねる量は次の行の分だけ減らす）。
+    見出し行が来たらチャンクを区切り、その見出しを以降のチャンクの見出しにする。
+    """
+    heading = ""
+    pieces: List[Tuple[str, int]] = []
+    used = 0
+    fresh = False  # 重ねた行以外の新しい行があるか
+
+    def flush():
+        return "\n".join(piece for piece, _ in pieces).strip()
+
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        if HEADING_PATTERN.match(line):
+            if fresh:
+                yield heading, flush()
+            heading, pieces, used, fresh = line, [], 0, False
+        for piece, tokens in split_to_tokens(line, chunk_tokens):
+            if fresh and used + tokens > chunk_tokens:
+                yield heading, flush()
+                # 末尾から overlap_tokens 分（次の行と合わせて chunk_tokens 以内）を次のチャンクに重ねる
+                room = min(overlap_tokens, chunk_tokens - tokens)
+                overlap, overlap_used = [], 0
+                for prev in reversed(pieces):
+                    if overlap_used + prev[1] > room:
+                        break
+                    overlap.insert(0, prev)
+                    overlap_used += prev[1]
+                pieces, used, fresh = overlap, overlap_used, False
+            pieces.append((piece, tokens))
+            used += tokens
+            fresh = True
+    if fresh:
+        yield heading, flush()
+
+
+@register_parser('qa')
+def parse_qa(lines: Iterable[str], config: Dict) -> Iterator[Dict]:
+    for record in iter_qa_records(lines, config['doc_title'], config['type'], config['id_prefix']):
+        yield qa_sync_record(record)
+
+
+@register_parser('guideline')
+def parse_guideline(lines: Iterable[str], config: Dict) -> Iterator[Dict]:
+    return iter_guideline_records(lines, source_label=config.get('source_label', 'ガイドライン'),
+                                  doc_title=config['doc_title'], id_prefix=config['id_prefix'])
+
+
+@register_parser('text')
+def parse_text(lines: Iterable[str], config: Dict) -> Iterator[Dict]:
+    seen: Dict[str, int] = {}
+    doc_title = config['doc_title']
+    today = datetime.now().strftime("%Y-%m-%d")
+    for heading, content in iter_text_chunks(lines, config['chunk_tokens'], config['overlap_tokens']):
+        doc_id = stable_id(config['id_prefix'], content, seen)
+        yield {
+            'id': doc_id,
+            'content': content,
+            'metadata': {
+                'id': doc_id,
+                'type': config['type'],
+                'doc_title': doc_title,
+                'category': heading or doc_title,
+                'updated_at': today,
+                'token_count': count_tokens(content),
+                'source': f"{doc_title} - {heading}" if heading else doc_title,
+            }
+        }
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+"""
+サンプリングによるリクエストプロファイリング
+
+PROFILING_ENABLED が False の場合、ミドルウェアは MiddlewareNotUsed で自身を外し、
+パイプライン側のフック（profile / annotate）もフラグを見るだけで何もしない。
+
+有効時は PROFILING_SAMPLE_RATE の割合、または管理者用ヘッダー
+（PROFILING_HEADER に PROFILING_TOKEN を設定）付きのリクエストだけを計測し、
+PROFILING_DIR に最大 PROFILING_MAX_FILES 件まで保存する（古いものから削除）。
+
+PROFILING_MODE:
+    sampling: スタックを定期的に採取してcollapsed-stack形式（flamegraph用）で保存（低オーバーヘッド）
+    cprofile: cProfileで全関数呼び出しを計測してpstats形式で保存
+
+パイプラインのステージは別スレッド（ai-stage）で動くので、bind() で包んだ関数は
+計測中のプロファイルを引き継ぎ、そのスレッドも採取対象にする（cprofileではスレッドごとに計測して合算する）。
+"""
+import cProfile
+import functools
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+_local = threading.local()
+
+
+def is_enabled() -> bool:
+    return getattr(settings, 'PROFILING_ENABLED', False)
+
+
+def profile_dir() -> str:
+    return str(getattr(settings, 'PROFILING_DIR', os.path.join(settings.BASE_DIR, 'profiles')))
+
+
+class SamplingProfiler:
+    """対象スレッドのスタックを一定間隔で採取する軽量プロファイラ
+
+    リクエストのスレッドに加え、add_thread() したステージのスレッドも採取する
+    （ステージのスタックは先頭にスレッド名を付ける）。
+    """
+
+    def __init__(self, thread_id: int, interval_ms: float = 5):
+        self.thread_id = thread_id
+        self.interval = interval_ms / 1000
+        self.stacks: Counter = Counter()
+        self._extra_threads: Dict[int, str] = {}
+        self._threads_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def add_thread(self, thread_id: int, name: str):
+        with self._threads_lock:
+            self._extra_threads[thread_id] = name
+
+    def remove_thread(self, thread_id: int):
+        with self._threads_lock:
+            self._extra_threads.pop(thread_id, None)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._threads_lock:
+                targets = [(self.thread_id, None)] + list(self._extra_threads.items())
+            for thread_id, thread_name in targets:
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                if thread_name:
+                    names.append(f"[{thread_name}]")
+                self.stacks[";".join(reversed(names))] += 1
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+
+class _ActiveProfile:
+    """1回分の計測状態"""
+
+    def __init__(self, label: str, mode: str):
+        self.label = label
+        self.mode = mode
+        self.meta: Dict = {}
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        # ステージのスレッドで計測した cProfile（finish() で合算する）
+        self.thread_profiles: List[cProfile.Profile] = []
+        self._lock = threading.Lock()
+        if mode == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        else:
+            self.profiler = SamplingProfiler(threading.get_ident(),
+                                             getattr(settings, 'PROFILING_INTERVAL_MS', 5))
+            self.profiler.start()
+
+    @contextmanager
+    def observe_thread(self):
+        """呼び出したスレッド（ステージのスレッド）の処理を計測対象に加える"""
+        if self.mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield
+            finally:
+                profiler.disable()
+                with self._lock:
+                    self.thread_profiles.append(profiler)
+        else:
+            thread = threading.current_thread()
+            self.profiler.add_thread(thread.ident, thread.name)
+            try:
+                yield
+            finally:
+                self.profiler.remove_thread(thread.ident)
+
+    def finish(self) -> Optional[str]:
+        duration_ms = (time.perf_counter() - self._start) * 1000
+        if self.mode == 'cprofile':
+            self.profiler.disable()
+        else:
+            self.profiler.stop()
+        return write_profile(self, duration_ms)
+
+
+def write_profile(active: _ActiveProfile, duration_ms: float) -> Optional[str]:
+    """プロファイルとメタ情報を保存し、上限を超えた古いファイルを削除する"""
+    directory = profile_dir()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9_-]+', '_', active.label).strip('_')[:40] or 'request'
+        base = os.path.join(directory, f"{int(active.started_at * 1000)}-{os.getpid()}-{slug}")
+        if active.mode == 'cprofile':
+            path = base + '.prof'
+            stats = pstats.Stats(active.profiler)
+            for profiler in active.thread_profiles:
+                stats.add(profiler)
+            stats.dump_stats(path)
+        else:
+            path = base + '.collapsed'
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(active.profiler.collapsed())
+        meta = dict(active.meta, label=active.label, mode=active.mode, file=os.path.basename(path),
+                    started_at=active.started_at, duration_ms=round(duration_ms, 1))
+        with open(base + '.json', 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, default=str)
+        rotate(directory, getattr(settings, 'PROFILING_MAX_FILES', 50))
+        return path
+    except OSError as e:
+        print(f"Warning: failed to write profile: {e}")
+        return None
+
+
+def rotate(directory: str, max_profiles: int):
+    """メタ情報ファイルの数が上限を超えたら古い順に削除する"""
+    metas = sorted(f for f in os.listdir(directory) if f.endswith('.json'))
+    for name in metas[:max(0, len(metas) - max_profiles)]:
+        base = os.path.join(directory, name[:-len('.json')])
+        for ext in ('.json', '.prof', '.collapsed'):
+            try:
+                os.remove(base + ext)
+            except FileNotFoundError:
+                pass
+
+
+def should_sample() -> bool:
+    rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0.0)
+    return rate > 0 and random.random() < rate
+
+
+@contextmanager
+def profile(label: str, force: bool = False):
+    """パイプライン用フック。無効時・計測中のネスト時は何もしない
+
+    Args:
+        label: ファイル名とメタ情報に使うラベル
+        force: サンプリング率に関係なく計測する（管理者ヘッダー等）
+    """
+    if not is_enabled() or getattr(_local, 'active', None) is not None or not (force or should_sample()):
+        yield
+        return
+    active = _ActiveProfile(label, getattr(settings, 'PROFILING_MODE', 'sampling'))
+    _local.active = active
+    try:
+        yield
+    finally:
+        _local.active = None
+        active.finish()
+
+
+def bind(fn):
+    """別スレッドで実行する fn に計測中のプロファイルを引き継ぐ（計測中でなければ fn をそのまま返す）"""
+    active = getattr(_local, 'active', None)
+    if active is None:
+        return fn
+
+    @functools.wraps(fn)
+    def observed(*args, **kwargs):
+        previous = getattr(_local, 'active', None)
+        # ステージの中でさらに bind() した関数（ヘッジ等）にも引き継ぐ
+        _local.active = active
+        try:
+            with active.observe_thread():
+                return fn(*args, **kwargs)
+        finally:
+            _local.active = previous
+
+    return observed
+
+
+def annotate(**info):
+    """計測中のプロファイルにメタ情報（process_infoのタイミング等）を追加する"""
+    active = getattr(_local, 'active', None)
+    if active is not None:
+        active.meta.update(info)
+
+
+def recent_profiles(limit: int = 20) -> List[Dict]:
+    """保存済みプロファイルのメタ情報を遅い順に返す"""
+    directory = profile_dir()
+    if not os.path.isdir(directory):
+        return []
+    profiles = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(profiles, key=lambda p: p.get('duration_ms', 0), reverse=True)[:limit]
+
+
+class ProfilingMiddleware:
+    """サンプリング対象、または管理者ヘッダー付きのリクエストをプロファイルする"""
+
+    def __init__(self, get_response):
+        if not is_enabled():
+            # 無効時はDjangoがミドルウェアチェーンから外すため、リクエストごとのコストはゼロ
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.header = 'HTTP_' + getattr(settings, 'PROFILING_HEADER', 'X-Profile-Request').upper().replace('-', '_')
+        self.token = getattr(settings, 'PROFILING_TOKEN', '')
+
+    def __call__(self, request):
+        forced = bool(self.token) and request.META.get(self.header) == self.token
+        with profile(f"{request.method} {request.path}", force=forced):
+            annotate(path=request.path, method=request.method, forced=forced)
+            response = self.get_response(request)
+            annotate(status=response.status_code)
+        return response
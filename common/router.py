@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+検索前に質問の振り分け先（QA / ガイドライン / 両方）を決める最近傍セントロイドのルーター
+
+取り込み後に 'wdb' コレクションの埋め込みを 種別（type）/カテゴリ ごとに平均したセントロイドを
+特徴量ストアに保存しておき、検索時は質問の埋め込みとのコサイン類似度だけで振り分ける
+（質問の埋め込みは検索でもそのまま使うので、追加のAPI呼び出しは無い）。
+
+    qa:        QAのセントロイドが他より margin 以上近い → 従来どおりQAを検索
+    guideline: QA以外（ガイドライン・コンセプト・理念など）が margin 以上近い → QAを検索せずにそちらだけを検索
+    both:      差が margin 未満 → 全種別を1回で検索（低確信時のガイドライン補完を待たない）
+"""
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from common.ingest import iter_collection
+
+ROUTES = ('qa', 'guideline', 'both')
+
+
+def centroid_label(metadata: Dict) -> Tuple[str, str]:
+    """(ラベル, 種別)。カテゴリのある種別は 種別/カテゴリ ごとに分ける"""
+    doc_type = metadata.get('type') or 'document'
+    category = metadata.get('category')
+    return (f"{doc_type}/{category}" if category else doc_type), doc_type
+
+
+def centroids_from_vectors(items: Iterable[Tuple[Dict, Sequence[float]]]) -> List[Tuple[str, str, int, np.ndarray]]:
+    """(メタデータ, ベクトル) の組を単位ベクトルにして平均し、(ラベル, 種別, 件数, セントロイド) を返す"""
+    sums: Dict[Tuple[str, str], np.ndarray] = {}
+    counts: Dict[Tuple[str, str], int] = defaultdict(int)
+    for metadata, vector in items:
+        key = centroid_label(metadata)
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        if not norm:
+            continue
+        sums[key] = sums.get(key, 0) + vector / norm
+        counts[key] += 1
+    centroids = []
+    for (label, doc_type), total in sorted(sums.items()):
+        norm = np.linalg.norm(total)
+        if norm:
+            centroids.append((label, doc_type, counts[(label, doc_type)], (total / norm).astype(np.float32)))
+    return centroids
+
+
+def build_centroids(collection, page_size: int = 1000) -> List[Tuple[str, str, int, np.ndarray]]:
+    """Chromaコレクションの全埋め込みから種別/カテゴリごとのセントロイドを作る（ページ単位で読む）"""
+    return centroids_from_vectors(
+        (metadata or {}, vector)
+        for page in iter_collection(collection, ['embeddings', 'metadatas'], page_size)
+        for metadata, vector in zip(page['metadatas'], page['embeddings'])
+    )
+
+
+def rebuild_centroids(collection, features) -> int:
+    """セントロイドを作り直して特徴量ストアに保存し、件数を返す（取り込みコマンドの最後に呼ぶ）"""
+    centroids = build_centroids(collection)
+    features.replace_centroids(centroids)
+    return len(centroids)
+
+
+class RouteDecision:
+    """1リクエストの振り分け（process_info['routing'] に載せる）"""
+
+    def __init__(self, route: str, label: str, qa_score: float, other_score: float):
+        self.route = route
+        self.label = label
+        self.qa_score = qa_score
+        self.other_score = other_score
+
+    def as_dict(self) -> Dict:
+        return {
+            'route': self.route,
+            'nearest': self.label,
+            'qa_score': round(self.qa_score, 4),
+            'other_score': round(self.other_score, 4),
+        }
+
+
+class IntentRouter:
+    """種別/カテゴリのセントロイドへの最近傍で振り分ける"""
+
+    def __init__(self, centroids: List[Tuple[str, str, int, np.ndarray]], margin: float = 0.03):
+        self.labels = [label for label, _, _, _ in centroids]
+        self.types = [doc_type for _, doc_type, _, _ in centroids]
+        self.matrix = np.stack([vector for _, _, _, vector in centroids]) if centroids else np.zeros((0, 0))
+        self.margin = margin
+        self.is_qa = np.array([doc_type == 'qa' for doc_type in self.types])
+
+    @property
+    def other_types(self) -> List[str]:
+        """guideline に振り分けたときに検索する種別（QA以外）"""
+        return sorted({doc_type for doc_type in self.types if doc_type != 'qa'})
+
+    @property
+    def usable(self) -> bool:
+        """QAとそれ以外の両方のセントロイドがあるときだけ振り分けられる"""
+        return bool(self.is_qa.any() and (~self.is_qa).any())
+
+    def route(self, embedding: Sequence[float]) -> Optional[RouteDecision]:
+        query = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if not self.usable or not norm or query.shape[0] != self.matrix.shape[1]:
+            return None
+        scores = self.matrix @ (query / norm)
+        qa_score = float(scores[self.is_qa].max())
+        other_score = float(scores[~self.is_qa].max())
+        if qa_score - other_score >= self.margin:
+            route = 'qa'
+        elif other_score - qa_score >= self.margin:
+            route = 'guideline'
+        else:
+            route = 'both'
+        return RouteDecision(route, self.labels[int(scores.argmax())], qa_score, other_score)
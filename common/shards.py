@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+店舗ごとのシャード（Chromaコレクション）
+
+ブランド共通のドキュメントは従来どおり 'wdb'（ブランドシャード）に置き、
+店舗固有のドキュメントは取り込み時の --store で店舗ごとのコレクション（wdb_store_<店舗コード>）に分ける。
+検索はブランドシャードと、質問したユーザー（Customer.store）の店舗のシャードだけを対象にするので、
+店舗が増えても他店舗のドキュメントを絞り込む必要が無い。
+
+- 店舗シャードのIDは <店舗コード>/<ID> にして、同じ質問文のブランドのレコードとぶつからないようにする
+- 店舗シャードはコサイン空間で作る。検索結果は距離からコサイン類似度に戻し、
+  ブランドシャードの検索と同じ尺度のスコアに変換してから統合する（埋め込みは単位ベクトル）
+- 店舗のドキュメントは特徴量ストア（数値ファクトの高速パス・セントロイド）には入れない
+  （他店舗の質問にその店舗のファクトで答えないため）
+"""
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from common.timing import summarize_latencies
+
+BRAND_SHARD = 'wdb'
+STORE_SHARD_PREFIX = 'wdb_store_'
+SHARD_METADATA = {"hnsw:space": "cosine"}
+# Chromaのコレクション名に使える文字で、店舗コードとして扱いやすいもの
+STORE_PATTERN = re.compile(r'^[a-z0-9][a-z0-9_-]{0,39}$')
+
+
+def validate_store(store: str) -> str:
+    """店舗コードを正規化して検証する（英小文字・数字・_・-、40文字まで）"""
+    code = (store or '').strip().lower()
+    if not STORE_PATTERN.match(code):
+        raise ValueError(f"Invalid store code: {store!r} (use lowercase letters, digits, '_' or '-')")
+    return code
+
+
+def shard_name(store: Optional[str] = None) -> str:
+    """店舗のシャード名（店舗が無ければブランドシャード）"""
+    return f"{STORE_SHARD_PREFIX}{validate_store(store)}" if store else BRAND_SHARD
+
+
+def store_of(collection_name: str) -> Optional[str]:
+    if collection_name.startswith(STORE_SHARD_PREFIX):
+        return collection_name[len(STORE_SHARD_PREFIX):]
+    return None
+
+
+def store_records(records: Iterable[Dict], store: str) -> Iterator[Dict]:
+    """同期用レコードのIDに店舗コードを付け、メタデータに store を入れる"""
+    for record in records:
+        doc_id = f"{store}/{record['id']}"
+        yield {**record, 'id': doc_id, 'metadata': {**record['metadata'], 'id': doc_id, 'store': store}}
+
+
+def cosine_from_distance(distance: float, space: str) -> float:
+    """距離空間ごとの距離を単位ベクトルのコサイン類似度に戻す（l2 はChromaと同じく二乗距離）"""
+    if space == 'l2':
+        return 1 - distance / 2
+    return 1 - distance
+
+
+def distance_from_cosine(cosine: float, space: str) -> float:
+    if space == 'l2':
+        return 2 - 2 * cosine
+    return 1 - cosine
+
+
+class ShardStats:
+    """シャードごとの検索回数と直近のレイテンシ（管理画面の pipeline_stats に出す）"""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._lock = threading.Lock()
+        self._latencies: Dict[str, deque] = {}
+        self._searches: Dict[str, int] = {}
+
+    def record(self, shard: str, elapsed_ms: float):
+        with self._lock:
+            self._latencies.setdefault(shard, deque(maxlen=self.window)).append(elapsed_ms)
+            self._searches[shard] = self._searches.get(shard, 0) + 1
+
+    def stats(self, sizes: Dict[str, int]) -> Dict[str, Dict]:
+        with self._lock:
+            names = sorted(set(sizes) | set(self._searches))
+            return {
+                name: {
+                    'documents': sizes.get(name),
+                    'searches': self._searches.get(name, 0),
+                    'latency_ms': summarize_latencies(list(self._latencies.get(name, []))),
+                }
+                for name in names
+            }
+
+
+class StoreShards:
+    """店舗シャードの検索（コレクションは初回に開いてプロセス内で使い回す）
+
+    シャードの一覧は refresh_s 秒ごとに読み直すので、稼働中に取り込まれた店舗もそのうち検索対象になる。
+    """
+
+    def __init__(self, client, refresh_s: float = 60):
+        self.client = client
+        self.refresh_s = refresh_s
+        self._collections: Dict[str, object] = {}
+        self._names: List[str] = []
+        self._listed_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def names(self) -> List[str]:
+        return sorted(c.name for c in self.client.list_collections() if store_of(c.name))
+
+    def collection(self, store: Optional[str]):
+        """店舗のシャード（店舗が無い・シャードが無い・不正な店舗コードは None）"""
+        if not store:
+            return None
+        try:
+            name = shard_name(store)
+        except ValueError:
+            return None
+        with self._lock:
+            if name in self._collections:
+                return self._collections[name]
+            now = time.monotonic()
+            if self._listed_at is None or now - self._listed_at > self.refresh_s:
+                self._names = self.names()
+                self._listed_at = now
+            if name not in self._names:
+                return None
+            self._collections[name] = self.client.get_collection(name)
+            return self._collections[name]
+
+    def search(self, store: str, embedding: List[float], k: int = 10,
+               where: Optional[Dict] = None) -> List[Tuple[Dict, float]]:
+        """店舗シャードを検索し、(ドキュメント, コサイン類似度) を返す"""
+        collection = self.collection(store)
+        if collection is None or not collection.count():
+            return []
+        space = (collection.metadata or {}).get('hnsw:space', 'l2')
+        try:
+            found = collection.query(query_embeddings=[embedding], n_results=min(k, collection.count()), where=where,
+                                     include=['documents', 'metadatas', 'distances'])
+        except Exception:
+            # --clear-db で作り直されたシャードは次の検索で開き直す
+            with self._lock:
+                self._collections.pop(collection.name, None)
+                self._listed_at = None
+            raise
+        return [
+            ({'id': doc_id, 'content': content, 'metadata': dict(metadata or {}), 'shard': collection.name},
+             cosine_from_distance(distance, space))
+            for doc_id, content, metadata, distance
+            in zip(found['ids'][0], found['documents'][0], found['metadatas'][0], found['distances'][0])
+        ]
+
+    def sizes(self) -> Dict[str, int]:
+        return {name: self.client.get_collection(name).count() for name in self.names()}
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+負荷試験用のローカルHTTPスタブサーバー
+
+外部APIの代わりに起動し、実際のHTTPクライアント経路（openai SDK等）を通したまま
+レイテンシを擬似的に再現する。OPENAI_BASE_URL をこのサーバーに向けて使用する。
+"""
+import base64
+import json
+import math
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict
+
+from common.stubs import FakeEmbeddings
+
+
+class StubServer:
+    """ThreadingHTTPServerをバックグラウンドスレッドで動かす基底クラス"""
+
+    handler_class = BaseHTTPRequestHandler
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        handler = type('Handler', (self.handler_class,), {'stub': self})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    """JSONの読み書きを共通化したハンドラ"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self) -> Dict:
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        return json.loads(body) if body else {}
+
+    def write_json(self, payload, status: int = 200):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _OpenAIHandler(JSONHandler):
+    stub = None
+
+    def do_POST(self):
+        payload = self.read_json()
+        if self.path.endswith('/chat/completions'):
+            self.stub.sleep(self.stub.chat_latency_ms)
+            self.write_json(self.stub.chat_completion(payload))
+        elif self.path.endswith('/embeddings'):
+            self.stub.sleep(self.stub.embedding_latency_ms)
+            self.write_json(self.stub.embeddings_response(payload))
+        else:
+            self.write_json({'error': {'message': f'unknown path {self.path}'}}, status=404)
+
+
+class FakeOpenAIServer(StubServer):
+    """OpenAIの chat/completions と embeddings を模倣するスタブ"""
+
+    handler_class = _OpenAIHandler
+
+    def __init__(self, chat_latency_ms: float = 400, embedding_latency_ms: float = 50,
+                 jitter: float = 0.3, dimensions: int = 1536, **kwargs):
+        super().__init__(**kwargs)
+        self.chat_latency_ms = chat_latency_ms
+        self.embedding_latency_ms = embedding_latency_ms
+        self.jitter = jitter
+        self.embedder = FakeEmbeddings(dimensions=dimensions)
+        self._rng = random.Random(0)
+        self._lock = threading.Lock()
+
+    def sleep(self, latency_ms: float):
+        if latency_ms <= 0:
+            return
+        with self._lock:
+            factor = math.exp(self._rng.gauss(0, self.jitter))
+        time.sleep(latency_ms * factor / 1000)
+
+    def chat_completion(self, payload: Dict) -> Dict:
+        messages = payload.get('messages') or [{}]
+        prompt = str(messages[-1].get('content', ''))
+        lines = [line for line in prompt.splitlines() if line.strip()]
+        content = lines[-2] if len(lines) >= 2 else prompt[:100]
+        return {
+            'id': 'chatcmpl-stub',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': payload.get('model', 'gpt-4o-mini'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': content},
+                'finish_reason': 'stop',
+            }],
+            'usage': {'prompt_tokens': len(prompt), 'completion_tokens': len(content),
+                      'total_tokens': len(prompt) + len(content)},
+        }
+
+    def embeddings_response(self, payload: Dict) -> Dict:
+        inputs = payload.get('input', [])
+        if not isinstance(inputs, list) or (inputs and isinstance(inputs[0], int)):
+            inputs = [inputs]
+        data = []
+        for i, item in enumerate(inputs):
+            vector = self.embedder.embed_query(str(item))
+            if payload.get('encoding_format') == 'base64':
+                # openai SDKは既定でbase64（float32リトルエンディアン）を要求する
+                embedding = base64.b64encode(struct.pack(f'<{len(vector)}f', *vector)).decode('ascii')
+            else:
+                embedding = vector
+            data.append({'object': 'embedding', 'index': i, 'embedding': embedding})
+        return {
+            'object': 'list',
+            'data': data,
+            'model': payload.get('model', 'text-embedding-3-small'),
+            'usage': {'prompt_tokens': 0, 'total_tokens': 0},
+        }
+
+
+def fake_openai_env(server: FakeOpenAIServer) -> Dict[str, str]:
+    """スタブを使わせるための環境変数（サブプロセスに渡す）"""
+    return {
+        'OPENAI_BASE_URL': f"{server.url}/v1",
+        'OPENAI_API_BASE': f"{server.url}/v1",
+        'OPENAI_API_KEY': 'sk-stub',
+    }
+
+
+
+class _LineHandler(JSONHandler):
+    stub = None
+
+    def do_GET(self):
+        prefix = '/v2/bot/profile/'
+        if self.path.startswith(prefix):
+            user_id = self.path[len(prefix):]
+            self.stub.record('get_profile', user_id)
+            self.write_json({'userId': user_id, 'displayName': f'負荷試験ユーザー{user_id[-4:]}',
+                             'pictureUrl': '', 'statusMessage': ''})
+        else:
+            self.write_json({'message': f'unknown path {self.path}'}, status=404)
+
+    def do_POST(self):
+        payload = self.read_json()
+        if self.path == '/v2/bot/message/push':
+            self.stub.record('push_message', payload.get('to', ''))
+            self.write_json({'sentMessages': [{'id': '1', 'quoteToken': 'stub'}]})
+        elif self.path.endswith('chat.postMessage'):
+            # Slack通知もこのスタブで受ける（SLACK_API_URL）
+            self.stub.record('slack', '')
+            self.write_json({'ok': True})
+        else:
+            self.write_json({'message': f'unknown path {self.path}'}, status=404)
+
+
+class FakeLineServer(StubServer):
+    """LINE Messaging API（push_message / get_profile）とSlack通知を記録するスタブ"""
+
+    handler_class = _LineHandler
+
+    def __init__(self, latency_ms: float = 0, on_call=None, **kwargs):
+        super().__init__(**kwargs)
+        self.latency_ms = latency_ms
+        self.on_call = on_call
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def record(self, kind: str, user_id: str):
+        """呼び出しを受信時刻（perf_counter）付きで記録する"""
+        at = time.perf_counter()
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        with self._lock:
+            self.calls.append({'kind': kind, 'user_id': user_id, 'at': at})
+        if self.on_call is not None:
+            self.on_call(kind, user_id, at)
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            result: Dict[str, int] = {}
+            for call in self.calls:
+                result[call['kind']] = result.get(call['kind'], 0) + 1
+            return result
+
+
+def fake_line_env(server: FakeLineServer) -> Dict[str, str]:
+    """LINE/Slackの呼び出し先をスタブに向ける環境変数"""
+    return {
+        'LINE_API_ENDPOINT': server.url,
+        'SLACK_API_URL': f"{server.url}/api/chat.postMessage",
+    }
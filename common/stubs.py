@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+ベンチマーク・負荷試験用のスタブ／記録再生プロバイダ
+
+OpenAIやCross-Encoderを呼び出さずにパイプラインを動かすための代替実装。
+レイテンシを擬似的に再現し、ネットワークやAPI料金なしで性能を比較できる。
+"""
+import hashlib
+import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage
+
+from common.facts import FactIndex
+
+
+def _char_ngrams(text: str, n: int = 2) -> List[str]:
+    """空白を除いた文字n-gramを返す（日本語でも形態素解析なしで使える）"""
+    compact = "".join(text.split())
+    if len(compact) < n:
+        return [compact] if compact else []
+    return [compact[i:i + n] for i in range(len(compact) - n + 1)]
+
+
+def _simulated_delay(latency_ms: float, jitter: float, rng: random.Random) -> float:
+    """対数正規分布で揺らぎを付けた遅延（秒）を返す"""
+    if latency_ms <= 0:
+        return 0.0
+    return latency_ms * math.exp(rng.gauss(0, jitter)) / 1000
+
+
+class FakeChatModel:
+    """ChatOpenAIの代わりに定型文を返すスタブLLM"""
+
+    def __init__(self, latency_ms: float = 0, jitter: float = 0.3, reply: Optional[str] = None, seed: int = 0):
+        self.latency_ms = latency_ms
+        self.jitter = jitter
+        self.reply = reply
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def invoke(self, prompt, *args, **kwargs) -> AIMessage:
+        with self._lock:
+            delay = _simulated_delay(self.latency_ms, self.jitter, self._rng)
+        if delay:
+            time.sleep(delay)
+        text = prompt if isinstance(prompt, str) else str(prompt)
+        if self.reply is not None:
+            content = self.reply
+        else:
+            # プロンプト末尾の質問行をそのまま返す（リライト結果として自然な長さになる）
+            lines = [line for line in text.splitlines() if line.strip()]
+            content = lines[-2] if len(lines) >= 2 else text[:100]
+        return AIMessage(content=content)
+
+
+class FakeEmbeddings(Embeddings):
+    """文字bigramのハッシュで決定的なベクトルを生成するスタブ埋め込み"""
+
+    def __init__(self, dimensions: int = 256, latency_ms: float = 0):
+        self.dimensions = dimensions
+        self.latency_ms = latency_ms
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for gram in _char_ngrams(text):
+            digest = hashlib.md5(gram.encode('utf-8')).digest()
+            index = int.from_bytes(digest[:4], 'little') % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        return self._embed(text)
+
+
+class FakeCrossEncoder:
+    """文字bigramのJaccard係数でスコアを付けるスタブCross-Encoder"""
+
+    def __init__(self, latency_ms_per_pair: float = 0):
+        self.latency_ms_per_pair = latency_ms_per_pair
+
+    def predict(self, pairs) -> List[float]:
+        if self.latency_ms_per_pair:
+            time.sleep(self.latency_ms_per_pair * len(pairs) / 1000)
+        scores = []
+        for query, content in pairs:
+            q = set(_char_ngrams(query))
+            c = set(_char_ngrams(content))
+            scores.append(len(q & c) / len(q | c) if q and c else 0.0)
+        return scores
+
+
+class Recording:
+    """LLM応答・埋め込みを記録し、次回以降に再生するためのJSONストア"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries: Dict[str, object] = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    @staticmethod
+    def key(kind: str, text: str) -> str:
+        return f"{kind}:{hashlib.sha256(text.encode('utf-8')).hexdigest()}"
+
+    def get(self, key: str):
+        with self._lock:
+            return self.entries.get(key)
+
+    def put(self, key: str, value):
+        with self._lock:
+            self.entries[key] = value
+
+    def save(self):
+        with self._lock:
+            with open(self.path, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f, ensure_ascii=False)
+
+
+class RecordedChatModel:
+    """記録済みの応答を返し、未記録の場合のみ実LLMを呼び出して記録する"""
+
+    def __init__(self, recording: Recording, name: str, inner=None):
+        self.recording = recording
+        self.name = name
+        self.inner = inner
+
+    def invoke(self, prompt, *args, **kwargs) -> AIMessage:
+        text = prompt if isinstance(prompt, str) else str(prompt)
+        key = Recording.key(self.name, text)
+        content = self.recording.get(key)
+        if content is None:
+            if self.inner is None:
+                raise KeyError(f"記録されていないプロンプトです: {key}")
+            content = self.inner.invoke(prompt, *args, **kwargs).content
+            self.recording.put(key, content)
+        return AIMessage(content=content)
+
+
+class RecordedEmbeddings(Embeddings):
+    """記録済みの埋め込みを返し、未記録の場合のみ実APIを呼び出して記録する"""
+
+    def __init__(self, recording: Recording, inner: Optional[Embeddings] = None):
+        self.recording = recording
+        self.inner = inner
+
+    def _lookup(self, text: str, compute) -> List[float]:
+        key = Recording.key('embedding', text)
+        vector = self.recording.get(key)
+        if vector is None:
+            if self.inner is None:
+                raise KeyError(f"記録されていない埋め込みです: {key}")
+            vector = compute(text)
+            self.recording.put(key, vector)
+        return vector
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._lookup(text, lambda t: self.inner.embed_documents([t])[0]) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._lookup(text, self.inner.embed_query if self.inner else None)
+
+
+def build_stub_store(records: List[Dict], embeddings: Embeddings):
+    """レコードをインメモリのChromaコレクションに投入して返す"""
+    import chromadb
+    from langchain_chroma import Chroma
+
+    store = Chroma(
+        client=chromadb.EphemeralClient(),
+        collection_name=f"bench-{uuid.uuid4().hex[:8]}",
+        embedding_function=embeddings,
+        collection_metadata={"hnsw:space": "cosine"},
+    )
+    batch_size = 100
+    for i in range(0, len(records), batch_size):
+        batch = records[i:i + batch_size]
+        store.add_texts(
+            texts=[r['content'] for r in batch],
+            metadatas=[{k: r[k] for k in ('id', 'type', 'doc_title', 'question', 'answer', 'source')} for r in batch],
+            ids=[r['id'] for r in batch],
+        )
+    return store
+
+
+def build_stub_multivector(records: List[Dict], embeddings: Embeddings):
+    """レコードの質問・回答ベクトルをインメモリのChromaコレクションに投入して返す"""
+    import chromadb
+    from langchain_chroma import Chroma
+
+    from common.multivector import QA_VECTOR_METADATA, child_records
+
+    store = Chroma(
+        client=chromadb.EphemeralClient(),
+        collection_name=f"bench-qa-{uuid.uuid4().hex[:8]}",
+        embedding_function=embeddings,
+        collection_metadata=QA_VECTOR_METADATA,
+    )
+    children = [child for r in records if r.get('type') == 'qa'
+                for child in child_records({'id': r['id'], 'content': r['content'], 'metadata': r})]
+    batch_size = 100
+    for i in range(0, len(children), batch_size):
+        batch = children[i:i + batch_size]
+        store.add_texts(
+            texts=[c['content'] for c in batch],
+            metadatas=[c['metadata'] for c in batch],
+            ids=[c['id'] for c in batch],
+        )
+    return store
+
+
+def build_stub_router(records: List[Dict], embeddings: Embeddings, margin: float = 0.03):
+    """レコードの埋め込みからセントロイドを作り、振り分け用のルーターを返す"""
+    from common.router import IntentRouter, centroids_from_vectors
+
+    vectors = embeddings.embed_documents([r['content'] for r in records])
+    return IntentRouter(centroids_from_vectors(zip(records, vectors)), margin=margin)
+
+
+def install_providers(service, llm_rewrite=None, llm_answer=None, embeddings=None, store=None, cross_encoder=None,
+                      multi_vector=None, router=None, ivf=None, shards=None, features=None, fact_index=None):
+    """AIService / AIServiceLite のプロバイダを差し替える
+
+    store を差し替えるときは、マルチベクトルのインデックス・振り分けのルーター・IVFインデックス・店舗シャード・
+    特徴量ストア・数値ファクトのインデックスも multi_vector / router / ivf / shards / features / fact_index
+    （省略時は無効・空）に揃え、元のストアから作った回答キャッシュと語彙インデックスを破棄する。
+    """
+    if llm_rewrite is not None:
+        service.llm_rewrite = llm_rewrite
+    if llm_answer is not None:
+        if hasattr(service, 'llm_answer'):
+            service.llm_answer = llm_answer
+        else:
+            service.llm = llm_answer
+    if embeddings is not None:
+        if hasattr(service, 'embeddings_model'):
+            service.embeddings_model = embeddings
+        else:
+            service.embeddings = embeddings
+    if store is not None:
+        if hasattr(service, 'db'):
+            service.db = store
+        else:
+            service.vector_store = store
+        if hasattr(service, 'qa_vectors'):
+            service.qa_vectors = multi_vector
+        if hasattr(service, 'router'):
+            service.router = router
+        if hasattr(service, 'ivf'):
+            service.ivf = ivf
+        if hasattr(service, 'shards'):
+            service.shards = shards
+        if hasattr(service, 'features'):
+            service.features = features
+        if hasattr(service, 'fact_index'):
+            service.fact_index = fact_index if fact_index is not None else FactIndex([])
+        if hasattr(service, '_fact_index_version'):
+            # 差し替えたインデックスを、特徴量ストアの版が変わるまで読み直さない
+            service._fact_index_version = features.facts_version() if features is not None else None
+        if hasattr(service, 'clear_caches'):
+            service.clear_caches()
+    if cross_encoder is not None and hasattr(service, '_cross_encoder'):
+        service._cross_encoder = cross_encoder
+    return service
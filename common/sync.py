@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+ソースファイルとChromaコレクションの差分同期（取り込みコマンド共通）
+
+- IDは連番ではなくブロックの見出し（QAなら質問文、ガイドラインならタイトル）から作るので、
+  ブロックを挿入・並べ替えてもIDがずれない
+- 本文と安定したメタデータのハッシュ（sync_hash）をメタデータに保存し、
+  同じ種別の既存ドキュメントと比べて 追加 / 更新 / 削除 だけを適用する
+- 埋め込みを全部計算し終えてから書き込むので、途中でAPIが失敗してもコレクションは変わらない
+- 変更が無ければ埋め込みAPIは呼ばない（変更分も本文が同じなら埋め込みキャッシュから返る）
+- 大きなファイルは sync_stream() でバッチごとに差分を適用する（保持するのは既存の ID → ハッシュ だけ）
+
+レコードは 'id' / 'content' / 'metadata' を持つ辞書。
+"""
+import hashlib
+import json
+from typing import Dict, Iterable, List, Optional
+
+from common.ingest import embed_concurrently, upsert_vectors
+from common.tokens import count_tokens
+
+# 差分判定に使わないメタデータ（取り込み日や派生値は変わっても更新扱いにしない）
+VOLATILE_KEYS = ('updated_at', 'token_count', 'sync_hash')
+
+
+def stable_id(prefix: str, key: str, seen: Optional[Dict[str, int]] = None) -> str:
+    """見出しから安定したIDを作る（同じ見出しが複数あれば出現順の番号を付ける）"""
+    digest = hashlib.sha256(key.strip().encode('utf-8')).hexdigest()[:16]
+    doc_id = f"{prefix}.{digest}"
+    if seen is not None:
+        seen[doc_id] = seen.get(doc_id, 0) + 1
+        if seen[doc_id] > 1:
+            doc_id = f"{doc_id}-{seen[doc_id]}"
+    return doc_id
+
+
+def sync_hash(content: str, metadata: Dict) -> str:
+    stable = {key: value for key, value in metadata.items() if key not in VOLATILE_KEYS}
+    payload = json.dumps([content, stable], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SyncPlan:
+    """同期で適用する変更"""
+
+    def __init__(self, inserts: List[Dict], updates: List[Dict], deletes: List[str], unchanged: List[str]):
+        self.inserts = inserts
+        self.updates = updates
+        self.deletes = deletes
+        self.unchanged = unchanged
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.inserts or self.updates or self.deletes)
+
+    def summary(self) -> str:
+        return (f"{len(self.inserts)} inserted, {len(self.updates)} updated, "
+                f"{len(self.deletes)} deleted, {len(self.unchanged)} unchanged")
+
+
+class SyncStats:
+    """sync_stream() の集計（件数だけを持つ）"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.deleted = 0
+        self.unchanged = 0
+
+    def add(self, plan: SyncPlan):
+        self.inserted += len(plan.inserts)
+        self.updated += len(plan.updates)
+        self.deleted += len(plan.deletes)
+        self.unchanged += len(plan.unchanged)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.inserted or self.updated or self.deleted)
+
+    def summary(self) -> str:
+        return (f"{self.inserted} inserted, {self.updated} updated, "
+                f"{self.deleted} deleted, {self.unchanged} unchanged")
+
+
+def load_existing_hashes(collection, where: Dict) -> Dict[str, Optional[str]]:
+    """where に一致する既存ドキュメントの ID → sync_hash"""
+    existing = collection.get(where=where, include=['metadatas'])
+    return {
+        doc_id: (metadata or {}).get('sync_hash')
+        for doc_id, metadata in zip(existing['ids'], existing['metadatas'])
+    }
+
+
+def plan_sync(collection, records: List[Dict], where: Dict,
+              existing_hashes: Optional[Dict[str, Optional[str]]] = None, deletes: bool = True) -> SyncPlan:
+    """where に一致する既存ドキュメントとレコードを比べて変更を求める
+
+    where の範囲にあってレコードに無いドキュメント（古い連番IDやIDなしで重複登録されたもの）は削除する。
+    records がファイルの一部（バッチ）のときは deletes=False にして、削除は最後にまとめて求める。
+    """
+    if existing_hashes is None:
+        existing_hashes = load_existing_hashes(collection, where)
+    inserts, updates, unchanged = [], [], []
+    for record in records:
+        digest = sync_hash(record['content'], record['metadata'])
+        if record['id'] not in existing_hashes:
+            inserts.append(record)
+        elif existing_hashes[record['id']] != digest:
+            updates.append(record)
+        else:
+            unchanged.append(record['id'])
+    record_ids = {record['id'] for record in records}
+    stale = [doc_id for doc_id in existing_hashes if doc_id not in record_ids] if deletes else []
+    return SyncPlan(inserts, updates, stale, unchanged)
+
+
+def apply_sync(collection, plan: SyncPlan, embeddings, features=None,
+               concurrency: int = 4, batch_tokens: int = 20000, on_batch=None) -> SyncPlan:
+    """変更を適用する（埋め込み → upsert → 削除 の順。特徴量ストアも合わせて更新する）"""
+    changed = plan.inserts + plan.updates
+    if changed:
+        ids = [record['id'] for record in changed]
+        texts = [record['content'] for record in changed]
+        metadatas = []
+        for record in changed:
+            metadata = dict(record['metadata'])
+            metadata['sync_hash'] = sync_hash(record['content'], record['metadata'])
+            # コンテキスト詰め込み時に数え直さないよう取り込み時に計算しておく
+            metadata.setdefault('token_count', count_tokens(record['content']))
+            metadatas.append(metadata)
+        vectors = embed_concurrently(
+            embeddings, texts, [metadata['token_count'] for metadata in metadatas],
+            batch_tokens=batch_tokens, concurrency=concurrency, on_batch=on_batch,
+        )
+        upsert_vectors(collection, ids, texts, vectors, metadatas)
+        if features is not None:
+            features.upsert(zip(ids, texts, [metadata.get('source', '') for metadata in metadatas]))
+    if plan.deletes:
+        collection.delete(ids=plan.deletes)
+        if features is not None:
+            features.delete(plan.deletes)
+    return plan
+
+
+def backfill_features(collection, plan: SyncPlan, features) -> int:
+    """変更の無いドキュメントのうち特徴量ストアに無いものを補う（ストアだけ消えた場合）"""
+    stored_ids = features.get_many(plan.unchanged)
+    missing = [doc_id for doc_id in plan.unchanged if doc_id not in stored_ids]
+    if not missing:
+        return 0
+    stored = collection.get(ids=missing, include=['documents', 'metadatas'])
+    return features.upsert(
+        (doc_id, content, (metadata or {}).get('source', ''))
+        for doc_id, content, metadata in zip(stored['ids'], stored['documents'], stored['metadatas'])
+    )
+
+
+def sync_stream(collection, batches: Iterable[List[Dict]], where: Dict, embeddings, features=None,
+                dry_run: bool = False, concurrency: int = 4, batch_tokens: int = 20000,
+                on_batch=None) -> SyncStats:
+    """レコードのバッチを順に同期し、最後にどのバッチにも無かった既存ドキュメントを削除する
+
+    バッチごとに書き込むので、途中で失敗した場合はそれまでのバッチだけが反映される
+    （再実行すれば残りの差分だけが適用される）。
+    """
+    existing_hashes = load_existing_hashes(collection, where)
+    seen_ids = set()
+    stats = SyncStats()
+    for records in batches:
+        plan = plan_sync(collection, records, where, existing_hashes=existing_hashes, deletes=False)
+        seen_ids.update(record['id'] for record in records)
+        if not dry_run:
+            apply_sync(collection, plan, embeddings, features,
+                       concurrency=concurrency, batch_tokens=batch_tokens, on_batch=on_batch)
+            if features is not None:
+                backfill_features(collection, plan, features)
+        stats.add(plan)
+    if not seen_ids:
+        # 空のファイルや解析の失敗で既存ドキュメントを全部消さない
+        print(f"No records read; skipped deleting {len(existing_hashes)} existing documents")
+        return stats
+    stale = SyncPlan([], [], [doc_id for doc_id in existing_hashes if doc_id not in seen_ids], [])
+    if not dry_run:
+        apply_sync(collection, stale, embeddings, features)
+    stats.add(stale)
+    return stats
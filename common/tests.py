@@ -0,0 +1,434 @@
+import json
+import os
+import tempfile
+import threading
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from common import memory
+from common.adaptive import AdaptiveController, AdaptiveThresholds
+from common.circuit import CircuitBreaker, CircuitOpen
+from common.context_packer import SEPARATOR, pack_context
+from common.dedupe import find_duplicates
+from common.facts import FactIndex, extract_facts, extract_numeric_facts, facts_contradict
+from common.features import FeatureStore
+from common.parsers import iter_guideline_records, iter_qa_records, iter_text_chunks, source_config, source_scope
+from common.router import IntentRouter, centroids_from_vectors
+from common.sync import sync_stream
+
+
+class FakeCollection:
+    """Chromaコレクションの代わり（where は {'key': value} と '$and' だけを扱う）"""
+
+    def __init__(self):
+        self.rows = {}
+
+    @staticmethod
+    def matches(metadata, where):
+        if '$and' in where:
+            return all(FakeCollection.matches(metadata, clause) for clause in where['$and'])
+        return all(metadata.get(key) == value for key, value in where.items())
+
+    def get(self, ids=None, where=None, include=()):
+        found = [(doc_id, row) for doc_id, row in self.rows.items()
+                 if (ids is None or doc_id in ids) and (where is None or self.matches(row['metadata'], where))]
+        return {'ids': [doc_id for doc_id, _ in found],
+                'documents': [row['document'] for _, row in found],
+                'metadatas': [row['metadata'] for _, row in found]}
+
+    def upsert(self, ids, documents, embeddings, metadatas):
+        for doc_id, document, metadata in zip(ids, documents, metadatas):
+            self.rows[doc_id] = {'document': document, 'metadata': metadata}
+
+    def delete(self, ids):
+        for doc_id in ids:
+            self.rows.pop(doc_id, None)
+
+
+class CountingEmbeddings:
+    """埋め込んだ本文を記録するスタブ"""
+
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+
+def guideline_lines(*sections):
+    lines = []
+    for title, content in sections:
+        lines += [f"タイトル: {title}", "カテゴリ: 館内", f"内容: {content}", "---"]
+    return lines
+
+
+class SyncStreamTests(SimpleTestCase):
+    def sync(self, collection, path, sections, embeddings=None):
+        config = source_config(path, format='guideline')
+        records = list(iter_guideline_records(guideline_lines(*sections), doc_title=config['doc_title'],
+                                              id_prefix=config['id_prefix']))
+        return sync_stream(collection, [records], source_scope(config), embeddings or CountingEmbeddings())
+
+    def test_insert_update_delete(self):
+        collection = FakeCollection()
+        stats = self.sync(collection, 'docs/guideline_unified.txt', [('朝食', '7時から'), ('駐車場', '20台')])
+        self.assertEqual((stats.inserted, stats.updated, stats.deleted), (2, 0, 0))
+
+        embeddings = CountingEmbeddings()
+        stats = self.sync(collection, 'docs/guideline_unified.txt',
+                          [('朝食', '6時半から'), ('チェックアウト', '11時')], embeddings)
+        self.assertEqual((stats.inserted, stats.updated, stats.deleted, stats.unchanged), (1, 1, 1, 0))
+        self.assertEqual(sorted(embeddings.embedded), ['11時', '6時半から'])
+        self.assertEqual(sorted(row['metadata']['title'] for row in collection.rows.values()),
+                         ['チェックアウト', '朝食'])
+
+    def test_unchanged_records_are_not_embedded(self):
+        collection = FakeCollection()
+        self.sync(collection, 'docs/guideline_unified.txt', [('朝食', '7時から')])
+        embeddings = CountingEmbeddings()
+        stats = self.sync(collection, 'docs/guideline_unified.txt', [('朝食', '7時から')], embeddings)
+        self.assertEqual((stats.unchanged, stats.changed), (1, False))
+        self.assertEqual(embeddings.embedded, [])
+
+    def test_sync_is_scoped_to_the_source_file(self):
+        collection = FakeCollection()
+        self.sync(collection, 'docs/guideline_unified.txt', [('朝食', '7時から'), ('駐車場', '20台')])
+        stats = self.sync(collection, 'docs/shibuya_guideline.txt', [('朝食', '渋谷店は6時から')])
+        # 別のファイルの同期では既存のガイドラインを消さず、同じタイトルでもIDが衝突しない
+        self.assertEqual((stats.inserted, stats.deleted), (1, 0))
+        self.assertEqual(len(collection.rows), 3)
+
+    def test_empty_file_deletes_nothing(self):
+        collection = FakeCollection()
+        self.sync(collection, 'docs/guideline_unified.txt', [('朝食', '7時から')])
+        stats = self.sync(collection, 'docs/guideline_unified.txt', [])
+        self.assertEqual(stats.deleted, 0)
+        self.assertEqual(len(collection.rows), 1)
+
+
+class QARecordTests(SimpleTestCase):
+    def test_source_shows_the_question_not_the_hash(self):
+        lines = ["朝食は何時からですか", "7時からです", "=====", "駐車場は" + "ありますか" * 10, "20台です"]
+        records = list(iter_qa_records(lines, 'フロントFAQ', 'qa', 'qa'))
+        self.assertEqual(records[0]['source'], 'フロントFAQ - 朝食は何時からですか')
+        self.assertNotIn(records[1]['id'], records[1]['source'])
+        self.assertTrue(records[1]['source'].endswith('…'))
+        # IDは質問のハッシュのまま（差分同期のキー）
+        self.assertTrue(records[0]['id'].startswith('qa.'))
+
+
+class FindDuplicatesTests(SimpleTestCase):
+    def plan(self, contents):
+        records = [{'id': f"r{i}", 'content': content, 'metadata': {'question': content.split('\n')[0]}}
+                   for i, content in enumerate(contents)]
+        return find_duplicates(lambda: iter(records))
+
+    def test_identical_records_are_collapsed(self):
+        text = "大浴場の利用時間は15時から翌朝10時までです。タオルはお部屋からお持ちください。"
+        plan = self.plan([text, text + " "])
+        self.assertEqual(plan.canonical_of, {'r1': 'r0'})
+
+    def test_records_differing_only_in_numbers_are_kept(self):
+        base = ("会議室Aのご予約は{}階フロントで承ります。ご利用料金は1時間あたり{}円です。"
+                "プロジェクターとホワイトボードは無料でお貸しします。お問い合わせは内線{}番へ。")
+        plan = self.plan([base.format(2, '3,000', 201), base.format(3, '3,000', 201),
+                          base.format(2, '5,500', 201), base.format(2, '3,000', 301)])
+        self.assertEqual(plan.canonical_of, {})
+
+    def test_full_width_and_comma_numbers_are_the_same(self):
+        text = "駐車場は1台1泊{}円です。台数に限りがございますので、事前にご予約をお願いいたします。"
+        plan = self.plan([text.format('1,000'), text.format('１０００')])
+        self.assertEqual(plan.canonical_of, {'r1': 'r0'})
+
+
+class NumericFactTests(SimpleTestCase):
+    def test_hours_are_not_split_into_hour_and_between(self):
+        self.assertEqual(extract_numeric_facts("ご利用は最大2時間、17時までです"), [('17', '時'), ('2', '時間')])
+        self.assertEqual(extract_numeric_facts("料金は１,５００円です"), [('1500', '円')])
+
+    def test_contradiction_needs_the_same_unit(self):
+        self.assertFalse(facts_contradict([('2', '時間')], [('2', '時間'), ('10', '時')]))
+        self.assertTrue(facts_contradict([('2', '時間')], [('3', '時間')]))
+        self.assertTrue(facts_contradict([('7', '時')], [('7', '時'), ('10', '時')]))
+        self.assertFalse(facts_contradict([('2', '時間')], [('2', '時')]))
+
+    def test_feature_store_uses_the_same_extractor(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            store = FeatureStore(os.path.join(tmp, 'features.sqlite3'))
+            content = "質問: 延長は何時間までですか\n\n回答: 延長は2時間まで、1時間あたり1,000円です。"
+            store.upsert([('qa.1', content, '')])
+            stored = store.get_many(['qa.1'])['qa.1']['numeric_facts']
+            store.close()
+        self.assertEqual(stored, extract_numeric_facts(content))
+
+
+class FactsVersionTests(SimpleTestCase):
+    def test_version_changes_when_another_connection_writes_facts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'features.sqlite3')
+            reader, writer = FeatureStore(path), FeatureStore(path)
+            before = reader.facts_version()
+            writer.upsert([('qa.1', "質問: 朝食は何時からですか\n\n回答: 7時からです。", '')])
+            after_upsert = reader.facts_version()
+            writer.delete(['qa.1'])
+            after_delete = reader.facts_version()
+            facts = reader.load_facts()
+            reader.close()
+            writer.close()
+        self.assertLess(before, after_upsert)
+        self.assertLess(after_upsert, after_delete)
+        self.assertEqual(facts, [])
+
+
+def fact_index(*qas):
+    facts = []
+    for i, (question, answer) in enumerate(qas):
+        for fact in extract_facts(f"質問: {question}\n\n回答: {answer}"):
+            facts.append(dict(fact, doc_id=f"qa.{i}", source=question))
+    return FactIndex(facts)
+
+
+class FactIndexLookupTests(SimpleTestCase):
+    def setUp(self):
+        self.index = fact_index(
+            ("チェックアウトは何時ですか", "チェックアウトは11時です。"),
+            ("駐車場の料金はいくらですか", "駐車場は1泊1,000円です。"),
+            ("朝食会場の営業時間", "朝食会場は7時から営業しています。"),
+        )
+
+    def test_matching_question_hits(self):
+        fact = self.index.lookup("チェックアウトは何時？")
+        self.assertEqual((fact['value'], fact['unit'], fact['doc_id']), ('11', '時', 'qa.0'))
+        self.assertEqual(self.index.lookup("駐車場の料金はいくら？")['value'], '1000')
+
+    def test_price_noun_alone_is_not_a_quantity_question(self):
+        self.assertIsNone(self.index.lookup("駐車場の料金プランの違いは？"))
+        self.assertIsNone(self.index.lookup("駐車場の料金について"))
+
+    def test_unrelated_or_non_qa_facts_are_not_returned(self):
+        # 主題bigramの重なりが min_score に届かない質問には答えない
+        self.assertIsNone(self.index.lookup("朝食会場は何時から？"))
+        self.assertIsNone(self.index.lookup("チェックインは何時？"))
+
+    def test_competing_values_are_ambiguous(self):
+        index = fact_index(("チェックアウトは何時ですか", "チェックアウトは11時です。"),
+                           ("チェックアウトは何時ですか", "チェックアウトは12時です。"))
+        self.assertIsNone(index.lookup("チェックアウトは何時？"))
+
+
+@override_settings(MEMORY_BUDGET_MB=1, MEMORY_CHECK_INTERVAL=0)
+class EnforceBudgetTests(SimpleTestCase):
+    def test_concurrent_checks_evict_once(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def evict():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+
+        results = []
+        # 他のテストで作ったサービスの登録を退避させない
+        with mock.patch.dict(memory._components, clear=True), \
+                mock.patch.object(memory, 'rss_mb', return_value=100.0), mock.patch.object(memory, '_last_check', 0.0):
+            memory.register('test_cache', evict=evict, priority=1, repeatable=True)
+            first = threading.Thread(target=lambda: results.append(memory.enforce_budget()))
+            first.start()
+            self.assertTrue(started.wait(5))
+            # 1つ目のスレッドが退避している間の2つ目は何もせずに戻る
+            self.assertEqual(memory.enforce_budget(), [])
+            release.set()
+            first.join(5)
+        self.assertEqual(calls, [1])
+        self.assertIn('test_cache', results[0])
+
+
+# トークン数は1文字1トークンとして数える（tiktokenの有無で結果が変わらないように）
+@mock.patch('common.parsers.count_tokens', lambda text: len(text or ''))
+class TextChunkTests(SimpleTestCase):
+    def chunks(self, lines, chunk_tokens=20, overlap_tokens=8):
+        return list(iter_text_chunks(lines, chunk_tokens=chunk_tokens, overlap_tokens=overlap_tokens))
+
+    def test_chunks_with_overlap_fit_the_budget(self):
+        lines = ["あ" * 6, "い" * 5, "う" * 7, "え" * 4, "お" * 9, "か" * 3, "き" * 12]
+        chunks = self.chunks(lines)
+        for _, text in chunks:
+            self.assertLessEqual(sum(len(line) for line in text.split("\n")), 20)
+        for (_, prev), (_, text) in zip(chunks, chunks[1:]):
+            prev_lines, lines_ = prev.split("\n"), text.split("\n")
+            overlap = [line for line in lines_ if line in prev_lines]
+            self.assertLessEqual(sum(len(line) for line in overlap), 8)
+            # 重ねるのは直前のチャンクの末尾の行
+            if overlap:
+                self.assertEqual(prev_lines[-len(overlap):], overlap)
+        self.assertEqual(chunks[-1][1].split("\n")[-1], "き" * 12)
+
+    def test_overlap_shrinks_for_a_long_next_line(self):
+        chunks = self.chunks(["あ" * 5, "い" * 5, "う" * 8, "え" * 18])
+        # 18トークンの行の前に重ねられるのは2トークンまでなので、直前の8トークンの行は重ねない
+        self.assertEqual(chunks[-1][1], "え" * 18)
+
+    def test_every_line_is_kept_and_headings_split_chunks(self):
+        lines = ["【朝食】", "い" * 10, "う" * 10, "【駐車場】", "え" * 5]
+        chunks = self.chunks(lines)
+        self.assertEqual([heading for heading, _ in chunks], ["【朝食】", "【朝食】", "【駐車場】"])
+        joined = "\n".join(text for _, text in chunks)
+        for line in lines:
+            self.assertIn(line, joined)
+        # 見出しをまたいで重ねない
+        self.assertEqual(chunks[-1][1], "【駐車場】\n" + "え" * 5)
+
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('common.circuit.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker('test', window=4, min_calls=4, failure_rate=0.5, open_seconds=30, probes=1)
+
+    def fail(self):
+        with self.assertRaises(ValueError):
+            self.breaker.call(mock.Mock(side_effect=ValueError))
+
+    def open(self):
+        for _ in range(4):
+            self.fail()
+        self.assertTrue(self.breaker.is_open())
+
+    def test_opens_at_the_failure_rate_after_min_calls(self):
+        self.breaker.call(lambda: 1)
+        self.breaker.call(lambda: 1)
+        self.fail()
+        self.assertEqual(self.breaker.state, 'closed')  # 3件では min_calls に届かない
+        self.fail()
+        self.assertEqual(self.breaker.state, 'open')
+        with self.assertRaises(CircuitOpen):
+            self.breaker.call(lambda: 1)
+        self.assertEqual(self.breaker.snapshot()['rejected'], 1)
+
+    def test_half_open_admits_one_probe_and_closes_on_success(self):
+        self.open()
+        self.now += 30
+        self.assertFalse(self.breaker.is_open())
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertFalse(self.breaker.allow())  # プローブ枠は1つ
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertEqual(self.breaker.snapshot()['window_calls'], 0)
+
+    def test_failed_probe_reopens(self):
+        self.open()
+        self.now += 30
+        self.fail()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(self.breaker.times_opened, 2)
+        self.assertTrue(self.breaker.is_open())
+
+    def test_ignored_probe_returns_its_slot(self):
+        self.open()
+        self.now += 30
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_ignored()
+        self.assertEqual(self.breaker.state, 'half_open')
+        self.assertTrue(self.breaker.allow())
+
+
+def sentences(*chars):
+    """1文10トークン（9文字＋句点）の文を並べた本文"""
+    return "".join(char * 9 + "。" for char in chars)
+
+
+@mock.patch('common.context_packer.count_tokens', lambda text: len(text or ''))
+class PackContextTests(SimpleTestCase):
+    def pack(self, contents, budget, **kwargs):
+        return pack_context([{'content': content, 'metadata': {}} for content in contents], budget, **kwargs)
+
+    def test_truncates_at_sentence_boundaries_within_the_budget(self):
+        packed, stats = self.pack([sentences(*"あいう"), sentences(*"かきくけこ")], 70, min_truncated_tokens=10)
+        self.assertEqual([doc['content'] for doc in packed], [sentences(*"あいう"), sentences(*"かきく")])
+        self.assertTrue(packed[1]['truncated'])
+        self.assertEqual(stats['packed_tokens'], 30 + len(SEPARATOR) + 30)
+        self.assertLessEqual(stats['packed_tokens'], 70)
+        self.assertEqual((stats['truncated'], stats['dropped_tokens']), (1, 20))
+
+    def test_too_short_remainder_is_dropped(self):
+        packed, stats = self.pack([sentences(*"あいうえお"), sentences(*"かき")], 60, min_truncated_tokens=10)
+        self.assertEqual(len(packed), 1)
+        self.assertEqual(stats['dropped_documents'], 1)
+
+    def test_near_duplicates_are_skipped(self):
+        base = sentences(*"あいうえおかきくけこ")
+        packed, stats = self.pack([base, base + "さ", sentences(*"たちつ")], 0)
+        self.assertEqual([doc['content'] for doc in packed], [base, sentences(*"たちつ")])
+        self.assertEqual(stats['duplicates'], 1)
+
+    def test_top_document_is_cut_by_characters_when_no_sentence_fits(self):
+        packed, stats = self.pack(["あ" * 50 + "。"], 20)
+        self.assertEqual(packed[0]['content'], "あ" * 20)
+        self.assertEqual(stats['packed_tokens'], 20)
+
+    def test_max_documents(self):
+        packed, stats = self.pack([sentences(char) for char in "あいうえ"], 0, max_documents=3)
+        self.assertEqual((len(packed), stats['dropped_documents']), (3, 1))
+
+
+class IntentRouterTests(SimpleTestCase):
+    def setUp(self):
+        # QA は x 軸、ガイドラインは y 軸の方向に集まっている
+        self.router = IntentRouter(centroids_from_vectors([
+            ({'type': 'qa'}, [1.0, 0.0]),
+            ({'type': 'qa'}, [2.0, 0.0]),
+            ({'type': 'guideline', 'category': '館内'}, [0.0, 3.0]),
+        ]), margin=0.1)
+
+    def test_routes_by_margin(self):
+        self.assertEqual(self.router.route([1.0, 0.2]).route, 'qa')
+        decision = self.router.route([0.2, 1.0])
+        self.assertEqual((decision.route, decision.label), ('guideline', 'guideline/館内'))
+        # 差が margin 未満なら両方を検索する
+        self.assertEqual(self.router.route([1.0, 0.95]).route, 'both')
+
+    def test_unusable_inputs_are_not_routed(self):
+        self.assertIsNone(self.router.route([0.0, 0.0]))
+        self.assertIsNone(self.router.route([1.0, 0.0, 0.0]))
+        qa_only = IntentRouter(centroids_from_vectors([({'type': 'qa'}, [1.0, 0.0])]))
+        self.assertIsNone(qa_only.route([1.0, 0.0]))
+
+
+class AdaptiveControllerTests(SimpleTestCase):
+    def decide(self, scores, search_type='qa', controller=None):
+        documents = [{'score': score} for score in scores]
+        return (controller or AdaptiveController()).decide(documents, search_type)
+
+    def test_actions(self):
+        decision = self.decide([0.8, 0.6, 0.55])
+        self.assertEqual((decision.action, decision.rerank_n, decision.skip_fallback), ('skip_rerank', 0, True))
+        # 1位は低いが上位2件に集中している
+        decision = self.decide([0.6, 0.58, 0.3, 0.29, 0.28])
+        self.assertEqual((decision.action, decision.rerank_n, decision.skip_fallback), ('shrink_rerank', 3, False))
+        self.assertEqual(self.decide([0.5] * 5).action, 'full_rerank')
+        self.assertEqual((self.decide([]).action, self.decide([]).rerank_n), ('full_rerank', 0))
+
+    def test_close_second_is_not_skipped(self):
+        self.assertNotEqual(self.decide([0.8, 0.78, 0.2, 0.1]).action, 'skip_rerank')
+
+    def test_thresholds_by_search_type(self):
+        controller = AdaptiveController(by_search_type={'guideline': AdaptiveThresholds(skip_score=0.9)})
+        self.assertEqual(self.decide([0.8, 0.6], 'qa', controller).action, 'skip_rerank')
+        self.assertNotEqual(self.decide([0.8, 0.6], 'guideline', controller).action, 'skip_rerank')
+
+    def test_load_falls_back_to_defaults(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'thresholds.json')
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({'thresholds': {'qa': {'skip_score': 0.9, 'shrink_n': 2}}}, f)
+            self.assertEqual(AdaptiveController.load(path).thresholds('qa').shrink_n, 2)
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('{"thresholds": {"qa": {"unknown": 1}}}')
+            controller = AdaptiveController.load(path)
+        self.assertEqual(controller.by_search_type, {})
+        self.assertEqual(AdaptiveController.load(os.path.join(tmp, 'missing.json')).by_search_type, {})
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+処理時間計測用のユーティリティ
+
+パイプラインの各ステージの所要時間を記録し、ベンチマークや負荷試験で
+パーセンタイルを集計するために使用する。
+また、リクエスト全体の締め切り（Deadline）とステージごとの時間予算の管理も行う。
+"""
+import math
+import time
+from concurrent.futures import Executor, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional
+
+
+class StageTimer:
+    """ステージごとの所要時間（ミリ秒）を記録するタイマー"""
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.timings: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """with文で囲んだ区間の所要時間を name に加算する"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.timings[name] = round(self.timings.get(name, 0.0) + elapsed, 2)
+
+    def elapsed_ms(self) -> float:
+        """計測開始からの経過時間（ミリ秒）"""
+        return (time.perf_counter() - self.started_at) * 1000
+
+    def as_dict(self) -> Dict[str, float]:
+        """ステージ別の所要時間に合計（total）を加えた辞書を返す"""
+        result = dict(self.timings)
+        result['total'] = round(self.elapsed_ms(), 2)
+        return result
+
+
+class StageTimeout(Exception):
+    """ステージが時間予算内に終わらなかった"""
+
+
+class Deadline:
+    """リクエスト全体の締め切り（seconds が None または0以下なら無期限）"""
+
+    def __init__(self, seconds: Optional[float]):
+        self.seconds = seconds if seconds and seconds > 0 else None
+        self.expires_at = time.monotonic() + self.seconds if self.seconds else None
+
+    def remaining(self) -> float:
+        """残り秒数（無期限なら inf）"""
+        if self.expires_at is None:
+            return math.inf
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def allows(self, seconds: float) -> bool:
+        """残り時間が seconds 以上あるか"""
+        return self.remaining() >= seconds
+
+    def budget(self, stage_seconds: Optional[float] = None) -> float:
+        """ステージの予算と残り時間の小さい方"""
+        return min(stage_seconds if stage_seconds else math.inf, self.remaining())
+
+
+def call_with_timeout(executor: Executor, timeout: float, fn: Callable, *args, **kwargs):
+    """fn を timeout 秒以内に実行し、超えたら StageTimeout を送出する
+
+    無期限の場合は呼び出し元スレッドでそのまま実行する。タイムアウトした呼び出しは
+    バックグラウンドで完了まで走り続けるが、結果は捨てられる。
+    """
+    if timeout == math.inf:
+        return fn(*args, **kwargs)
+    if timeout <= 0:
+        raise StageTimeout("no time left")
+    future = executor.submit(fn, *args, **kwargs)
+    try:
+        return future.result(timeout=timeout)
+    except FutureTimeoutError:
+        future.cancel()
+        raise StageTimeout(f"exceeded {timeout:.2f}s")
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    """線形補間でパーセンタイルを計算する（p は 0〜100）"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    rank = (len(ordered) - 1) * p / 100
+    lower = math.floor(rank)
+    upper = math.ceil(rank)
+    if lower == upper:
+        return ordered[lower]
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+
+def summarize_latencies(values: List[float]) -> Dict[str, Optional[float]]:
+    """レイテンシ（ミリ秒）の一覧から代表的な統計値をまとめる"""
+    if not values:
+        return {'count': 0, 'mean': None, 'p50': None, 'p90': None, 'p95': None, 'p99': None, 'max': None}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 2),
+        'p50': round(percentile(values, 50), 2),
+        'p90': round(percentile(values, 90), 2),
+        'p95': round(percentile(values, 95), 2),
+        'p99': round(percentile(values, 99), 2),
+        'max': round(max(values), 2),
+    }
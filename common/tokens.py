@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""
+tiktokenによるトークン数計算
+
+エンコーディングは初回のみ読み込み、以降はプロセス内で共有する。
+tiktokenが使えない環境では文字数ベースの概算にフォールバックする。
+"""
+import threading
+from typing import Optional
+
+DEFAULT_MODEL = "gpt-4o-mini"
+
+_encodings = {}
+_lock = threading.Lock()
+
+
+def get_encoding(model: str = DEFAULT_MODEL):
+    """モデルに対応するエンコーディングを返す（取得できなければNone）"""
+    with _lock:
+        if model not in _encodings:
+            try:
+                import tiktoken
+                try:
+                    _encodings[model] = tiktoken.encoding_for_model(model)
+                except KeyError:
+                    _encodings[model] = tiktoken.get_encoding("o200k_base")
+            except Exception as e:
+                print(f"Warning: tiktoken encoding unavailable: {e}")
+                _encodings[model] = None
+        return _encodings[model]
+
+
+def count_tokens(text: Optional[str], model: str = DEFAULT_MODEL) -> int:
+    """テキストのトークン数（tiktokenがなければ日本語1文字≒1トークンで概算）"""
+    if not text:
+        return 0
+    encoding = get_encoding(model)
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+チャットパイプラインの構造化トレース（JSONL）
+
+chat() 1回ごとに1行のJSONを書き出す。書き込みは QueueHandler / QueueListener
+による専用スレッドで行い、リクエストスレッドはキューに積むだけでブロックしない。
+キューが溢れた場合はそのトレースを捨てて件数だけ数える。
+
+ファイルは RotatingFileHandler で TRACE_MAX_BYTES ごとにローテーションし、
+TRACE_BACKUP_COUNT 世代まで保持する。
+"""
+import glob
+import json
+import logging
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, Iterator, List
+
+from django.conf import settings
+
+_lock = threading.Lock()
+_logger = None
+_listener = None
+dropped = 0
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """キューが満杯ならブロックせずに破棄するハンドラ"""
+
+    def enqueue(self, record):
+        global dropped
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped += 1
+
+    def prepare(self, record):
+        # 書き込みスレッド側で整形不要なメッセージ文字列だけを渡す
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+def is_enabled() -> bool:
+    return getattr(settings, 'TRACE_ENABLED', False)
+
+
+def trace_path() -> str:
+    return str(getattr(settings, 'TRACE_PATH', os.path.join(settings.BASE_DIR, 'traces', 'chat_trace.jsonl')))
+
+
+def _get_logger():
+    """初回呼び出し時に書き込みスレッドを起動する"""
+    global _logger, _listener
+    with _lock:
+        if _logger is None:
+            path = trace_path()
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            file_handler = RotatingFileHandler(
+                path,
+                maxBytes=getattr(settings, 'TRACE_MAX_BYTES', 10 * 1024 * 1024),
+                backupCount=getattr(settings, 'TRACE_BACKUP_COUNT', 5),
+                encoding='utf-8',
+            )
+            file_handler.setFormatter(logging.Formatter('%(message)s'))
+            records = queue.Queue(maxsize=getattr(settings, 'TRACE_QUEUE_SIZE', 1000))
+            _listener = QueueListener(records, file_handler)
+            _listener.start()
+            logger = logging.getLogger('w_manual_bot.trace')
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            logger.addHandler(_DroppingQueueHandler(records))
+            _logger = logger
+        return _logger
+
+
+def record(trace: Dict):
+    """トレースを1件キューに積む（無効時は何もしない）"""
+    if not is_enabled():
+        return
+    try:
+        line = json.dumps(trace, ensure_ascii=False, default=str, separators=(',', ':'))
+        _get_logger().info(line)
+    except Exception as e:
+        print(f"Warning: failed to record trace: {e}")
+
+
+def flush():
+    """書き込みスレッドを止めてキューを吐き出す（管理コマンド終了時など）"""
+    global _logger, _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+            for handler in list(_logger.handlers):
+                _logger.removeHandler(handler)
+            _listener = None
+            _logger = None
+
+
+def trace_files(path: str) -> List[str]:
+    """ローテーション済みファイルを含め、古い順に並べたファイル一覧"""
+    backups = [p for p in glob.glob(f"{path}.*") if p.rsplit('.', 1)[-1].isdigit()]
+    backups.sort(key=lambda p: int(p.rsplit('.', 1)[-1]), reverse=True)
+    return backups + ([path] if os.path.exists(path) else [])
+
+
+def read_traces(path: str) -> Iterator[Dict]:
+    """JSONLトレースを1件ずつ読み出す（壊れた行は読み飛ばす）"""
+    for file_path in trace_files(path):
+        with open(file_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
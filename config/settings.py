@@ -66,6 +66,8 @@ MIDDLEWARE = [
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
+    # PROFILING_ENABLED=False の場合は自動的に外れる
+    "common.profiling.ProfilingMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
@@ -94,6 +96,114 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Use lightweight version on Render free tier to avoid memory issues
 USE_LITE_AI_SERVICE = env.bool('USE_LITE_AI_SERVICE', default=True if 'RENDER' in os.environ else False)
 
+# 取り込み時に計算するドキュメント特徴量のサイドカーストア
+FEATURE_STORE_PATH = env('FEATURE_STORE_PATH', default=str(BASE_DIR / 'wdb' / 'features.sqlite3'))
+
+# 取り込み時の埋め込みキャッシュ（(モデル名, 本文のSHA-256) → ベクトル。本文が同じなら再埋め込みしない）
+EMBEDDING_CACHE_PATH = env('EMBEDDING_CACHE_PATH', default=str(BASE_DIR / 'wdb' / 'embeddings.sqlite3'))
+
+# 数値ファクトの高速パス（質問とQAの質問の主題語が双方向にこの値以上重なり、一意に決まる場合のみLLMを使わずに回答）
+# 評価で精度を確認するまでは無効（確信度チェックの矛盾判定は高速パスと関係なく特徴量の numeric_facts で行う）
+FACT_INDEX_ENABLED = env.bool('FACT_INDEX_ENABLED', default=False)
+FACT_INDEX_MIN_SCORE = env.float('FACT_INDEX_MIN_SCORE', default=0.8)
+# 特徴量ストアのファクトの版を確認する間隔（稼働中に取り込んだQAが高速パスに反映されるまでの秒数）
+FACT_INDEX_REFRESH_S = env.float('FACT_INDEX_REFRESH_S', default=60)
+
+# 検索前の振り分け（質問の埋め込みに最も近い 種別/カテゴリ のセントロイドで QA / ガイドライン / 両方 を選ぶ）
+# QAとそれ以外の類似度の差が ROUTER_MARGIN 未満なら両方を1回で検索する
+ROUTER_ENABLED = env.bool('ROUTER_ENABLED', default=True)
+ROUTER_MARGIN = env.float('ROUTER_MARGIN', default=0.03)
+
+# QAの質問・回答を別ベクトルにしたインデックス（取り込み済みなら一次検索に使う）
+MULTI_VECTOR_ENABLED = env.bool('MULTI_VECTOR_ENABLED', default=True)
+MULTI_VECTOR_K = env.int('MULTI_VECTOR_K', default=5)
+
+# クラスタ分割（IVF）ベクトルインデックス（build_ivf_index で作る。件数がコレクションと違えば使わない）
+# 質問に近い IVF_N_PROBE 個のクラスタだけと比べる（コーパスが数千チャンクを超えたら有効にする）
+IVF_ENABLED = env.bool('IVF_ENABLED', default=False)
+IVF_INDEX_PATH = env('IVF_INDEX_PATH', default=str(BASE_DIR / 'wdb' / 'ivf_index.npz'))
+IVF_N_PROBE = env.int('IVF_N_PROBE', default=8)
+
+# 店舗ごとのシャード（取り込みの --store で作る wdb_store_<店舗コード>）
+# LINEの質問はブランド共通の 'wdb' と、ユーザー（Customer.store）の店舗のシャードだけを検索する
+STORE_SHARDS_ENABLED = env.bool('STORE_SHARDS_ENABLED', default=True)
+# シャードの一覧を読み直す間隔（稼働中に取り込んだ店舗が検索対象になるまでの秒数）
+STORE_SHARDS_REFRESH_S = env.float('STORE_SHARDS_REFRESH_S', default=60)
+
+# 一次検索のスコア分布による再ランク・ガイドライン補完の適応制御
+# 上位のスコアが RERANK_SKIP_SCORE 以上で2位との差が RERANK_SKIP_MARGIN 以上なら再ランクとガイドライン補完を省き、
+# スコア分布の正規化エントロピーが RERANK_SHRINK_ENTROPY 以下なら上位 RERANK_SHRINK_N 件だけ再ランクする
+# （ADAPTIVE_RETRIEVAL_PATH に calibrate_retrieval の結果があれば検索方式ごとにそちらを使う）
+ADAPTIVE_RETRIEVAL_ENABLED = env.bool('ADAPTIVE_RETRIEVAL_ENABLED', default=True)
+ADAPTIVE_RETRIEVAL_PATH = env('ADAPTIVE_RETRIEVAL_PATH', default=str(BASE_DIR / 'wdb' / 'adaptive_retrieval.json'))
+RERANK_SKIP_SCORE = env.float('RERANK_SKIP_SCORE', default=0.65)
+RERANK_SKIP_MARGIN = env.float('RERANK_SKIP_MARGIN', default=0.05)
+RERANK_SHRINK_ENTROPY = env.float('RERANK_SHRINK_ENTROPY', default=0.5)
+RERANK_SHRINK_N = env.int('RERANK_SHRINK_N', default=3)
+
+# 回答生成プロンプトに渡す文書部分のトークン予算（0で無制限）
+CONTEXT_TOKEN_BUDGET = env.int('CONTEXT_TOKEN_BUDGET', default=1500)
+
+# 推論の同時実行数（gthreadワーカーのスレッド間で共有。Cross-EncoderはCPU、LLMはAPIのレート制限に合わせる）
+AI_RERANK_CONCURRENCY = env.int('AI_RERANK_CONCURRENCY', default=1)
+AI_LLM_CONCURRENCY = env.int('AI_LLM_CONCURRENCY', default=4)
+
+# chat() の締め切りとステージごとの時間予算（秒、0で無期限）
+# 予算を超えたステージは縮退（リライト省略・ベクトルスコアのまま・ガイドライン補完省略）して続行する
+CHAT_DEADLINE_S = env.float('CHAT_DEADLINE_S', default=20)
+LINE_CHAT_DEADLINE_S = env.float('LINE_CHAT_DEADLINE_S', default=8)
+CHAT_STAGE_BUDGETS = {
+    'rewrite': env.float('CHAT_BUDGET_REWRITE_S', default=1.5),
+    'retrieve': env.float('CHAT_BUDGET_RETRIEVE_S', default=3),
+    'rerank': env.float('CHAT_BUDGET_RERANK_S', default=2),
+    'fallback': env.float('CHAT_BUDGET_FALLBACK_S', default=2),
+    'generate': env.float('CHAT_BUDGET_GENERATE_S', default=0),
+}
+# 任意ステージを始める前に回答生成用として残しておく時間
+CHAT_GENERATE_RESERVE_S = env.float('CHAT_GENERATE_RESERVE_S', default=3)
+AI_STAGE_WORKERS = env.int('AI_STAGE_WORKERS', default=8)
+
+# 上流（埋め込み・リライトLLM・回答LLM）ごとのサーキットブレーカー
+CIRCUIT_WINDOW = env.int('CIRCUIT_WINDOW', default=20)
+CIRCUIT_MIN_CALLS = env.int('CIRCUIT_MIN_CALLS', default=5)
+CIRCUIT_FAILURE_RATE = env.float('CIRCUIT_FAILURE_RATE', default=0.5)
+CIRCUIT_OPEN_SECONDS = env.float('CIRCUIT_OPEN_SECONDS', default=30)
+CIRCUIT_HALF_OPEN_PROBES = env.int('CIRCUIT_HALF_OPEN_PROBES', default=1)
+# 縮退モードで返す回答キャッシュ（0で無効）
+ANSWER_CACHE_SIZE = env.int('ANSWER_CACHE_SIZE', default=500)
+ANSWER_CACHE_TTL_S = env.float('ANSWER_CACHE_TTL_S', default=24 * 60 * 60)
+
+# LLM呼び出しのヘッジ（直近レイテンシのこのパーセンタイルを過ぎたら重複リクエスト、0で無効）とリトライ
+HEDGE_PERCENTILE = env.float('HEDGE_PERCENTILE', default=90)
+HEDGE_MIN_SAMPLES = env.int('HEDGE_MIN_SAMPLES', default=20)
+HEDGE_MIN_DELAY_S = env.float('HEDGE_MIN_DELAY_S', default=0.3)
+# ヘッジ用スレッド数（埋まっている間はヘッジを送らない）
+HEDGE_MAX_WORKERS = env.int('HEDGE_MAX_WORKERS', default=8)
+LLM_MAX_RETRIES = env.int('LLM_MAX_RETRIES', default=2)
+LLM_RETRY_BACKOFF_S = env.float('LLM_RETRY_BACKOFF_S', default=0.25)
+
+# リクエストプロファイリング（無効時はオーバーヘッドなし）
+PROFILING_ENABLED = env.bool('PROFILING_ENABLED', default=False)
+PROFILING_SAMPLE_RATE = env.float('PROFILING_SAMPLE_RATE', default=0.0)
+PROFILING_MODE = env('PROFILING_MODE', default='sampling')  # sampling / cprofile
+PROFILING_INTERVAL_MS = env.float('PROFILING_INTERVAL_MS', default=5)
+PROFILING_HEADER = env('PROFILING_HEADER', default='X-Profile-Request')
+PROFILING_TOKEN = env('PROFILING_TOKEN', default='')
+PROFILING_DIR = env('PROFILING_DIR', default=str(BASE_DIR / 'profiles'))
+PROFILING_MAX_FILES = env.int('PROFILING_MAX_FILES', default=50)
+
+# メモリ計測と予算（0で無効。超過時はキャッシュ→再ランクモデルの順に退避）
+MEMORY_BUDGET_MB = env.float('MEMORY_BUDGET_MB', default=0)
+MEMORY_CHECK_INTERVAL = env.float('MEMORY_CHECK_INTERVAL', default=5)
+MEMORY_TRACEMALLOC = env.bool('MEMORY_TRACEMALLOC', default=False)
+
+# chat() の構造化トレース（JSONL、専用スレッドで非同期書き込み）
+TRACE_ENABLED = env.bool('TRACE_ENABLED', default=True)
+TRACE_PATH = env('TRACE_PATH', default=str(BASE_DIR / 'traces' / 'chat_trace.jsonl'))
+TRACE_MAX_BYTES = env.int('TRACE_MAX_BYTES', default=10 * 1024 * 1024)
+TRACE_BACKUP_COUNT = env.int('TRACE_BACKUP_COUNT', default=5)
+TRACE_QUEUE_SIZE = env.int('TRACE_QUEUE_SIZE', default=1000)
+
 
 # Database
 # https://docs.djangoproject.com/en/5.0/ref/settings/#databases
@@ -176,6 +286,8 @@ ACCOUNT_USERNAME_REQUIRED = False
 
 CHANNEL_ACCESS_TOKEN = env("CHANNEL_ACCESS_TOKEN")
 CHANNEL_SECRET = env("CHANNEL_SECRET")
+# Messaging APIの接続先（負荷試験時はローカルスタブに向ける）
+LINE_API_ENDPOINT = env("LINE_API_ENDPOINT", default="https://api.line.me")
 OPENAI_API_KEY = env("OPENAI_API_KEY")
 LIFF_ID = env("LIFF_ID")
 
@@ -185,4 +297,5 @@ SUPERUSER_EMAIL = env("SUPERUSER_EMAIL")
 SUPERUSER_PASSWORD = env("SUPERUSER_PASSWORD")
 
 
-SLACK_BOT_TOKEN = env('SLACK_BOT_TOKEN')
\ No newline at end of file
+SLACK_BOT_TOKEN = env('SLACK_BOT_TOKEN')
+SLACK_API_URL = env('SLACK_API_URL', default='https://slack.com/api/chat.postMessage')
\ No newline at end of file
@@ -8,9 +8,14 @@ https://docs.djangoproject.com/en/5.0/howto/deployment/wsgi/
 """
 
 import os
+import tracemalloc
 
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
 
+# アプリ読み込み前に開始し、モデル・ベクトルストア初期化時の割り当ても集計対象にする
+if os.environ.get('MEMORY_TRACEMALLOC', '').lower() in ('1', 'true', 'yes', 'on'):
+    tracemalloc.start(int(os.environ.get('MEMORY_TRACEMALLOC_FRAMES', '1')))
+
 application = get_wsgi_application()
@@ -53,5 +53,14 @@ def pre_fork(server, worker):
 def pre_exec(server):
     server.log.info("Forked child, re-executing.")
 
+def post_worker_init(worker):
+    from common import memory
+    memory.log_memory(f"worker start (pid: {worker.pid})")
+
+def worker_exit(server, worker):
+    # max_requests による再起動直前のメモリを残し、リーク傾向を追えるようにする
+    from common import memory
+    memory.log_memory(f"worker exit (pid: {worker.pid}, requests: {worker.nr})")
+
 def on_exit(server):
     server.log.info("Server is shutting down")
\ No newline at end of file
@@ -6,6 +6,8 @@ from .models import Customer
 # line_idはReadOnlyにする
 class CustomerAdmin(admin.ModelAdmin):
     search_fields = ('name',)
+    list_display = ('name', 'store', 'block')
+    list_filter = ('store',)
     readonly_fields = ('line_id','name','updated_at','created_at')
 
 admin.site.register(Customer, CustomerAdmin)
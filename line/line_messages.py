@@ -5,7 +5,7 @@ from linebot.models import (
     FlexSendMessage,
 )
 
-line_bot_api = LineBotApi(settings.CHANNEL_ACCESS_TOKEN)
+line_bot_api = LineBotApi(settings.CHANNEL_ACCESS_TOKEN, endpoint=settings.LINE_API_ENDPOINT)
 
 
 # 予約確定
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Django management command: LINE Webhookシミュレータ
+
+CHANNEL_SECRET で正しく署名した follow / text / unfollow イベントを CallbackView に
+送信し、Messaging API のローカルスタブで push_message / get_profile の呼び出しを
+記録する。Webhookの応答（ACK）レイテンシと、テキスト送信から push_message が
+届くまでのエンドツーエンド応答レイテンシを計測する。
+
+使い方:
+    python manage.py simulate_line_webhook --users 20 --messages-per-user 3 --rate 2
+    python manage.py simulate_line_webhook --authorized --events-per-body 3 --redelivery-rate 0.1
+    python manage.py simulate_line_webhook --server gthread:1:4 --live-openai
+"""
+import base64
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from common.stub_servers import FakeLineServer, FakeOpenAIServer, fake_line_env, fake_openai_env
+from common.timing import summarize_latencies
+from chat_ui.management.commands.bench_chat import load_questions
+from chat_ui.management.commands.loadtest_chat import start_gunicorn, stop_gunicorn
+from line.models import Customer
+
+# シミュレータが作成するユーザーIDの接頭辞（後片付けに使用）
+SIM_USER_PREFIX = 'Usim'
+
+
+def sign(body: str, channel_secret: str) -> str:
+    """X-Line-Signature ヘッダーの値を計算する"""
+    digest = hmac.new(channel_secret.encode('utf-8'), body.encode('utf-8'), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode('utf-8')
+
+
+def make_event(kind: str, user_id: str, text: str = None) -> Dict:
+    """Webhookイベントを1件生成する"""
+    event = {
+        'type': kind,
+        'mode': 'active',
+        'timestamp': int(time.time() * 1000),
+        'source': {'type': 'user', 'userId': user_id},
+        'webhookEventId': uuid.uuid4().hex[:26].upper(),
+        'deliveryContext': {'isRedelivery': False},
+    }
+    if kind in ('follow', 'message'):
+        event['replyToken'] = uuid.uuid4().hex
+    if kind == 'message':
+        event['message'] = {'type': 'text', 'id': str(random.randint(10 ** 13, 10 ** 14)),
+                            'quoteToken': uuid.uuid4().hex, 'text': text}
+    return event
+
+
+def make_body(events: List[Dict], redelivery: bool = False) -> str:
+    """イベント群をWebhookボディにする（再送時は isRedelivery を立てる）"""
+    if redelivery:
+        events = [dict(e, deliveryContext={'isRedelivery': True}) for e in events]
+    return json.dumps({'destination': 'Usimulator', 'events': events}, ensure_ascii=False)
+
+
+class Command(BaseCommand):
+    help = 'Simulate signed LINE webhook traffic against CallbackView and record Messaging API calls'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', help='計測対象のベースURL（指定時はgunicornを起動しない）')
+        parser.add_argument('--server', default='gthread:1:2', help='起動するgunicornの設定（worker_class:workers:threads）')
+        parser.add_argument('--line-port', type=int, default=0,
+                            help='Messaging APIスタブのポート（--url使用時はサーバー側のLINE_API_ENDPOINTと合わせる）')
+        parser.add_argument('--users', type=int, default=10, help='シミュレートするユーザー数')
+        parser.add_argument('--messages-per-user', type=int, default=3, help='ユーザーごとのテキスト送信数')
+        parser.add_argument('--rate', type=float, default=2, help='テキストWebhookの送信レート（ボディ/秒）')
+        parser.add_argument('--events-per-body', type=int, default=1, help='1ボディに含めるイベント数')
+        parser.add_argument('--redelivery-rate', type=float, default=0.0, help='再送（isRedelivery）する割合')
+        parser.add_argument('--authorized', action='store_true',
+                            help='認証パスワードを設定してマニュアル回答（AI）経路を通す')
+        parser.add_argument('--live-openai', action='store_true', help='OpenAIスタブを使わず実APIを使用')
+        parser.add_argument('--line-latency-ms', type=float, default=0, help='Messaging APIスタブの応答遅延')
+        parser.add_argument('--reply-timeout', type=float, default=60, help='応答待ちの最大秒数')
+        parser.add_argument('--questions', default='docs/rag-text.txt', help='送信するテキストの元になる質問セット')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--output', help='結果を書き出すJSONファイル')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        questions = load_questions(options['questions'])
+        if not questions:
+            raise CommandError(f"質問が見つかりません: {options['questions']}")
+
+        self.pending = defaultdict(deque)
+        self.pending_lock = threading.Lock()
+        self.reply_latencies: List[float] = []
+        line_stub = FakeLineServer(latency_ms=options['line_latency_ms'], on_call=self.on_stub_call,
+                                   port=options['line_port']).start()
+        self.stdout.write(f"Messaging API stub: {line_stub.url}")
+
+        openai_stub = None
+        process = None
+        try:
+            if options['url']:
+                base_url = options['url']
+            else:
+                env = fake_line_env(line_stub)
+                if not options['live_openai']:
+                    openai_stub = FakeOpenAIServer().start()
+                    env.update(fake_openai_env(openai_stub))
+                self.stdout.write(f"Starting gunicorn ({options['server']})")
+                process, base_url = start_gunicorn(options['server'], env, 'simulate_line_gunicorn.log')
+            report = self.simulate(f"{base_url}/line/callback/", questions, options, line_stub)
+        finally:
+            if process is not None:
+                stop_gunicorn(process)
+            if openai_stub is not None:
+                openai_stub.stop()
+            line_stub.stop()
+            Customer.objects.filter(line_id__startswith=SIM_USER_PREFIX).delete()
+
+        self.print_report(report)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
+
+    def on_stub_call(self, kind: str, user_id: str, at: float):
+        """push_message を受けたら、そのユーザーの最も古い未応答テキストと対応付ける"""
+        if kind != 'push_message':
+            return
+        with self.pending_lock:
+            queue = self.pending.get(user_id)
+            if queue:
+                self.reply_latencies.append((at - queue.popleft()) * 1000)
+
+    def post(self, url: str, body: str, ack: Dict[str, List]):
+        """署名付きでWebhookを送信し、ACKレイテンシとステータスを記録する"""
+        start = time.perf_counter()
+        try:
+            response = requests.post(url, data=body.encode('utf-8'), timeout=130, headers={
+                'Content-Type': 'application/json',
+                'X-Line-Signature': sign(body, settings.CHANNEL_SECRET),
+            })
+            status = str(response.status_code)
+        except requests.RequestException as e:
+            status = type(e).__name__
+        elapsed = (time.perf_counter() - start) * 1000
+        with self.pending_lock:
+            ack['latencies'].append(elapsed)
+            ack['statuses'][status] = ack['statuses'].get(status, 0) + 1
+
+    def send_phase(self, url: str, events: List[Dict], options, rate: float = None) -> Dict:
+        """イベントをボディにまとめて送信する（rate指定時はポアソン到着のオープンループ）"""
+        per_body = max(1, options['events_per_body'])
+        bodies = [events[i:i + per_body] for i in range(0, len(events), per_body)]
+        ack = {'latencies': [], 'statuses': {}}
+        with ThreadPoolExecutor(max_workers=64) as executor:
+            start = time.perf_counter()
+            offset = 0.0
+            rng = random.Random(options['seed'])
+            for batch in bodies:
+                if rate:
+                    offset += rng.expovariate(rate)
+                    delay = start + offset - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                sent_at = time.perf_counter()
+                redeliver = rng.random() < options['redelivery_rate']
+                with self.pending_lock:
+                    for event in batch:
+                        if event['type'] == 'message':
+                            # 再送分もサーバーは再度返信するため、その分も待つ
+                            for _ in range(2 if redeliver else 1):
+                                self.pending[event['source']['userId']].append(sent_at)
+                executor.submit(self.post, url, make_body(batch), ack)
+                if redeliver:
+                    executor.submit(self.post, url, make_body(batch, redelivery=True), ack)
+        return {
+            'bodies': len(bodies),
+            'events': len(events),
+            'redeliveries': sum(ack['statuses'].values()) - len(bodies),
+            'ack_ms': summarize_latencies(ack['latencies']),
+            'statuses': ack['statuses'],
+        }
+
+    def simulate(self, url: str, questions: List[str], options, line_stub) -> Dict:
+        users = [f"{SIM_USER_PREFIX}{uuid.uuid4().hex[:29]}" for _ in range(options['users'])]
+
+        # 1. 友達追加（get_profile と顧客登録）
+        follow = self.send_phase(url, [make_event('follow', u) for u in users], options)
+        if options['authorized']:
+            Customer.objects.filter(line_id__in=users).update(password='R105')
+
+        # 2. テキストメッセージ（ユーザーを交互に並べてオープンループで送信）
+        texts = [
+            make_event('message', user, random.choice(questions))
+            for _ in range(options['messages_per_user'])
+            for user in users
+        ]
+        started = time.perf_counter()
+        text = self.send_phase(url, texts, options, rate=options['rate'])
+        elapsed = time.perf_counter() - started
+
+        # 未応答が残っていれば待つ
+        deadline = time.monotonic() + options['reply_timeout']
+        while time.monotonic() < deadline and self.pending_count():
+            time.sleep(0.2)
+
+        # 3. 友達解除（顧客削除）
+        unfollow = self.send_phase(url, [make_event('unfollow', u) for u in users], options)
+
+        return {
+            'users': len(users),
+            'follow': follow,
+            'text': dict(text, throughput_events_per_sec=round(len(texts) / elapsed, 3) if elapsed else None),
+            'unfollow': unfollow,
+            'reply_ms': summarize_latencies(self.reply_latencies),
+            'unanswered': self.pending_count(),
+            'stub_calls': line_stub.counts(),
+        }
+
+    def pending_count(self) -> int:
+        with self.pending_lock:
+            return sum(len(q) for q in self.pending.values())
+
+    def print_report(self, report: Dict):
+        for phase in ('follow', 'text', 'unfollow'):
+            data = report[phase]
+            ack = data['ack_ms']
+            self.stdout.write(
+                f"[{phase}] bodies {data['bodies']} events {data['events']} redeliveries {data['redeliveries']} "
+                f"ack p50 {ack['p50']}ms p95 {ack['p95']}ms p99 {ack['p99']}ms statuses {data['statuses']}"
+            )
+        reply = report['reply_ms']
+        self.stdout.write(
+            f"[reply] p50 {reply['p50']}ms p95 {reply['p95']}ms p99 {reply['p99']}ms "
+            f"unanswered {report['unanswered']}, stub calls {report['stub_calls']}"
+        )
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.4 on 2026-10-19 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('line', '0003_questionmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='store',
+            field=models.CharField(blank=True, default='', max_length=40, verbose_name='店舗'),
+        ),
+    ]
@@ -6,6 +6,8 @@ class Customer(models.Model):
     line_id = models.CharField(max_length=255, unique=True, verbose_name="LINE ID")
     password = models.CharField(max_length=255, verbose_name="認証パスワード")
     block = models.BooleanField(default=False, verbose_name="ブロック")
+    # 所属店舗の店舗コード（取り込みの --store と同じ）。空ならブランド共通のドキュメントだけで答える
+    store = models.CharField(max_length=40, blank=True, default="", verbose_name="店舗")
 
     updated_at = models.DateTimeField("更新日", auto_now=True)
     created_at = models.DateTimeField("作成日", auto_now_add=True)
@@ -1,8 +1,13 @@
-from common.ai_service import ai_service
+from django.conf import settings
 
-def open_ai_chat(question: str) -> str:
-    """共通AIサービスを使用してチャット処理"""
-    result = ai_service.chat(question)
+from common.ai_service import get_ai_service
+
+def open_ai_chat(question: str, store: str = None) -> str:
+    """共通AIサービスを使用してチャット処理（LINE向けの短い締め切りで実行）
+
+    store を渡すと、ブランド共通のシャードに加えてその店舗のシャードだけを検索する。
+    """
+    result = get_ai_service().chat(question, deadline_s=settings.LINE_CHAT_DEADLINE_S, store=store)
     # LINEでは回答のみを返す（後方互換性のため）
     if isinstance(result, dict):
         return result['answer']
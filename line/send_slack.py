@@ -7,7 +7,7 @@ def notify_slack_msg(text):
     """
     slackへメッセージ送信
     """
-    url = "https://slack.com/api/chat.postMessage"
+    url = settings.SLACK_API_URL
     data = {
         "token": settings.SLACK_BOT_TOKEN,
         "channel": "C08HWQTPS9H",
@@ -26,7 +26,7 @@ from .line_messages import send_menu_message
 from .open_ai_views import open_ai_chat
 from .send_slack import notify_slack_msg
 
-line_bot_api = LineBotApi(settings.CHANNEL_ACCESS_TOKEN)
+line_bot_api = LineBotApi(settings.CHANNEL_ACCESS_TOKEN, endpoint=settings.LINE_API_ENDPOINT)
 handler = WebhookHandler(settings.CHANNEL_SECRET)
 
 
@@ -108,7 +108,7 @@ class CallbackView(View):
 
             # 情報やブロック要素に問題がなければマニュアル情報を提供する
             # 情報を保存
-            chat_manual_res = open_ai_chat(event.message.text)
+            chat_manual_res = open_ai_chat(event.message.text, store=customer.store or None)
             QuestionMessage.objects.create(customer=customer, message=event.message.text, response=chat_manual_res)
             notify_slack_msg(f"ユーザー: {customer.name} が質問しました。\n質問: {event.message.text}\n回答: {chat_manual_res}")
             return send_text_message(line_id, chat_manual_res)